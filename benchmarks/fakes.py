@@ -0,0 +1,884 @@
+"""
+In-process fakes used by the benchmarks: a Docker Engine API served on a
+unix socket and a Splight platform API served over HTTP, both with
+latency and fault injection.
+
+Only the endpoints the agent uses are implemented, with just enough of
+their semantics (container lifecycle, events, ETags, incremental fetches,
+deployment stream, ranged image downloads) to drive the real agent code.
+"""
+import hashlib
+import io
+import json
+import os
+import queue
+import random
+import re
+import socketserver
+import tarfile
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, Optional
+from urllib.parse import parse_qs, unquote, urlparse
+
+API_VERSION = "v3"
+DOCKER_API_VERSION = "1.43"
+
+
+class Faults:
+    """
+    Latency and errors injected in every request of a fake server
+    """
+
+    def __init__(
+        self, latency: float = 0.0, error_rate: float = 0.0, seed: int = 0
+    ) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.errors = 0
+
+    def delay(self) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            failed = self._random.random() < self.error_rate
+            self.errors += int(failed)
+        return failed
+
+
+def make_image_tarball(
+    name: str, size: int, seed: int = 0, layers: int = 1
+) -> bytes:
+    """
+    Synthetic `docker save` archive with size random bytes split evenly
+    across the given number of layers
+    """
+    rng = random.Random(seed)
+    layers = max(layers, 1)
+    members, diff_ids, layer_paths = [], [], []
+    for index in range(layers):
+        layer_size = size // layers + (index < size % layers)
+        layer_buffer = io.BytesIO()
+        with tarfile.open(fileobj=layer_buffer, mode="w") as layer:
+            info = tarfile.TarInfo(f"data-{index}.bin")
+            info.size = layer_size
+            layer.addfile(info, io.BytesIO(rng.randbytes(layer_size)))
+        layer_data = layer_buffer.getvalue()
+        layer_digest = hashlib.sha256(layer_data).hexdigest()
+        diff_ids.append(f"sha256:{layer_digest}")
+        layer_paths.append(f"{layer_digest}/layer.tar")
+        members.append((layer_paths[-1], layer_data))
+    config = json.dumps(
+        {
+            "architecture": "amd64",
+            "os": "linux",
+            "config": {"Cmd": ["sh"]},
+            "rootfs": {"type": "layers", "diff_ids": diff_ids},
+        }
+    ).encode()
+    config_digest = hashlib.sha256(config).hexdigest()
+    manifest = json.dumps(
+        [
+            {
+                "Config": f"{config_digest}.json",
+                "RepoTags": [f"{name}:latest"],
+                "Layers": layer_paths,
+            }
+        ]
+    ).encode()
+    # the manifest goes last, as in the archives written by docker save
+    members += [(f"{config_digest}.json", config), ("manifest.json", manifest)]
+
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as archive:
+        for path, data in members:
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+class _BodyReader(io.RawIOBase):
+    """
+    File object over a request body, so it can be consumed while it is
+    being received
+    """
+
+    def __init__(self, handler: "_Handler") -> None:
+        self._chunks = handler.iter_body()
+        self._buffer = b""
+        self.size = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+        length = min(len(buffer), len(self._buffer))
+        buffer[:length] = self._buffer[:length]
+        self._buffer = self._buffer[length:]
+        self.size += length
+        return length
+
+    def drain(self) -> None:
+        self.size += len(self._buffer)
+        for chunk in self._chunks:
+            self.size += len(chunk)
+        self._buffer = b""
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    HTTP/1.1 handler with chunked request and response bodies
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def read_body(self) -> bytes:
+        return b"".join(self.iter_body())
+
+    def iter_body(self, chunk_size: int = 1 << 20) -> Iterator[bytes]:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            yield from self.iter_chunked_body()
+            return
+        remaining = int(self.headers.get("Content-Length") or 0)
+        while remaining > 0:
+            data = self.rfile.read(min(remaining, chunk_size))
+            if not data:
+                return
+            remaining -= len(data)
+            yield data
+
+    def iter_chunked_body(self) -> Iterator[bytes]:
+        while True:
+            size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+            if size == 0:
+                self.rfile.readline()
+                return
+            data = self.rfile.read(size)
+            self.rfile.readline()
+            yield data
+
+    def send_json(self, status: int, data=None, headers=None) -> None:
+        body = b"" if data is None else json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def start_chunked(self, content_type: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+class _ThreadingUnixHTTPServer(
+    socketserver.ThreadingMixIn, socketserver.UnixStreamServer
+):
+    daemon_threads = True
+
+
+def _matches_labels(labels: dict, filters: list[str]) -> bool:
+    for item in filters:
+        key, sep, value = item.partition("=")
+        if key not in labels or (sep and labels[key] != value):
+            return False
+    return True
+
+
+class FakeDocker:
+    """
+    Docker Engine API on a unix socket, keeping containers, images and
+    networks in memory
+    """
+
+    def __init__(self, socket_path: str, faults: Optional[Faults] = None):
+        self.socket_path = socket_path
+        self.faults = faults or Faults()
+        self.calls: Counter = Counter()
+        self.lock = threading.Lock()
+        self.containers: dict[str, dict] = {}
+        self.images: dict[str, dict] = {}
+        # image reference (id, repo:tag) -> image id
+        self.references: dict[str, str] = {}
+        self.networks: dict[str, dict] = {}
+        self.events: list[dict] = []
+        self._subscribers: list[queue.Queue] = []
+        self._stopped = threading.Event()
+        self._server = _ThreadingUnixHTTPServer(
+            socket_path, self._make_handler()
+        )
+
+    def start(self) -> "FakeDocker":
+        threading.Thread(
+            target=self._server.serve_forever, daemon=True
+        ).start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._server.shutdown()
+        self._server.server_close()
+        os.remove(self.socket_path)
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def _emit(self, action: str, container: dict, **attributes) -> None:
+        now = time.time()
+        event = {
+            "Type": "container",
+            "Action": action,
+            "status": action,
+            "id": container["Id"],
+            "Actor": {
+                "ID": container["Id"],
+                "Attributes": {
+                    **container["Labels"],
+                    "name": container["Name"],
+                    **attributes,
+                },
+            },
+            "time": int(now),
+            "timeNano": int(now * 1e9),
+        }
+        with self.lock:
+            self.events.append(event)
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+    def _summary(self, container: dict) -> dict:
+        return {
+            "Id": container["Id"],
+            "Names": [f"/{container['Name']}"],
+            "Image": container["Image"],
+            "Labels": container["Labels"],
+            "State": container["State"],
+            "Status": container["Status"],
+            "Created": container["Created"],
+        }
+
+    def _inspect(self, container: dict) -> dict:
+        return {
+            "Id": container["Id"],
+            "Name": f"/{container['Name']}",
+            "Image": container["Image"],
+            "Created": datetime.fromtimestamp(
+                container["Created"], timezone.utc
+            ).isoformat(),
+            "Config": {
+                "Labels": container["Labels"],
+                "Image": container["Image"],
+            },
+            "State": {
+                "Status": container["State"],
+                "Running": container["State"] == "running",
+                "ExitCode": 0,
+            },
+            "HostConfig": container["HostConfig"],
+            "NetworkSettings": {
+                "Networks": {container["Network"]: {}}
+                if container["Network"]
+                else {}
+            },
+        }
+
+    def _find_container(self, ref: str) -> Optional[dict]:
+        with self.lock:
+            if ref in self.containers:
+                return self.containers[ref]
+            for container in self.containers.values():
+                if container["Name"] == ref or container["Id"].startswith(ref):
+                    return container
+        return None
+
+    def _find_image(self, ref: str) -> Optional[dict]:
+        with self.lock:
+            image_id = self.references.get(ref) or self.references.get(
+                f"{ref}:latest"
+            )
+            return self.images.get(image_id) if image_id else None
+
+    def _make_handler(self):
+        docker = self
+
+        class Handler(_Handler):
+            def _route(self, method: str) -> None:
+                url = urlparse(self.path)
+                path = re.sub(r"^/v[0-9.]+", "", unquote(url.path))
+                query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                route = re.sub(r"/[0-9a-f]{64}", "/{id}", path)
+                docker.calls[f"{method} {route.split('?')[0]}"] += 1
+                docker.faults.delay()
+                if path != "/events" and docker.faults.should_fail():
+                    self.read_body()
+                    self.send_json(500, {"message": "injected fault"})
+                    return
+                try:
+                    docker._handle(self, method, path, query)
+                except BrokenPipeError:
+                    pass
+
+            def do_GET(self):
+                self._route("GET")
+
+            def do_POST(self):
+                self._route("POST")
+
+            def do_DELETE(self):
+                self._route("DELETE")
+
+            def do_HEAD(self):
+                self._route("HEAD")
+
+        return Handler
+
+    def _handle(self, handler: _Handler, method: str, path: str, query: dict):
+        if path == "/_ping":
+            handler.send_json(200, "OK")
+        elif path == "/version":
+            handler.send_json(
+                200,
+                {
+                    "ApiVersion": DOCKER_API_VERSION,
+                    "MinAPIVersion": "1.12",
+                    "Version": "24.0.0",
+                },
+            )
+        elif path == "/events":
+            self._stream_events(handler, query)
+        elif path == "/containers/json":
+            self._list_containers(handler, query)
+        elif path == "/containers/create":
+            self._create_container(handler, query)
+        elif path.startswith("/containers/"):
+            self._container_action(handler, method, path)
+        elif path == "/images/load":
+            self._load_image(handler)
+        elif path.startswith("/images/"):
+            self._image_action(handler, method, path, query)
+        elif path == "/networks/create":
+            body = json.loads(handler.read_body() or b"{}")
+            network = {"Id": uuid.uuid4().hex * 2, "Name": body["Name"]}
+            with self.lock:
+                self.networks[network["Name"]] = network
+                self.networks[network["Id"]] = network
+            handler.send_json(201, {"Id": network["Id"]})
+        elif path.startswith("/networks/"):
+            name = path.split("/")[2]
+            network = self.networks.get(name)
+            if network is None:
+                handler.send_json(404, {"message": "network not found"})
+            else:
+                handler.send_json(200, network)
+        else:
+            handler.send_json(404, {"message": f"unknown path {path}"})
+
+    def _list_containers(self, handler: _Handler, query: dict) -> None:
+        filters = json.loads(query.get("filters", "{}"))
+        labels = filters.get("label", [])
+        status = filters.get("status", [])
+        status = [status] if isinstance(status, str) else status
+        show_all = query.get("all") in ("1", "true", "True")
+        with self.lock:
+            containers = list(self.containers.values())
+        result = [
+            self._summary(c)
+            for c in containers
+            if _matches_labels(c["Labels"], labels)
+            and (show_all or c["State"] == "running")
+            and (not status or c["State"] in status)
+        ]
+        handler.send_json(200, result)
+
+    def _create_container(self, handler: _Handler, query: dict) -> None:
+        body = json.loads(handler.read_body() or b"{}")
+        name = query.get("name") or uuid.uuid4().hex[:12]
+        if self._find_container(name) is not None:
+            handler.send_json(409, {"message": f"name {name} is in use"})
+            return
+        if self._find_image(body.get("Image", "")) is None:
+            handler.send_json(404, {"message": "No such image"})
+            return
+        container = {
+            "Id": hashlib.sha256(uuid.uuid4().bytes).hexdigest(),
+            "Name": name,
+            "Image": body.get("Image"),
+            "Labels": body.get("Labels") or {},
+            "State": "created",
+            "Status": "Created",
+            "Created": int(time.time()),
+            "Network": (body.get("HostConfig") or {}).get("NetworkMode"),
+            "HostConfig": body.get("HostConfig") or {},
+        }
+        with self.lock:
+            self.containers[container["Id"]] = container
+        self._emit("create", container)
+        handler.send_json(201, {"Id": container["Id"], "Warnings": []})
+
+    def _container_action(
+        self, handler: _Handler, method: str, path: str
+    ) -> None:
+        parts = path.split("/")
+        container = self._find_container(parts[2])
+        if container is None:
+            handler.read_body()
+            handler.send_json(404, {"message": "No such container"})
+            return
+        action = parts[3] if len(parts) > 3 else ""
+        if method == "DELETE":
+            with self.lock:
+                self.containers.pop(container["Id"], None)
+            self._emit("destroy", container)
+            handler.send_json(204)
+        elif action == "json":
+            handler.send_json(200, self._inspect(container))
+        elif action == "start":
+            handler.read_body()
+            container["State"], container["Status"] = "running", "Up"
+            self._emit("start", container)
+            handler.send_json(204)
+        elif action == "update":
+            body = json.loads(handler.read_body() or b"{}")
+            with self.lock:
+                container["HostConfig"].update(body)
+            handler.send_json(200, {"Warnings": []})
+        elif action == "stop":
+            handler.read_body()
+            if container["State"] == "running":
+                container["State"] = "exited"
+                container["Status"] = "Exited (0) 1 second ago"
+                self._emit("stop", container)
+                self._emit("die", container, exitCode="0")
+            handler.send_json(204)
+        else:
+            handler.read_body()
+            handler.send_json(204)
+
+    def _load_image(self, handler: _Handler) -> None:
+        body = _BodyReader(handler)
+        manifest = None
+        try:
+            # read the archive as it arrives, every layer in full, as the
+            # daemon would
+            with tarfile.open(fileobj=body, mode="r|") as archive:
+                for member in archive:
+                    if not member.isfile():
+                        continue
+                    content = archive.extractfile(member)
+                    if member.name == "manifest.json":
+                        manifest = json.load(content)
+                        continue
+                    while content.read(1 << 20):
+                        pass
+            image_id = f"sha256:{manifest[0]['Config'].split('.')[0]}"
+        except (tarfile.TarError, KeyError, TypeError, ValueError) as e:
+            body.drain()
+            handler.send_json(500, {"message": f"invalid image archive: {e}"})
+            return
+        # tar padding after the end of archive marker
+        body.drain()
+        tags = manifest[0].get("RepoTags") or []
+        with self.lock:
+            self.images[image_id] = {
+                "Id": image_id,
+                "RepoTags": list(tags),
+                "Size": body.size,
+            }
+            for reference in [image_id, *tags]:
+                self.references[reference] = image_id
+        handler.send_json(200, {"stream": f"Loaded image ID: {image_id}\n"})
+
+    def _image_action(
+        self, handler: _Handler, method: str, path: str, query: dict
+    ) -> None:
+        reference = path[len("/images/") :]
+        action = ""
+        for suffix in ("/json", "/tag"):
+            if reference.endswith(suffix):
+                reference, action = reference[: -len(suffix)], suffix[1:]
+        image = self._find_image(reference)
+        if image is None:
+            handler.read_body()
+            handler.send_json(404, {"message": f"No such image: {reference}"})
+            return
+        if method == "DELETE":
+            with self.lock:
+                self.references.pop(reference, None)
+                if reference in image["RepoTags"]:
+                    image["RepoTags"].remove(reference)
+            handler.send_json(200, [{"Untagged": reference}])
+        elif action == "json":
+            handler.send_json(200, image)
+        elif action == "tag":
+            handler.read_body()
+            tag = f"{query['repo']}:{query.get('tag') or 'latest'}"
+            with self.lock:
+                self.references[tag] = image["Id"]
+                image["RepoTags"].append(tag)
+            handler.send_json(201)
+        else:
+            handler.send_json(404, {"message": "unknown image action"})
+
+    def _stream_events(self, handler: _Handler, query: dict) -> None:
+        filters = json.loads(query.get("filters", "{}"))
+        labels = filters.get("label", [])
+        actions = set(filters.get("event", []))
+
+        def wanted(event: dict) -> bool:
+            return _matches_labels(event["Actor"]["Attributes"], labels) and (
+                not actions or event["Action"] in actions
+            )
+
+        subscriber: queue.Queue = queue.Queue()
+        with self.lock:
+            history = list(self.events)
+            self._subscribers.append(subscriber)
+        handler.start_chunked("application/json")
+        try:
+            if "since" in query:
+                since = float(query["since"])
+                for event in history:
+                    if event["timeNano"] / 1e9 >= since and wanted(event):
+                        handler.write_chunk(json.dumps(event).encode() + b"\n")
+            while not self._stopped.is_set():
+                try:
+                    event = subscriber.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if wanted(event):
+                    handler.write_chunk(json.dumps(event).encode() + b"\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with self.lock:
+                self._subscribers.remove(subscriber)
+        handler.close_connection = True
+
+
+def make_component(index: int, hub_id: str, input_size: int = 5) -> dict:
+    return {
+        "id": str(uuid.UUID(int=index)),
+        "name": f"component-{index}",
+        "deployment_active": True,
+        "deployment_status": "Stopped",
+        "deployment_capacity": "small",
+        "deployment_log_level": "20",
+        "deployment_restart_policy": "Always",
+        "deployment_updated_at": now_iso(),
+        "compute_node": None,
+        "input": [
+            {"name": f"param_{i}", "type": "str", "value": "x" * 32}
+            for i in range(input_size)
+        ],
+        "hub_component": {
+            "id": hub_id,
+            "name": f"hub-{hub_id[:8]}",
+            "version": "1.0.0",
+        },
+    }
+
+
+def make_server(index: int, hub_id: str) -> dict:
+    return {
+        "id": str(uuid.UUID(int=(1 << 64) + index)),
+        "name": f"server-{index}",
+        "deployment_active": True,
+        "deployment_status": "Stopped",
+        "deployment_capacity": "small",
+        "deployment_log_level": "20",
+        "deployment_restart_policy": "Always",
+        "deployment_updated_at": now_iso(),
+        "compute_node": None,
+        "config": [],
+        "ports": [
+            {
+                "name": "http",
+                "protocol": "tcp",
+                "internal_port": 8000,
+                "exposed_port": 20000 + index,
+            }
+        ],
+        "env_vars": [{"name": "MODE", "value": "benchmark"}],
+        "hub_server": {
+            "id": hub_id,
+            "name": f"hub-{hub_id[:8]}",
+            "version": "1.0.0",
+        },
+    }
+
+
+def now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def parse_iso(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+class FakeSplightAPI:
+    """
+    Splight platform API for a single compute node. Image downloads can be
+    throttled and dropped mid-transfer.
+    """
+
+    RESOURCES = {"components": "component", "servers": "server"}
+
+    def __init__(
+        self,
+        node_id: str,
+        faults: Optional[Faults] = None,
+        bytes_per_second: Optional[float] = None,
+        drop_rate: float = 0.0,
+        seed: int = 0,
+    ) -> None:
+        self.node_id = node_id
+        self.faults = faults or Faults()
+        self.bytes_per_second = bytes_per_second
+        self.drop_rate = drop_rate
+        self._random = random.Random(seed)
+        self.calls: Counter = Counter()
+        self.lock = threading.Lock()
+        self.instances: dict[str, dict[str, dict]] = {
+            "components": {},
+            "servers": {},
+        }
+        self.statuses: dict[str, str] = {}
+        self.images: dict[str, bytes] = {}
+        self.generation = 0
+        self.downloaded_bytes = 0
+        self.drops = 0
+        self._changed = threading.Condition(self.lock)
+        self._stopped = threading.Event()
+        self._server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), self._make_handler()
+        )
+        self._server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def start(self) -> "FakeSplightAPI":
+        threading.Thread(
+            target=self._server.serve_forever, daemon=True
+        ).start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        with self._changed:
+            self._changed.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_image(self, hub_id: str, data: bytes) -> None:
+        self.images[hub_id] = data
+
+    def add(self, resource: str, instance: dict) -> None:
+        with self._changed:
+            self.instances[resource][instance["id"]] = instance
+            self.statuses[instance["id"]] = instance["deployment_status"]
+            self.generation += 1
+            self._changed.notify_all()
+
+    def update(self, resource: str, instance_id: str, **changes) -> None:
+        """
+        Change an instance as a user would in the platform
+        """
+        with self._changed:
+            instance = self.instances[resource][instance_id]
+            instance.update(changes, deployment_updated_at=now_iso())
+            self.generation += 1
+            self._changed.notify_all()
+
+    def count_status(self, status: str) -> int:
+        with self.lock:
+            return sum(1 for s in self.statuses.values() if s == status)
+
+    def _set_status(self, instance_id: str, status: str) -> None:
+        with self.lock:
+            self.statuses[instance_id] = status
+            for instances in self.instances.values():
+                if instance_id in instances:
+                    instances[instance_id]["deployment_status"] = status
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(_Handler):
+            def _route(self, method: str) -> None:
+                url = urlparse(self.path)
+                query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                route = re.sub(
+                    r"/[0-9a-f]{8}-[0-9a-f-]{27,}", "/{id}", url.path
+                )
+                api.calls[f"{method} {route}"] += 1
+                api.faults.delay()
+                if api.faults.should_fail():
+                    self.read_body()
+                    self.send_json(503, {"detail": "injected fault"})
+                    return
+                try:
+                    api._handle(self, method, url.path, query)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def do_GET(self):
+                self._route("GET")
+
+            def do_POST(self):
+                self._route("POST")
+
+            def do_PATCH(self):
+                self._route("PATCH")
+
+        return Handler
+
+    def _handle(self, handler: _Handler, method: str, path: str, query: dict):
+        node_prefix = (
+            f"/{API_VERSION}/engine/compute/nodes/all/{self.node_id}/"
+        )
+        if path.startswith("/images/"):
+            self._serve_image(handler, path.split("/")[2])
+        elif path.startswith(node_prefix):
+            resource = path[len(node_prefix) :].strip("/")
+            if resource in self.RESOURCES:
+                self._list(handler, resource, query)
+            elif resource == "deployments/stream":
+                self._stream_deployments(handler)
+            else:
+                handler.read_body()
+                handler.send_json(201, {})
+        elif "/download_url/" in path:
+            hub_id = path.split("/")[-3]
+            handler.send_json(200, {"url": f"{self.url}/images/{hub_id}"})
+        elif path.endswith("/bulk-update-status/"):
+            for item in json.loads(handler.read_body()):
+                self._set_status(item["id"], item["deployment_status"])
+            handler.send_json(200, {})
+        elif path.endswith("/update-status/"):
+            body = json.loads(handler.read_body())
+            self._set_status(path.split("/")[-3], body["deployment_status"])
+            handler.send_json(200, {})
+        else:
+            self._retrieve(handler, path)
+
+    def _list(self, handler: _Handler, resource: str, query: dict) -> None:
+        with self.lock:
+            items = list(self.instances[resource].values())
+            etag = f'"{resource}-{self.generation}"'
+        since = query.get("deployment_updated_at__gte")
+        if since is not None:
+            since = parse_iso(since)
+            items = [
+                i
+                for i in items
+                if parse_iso(i["deployment_updated_at"]) >= since
+            ]
+        elif handler.headers.get("If-None-Match") == etag:
+            handler.send_json(304, headers={"ETag": etag})
+            return
+        handler.send_json(200, items, headers={"ETag": etag})
+
+    def _retrieve(self, handler: _Handler, path: str) -> None:
+        instance_id = path.rstrip("/").split("/")[-1]
+        with self.lock:
+            for instances in self.instances.values():
+                if instance_id in instances:
+                    handler.send_json(200, instances[instance_id])
+                    return
+        handler.send_json(404, {"detail": "not found"})
+
+    def _stream_deployments(self, handler: _Handler) -> None:
+        handler.start_chunked("text/event-stream")
+        with self._changed:
+            generation = self.generation
+        handler.write_chunk(b"event: ping\ndata: {}\n\n")
+        while not self._stopped.is_set():
+            with self._changed:
+                self._changed.wait(timeout=5)
+                changed = self.generation != generation
+                generation = self.generation
+            if changed:
+                data = json.dumps({"generation": generation}).encode()
+                handler.write_chunk(b"event: change\ndata: " + data + b"\n\n")
+            else:
+                handler.write_chunk(b"event: ping\ndata: {}\n\n")
+        handler.close_connection = True
+
+    def _serve_image(self, handler: _Handler, hub_id: str) -> None:
+        data = self.images.get(hub_id)
+        if data is None:
+            handler.send_json(404, {"detail": "no image"})
+            return
+        start, end = 0, len(data) - 1
+        match = re.match(
+            r"bytes=(\d+)-(\d*)", handler.headers.get("Range", "")
+        )
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+            handler.send_response(206)
+            handler.send_header(
+                "Content-Range", f"bytes {start}-{end}/{len(data)}"
+            )
+        else:
+            handler.send_response(200)
+        handler.send_header("Content-Type", "application/octet-stream")
+        handler.send_header("Content-Length", str(end - start + 1))
+        handler.send_header("Accept-Ranges", "bytes")
+        handler.end_headers()
+        # drop the connection halfway through some transfers
+        drop_at = None
+        if end - start > 1 and self._random.random() < self.drop_rate:
+            drop_at = start + (end - start) // 2
+        offset, chunk_size = start, 64 * 1024
+        began = time.monotonic()
+        while offset <= end:
+            if drop_at is not None and offset >= drop_at:
+                with self.lock:
+                    self.drops += 1
+                handler.close_connection = True
+                handler.connection.shutdown(2)
+                return
+            chunk = data[offset : min(offset + chunk_size, end + 1)]
+            handler.wfile.write(chunk)
+            offset += len(chunk)
+            with self.lock:
+                self.downloaded_bytes += len(chunk)
+            if self.bytes_per_second:
+                expected = (offset - start) / self.bytes_per_second
+                sleep = expected - (time.monotonic() - began)
+                if sleep > 0:
+                    time.sleep(sleep)
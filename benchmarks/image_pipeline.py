@@ -0,0 +1,276 @@
+"""
+Benchmark of the image pipeline: getting the image of a hub instance from
+its download URL into the Docker daemon.
+
+The image is a synthetic `docker save` tarball of configurable size and
+layer count, served by the fake Splight API with per connection bandwidth
+limits and connections dropped halfway through a transfer. The Docker side
+is the fake daemon, which reads every byte of the archive it is sent.
+
+Every strategy runs `Engine._pull_image` in its own process, retrying
+failed attempts as the dispatcher would, and reports the throughput, the
+bytes sent by the server (re-downloads included), the peak disk use of
+the image directory and the peak RSS. Strategies are the download to disk
+followed by docker load, with one or more ranged segments, and the
+streamed load.
+
+Usage:
+    PYTHONPATH=src python benchmarks/image_pipeline.py
+    PYTHONPATH=src python benchmarks/image_pipeline.py --size 256 \\
+        --layers 8 --bandwidth 20 --drop-rate 0.2 --segments 1 4 8
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import psutil
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import (  # noqa: E402
+    FakeDocker,
+    FakeSplightAPI,
+    Faults,
+    make_image_tarball,
+)
+
+MB = 2**20
+
+
+def disk_usage(directory: str) -> int:
+    """
+    Bytes allocated by the files under directory, partial downloads are
+    sparse so their apparent size is not used
+    """
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                total += os.stat(os.path.join(root, name)).st_blocks * 512
+            except FileNotFoundError:
+                pass
+    return total
+
+
+class PeakMonitor:
+    """
+    Samples the disk use of a directory and the RSS of this process
+    """
+
+    def __init__(self, directory: str, interval: float = 0.01) -> None:
+        self._directory = directory
+        self._interval = interval
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self.peak_disk = 0
+        self.peak_rss = 0
+
+    def _sample_forever(self) -> None:
+        while not self._stop.is_set():
+            self.peak_disk = max(self.peak_disk, disk_usage(self._directory))
+            self.peak_rss = max(self.peak_rss, self._process.memory_info().rss)
+            self._stop.wait(self._interval)
+
+    def __enter__(self) -> "PeakMonitor":
+        self._thread = threading.Thread(
+            target=self._sample_forever, daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def run_child(config: dict) -> dict:
+    workdir = tempfile.mkdtemp(prefix="splight-bench-")
+    image_directory = os.path.join(workdir, "images")
+    # the agent reads its settings from the environment when imported
+    os.environ.update(
+        {
+            "HOME": workdir,
+            "DOCKER_HOST": config["docker_host"],
+            "SPLIGHT_PLATFORM_API_HOST": config["api_url"],
+            "COMPUTE_NODE_ID": config["node_id"],
+            "API_VERSION": "v3",
+            "DOWNLOAD_SEGMENTS": str(config["segments"]),
+            "LOG_LEVEL": "40",
+            "SPLIGHT_COMPONENT_LOG_FILE": os.path.join(workdir, "agent.log"),
+        }
+    )
+    from splight_agent import models
+    from splight_agent.engine import Engine, ImageError
+    from splight_agent.models import ComputeNode, HubComponent
+
+    # images are written to a fixed path in production
+    models.IMAGE_DIRECTORY = image_directory
+    os.makedirs(image_directory)
+    engine = Engine(
+        compute_node=ComputeNode(id=config["node_id"]),
+        workspace_name="benchmark",
+        ecr_repository="benchmark",
+        componenent_environment={},
+        stream_images=config["stream"],
+        stream_chunk_size=config["chunk_size"],
+    )
+    baseline_rss = psutil.Process().memory_info().rss
+
+    runs = []
+    with PeakMonitor(image_directory) as monitor:
+        for run in range(config["runs"]):
+            hub_component = HubComponent(
+                id=config["hub_id"], name=f"bench-{run}", version="1.0.0"
+            )
+            attempts = 0
+            loaded = False
+            start = time.perf_counter()
+            while not loaded and attempts < config["max_attempts"]:
+                attempts += 1
+                try:
+                    engine._pull_image(hub_component)
+                    loaded = True
+                except ImageError:
+                    pass
+            runs.append(
+                {
+                    "seconds": time.perf_counter() - start,
+                    "attempts": attempts,
+                    "loaded": loaded,
+                }
+            )
+    return {
+        "runs": runs,
+        "baseline_rss": baseline_rss,
+        # sampled, since ru_maxrss keeps the peak of the parent across exec
+        "peak_rss": monitor.peak_rss,
+        "peak_disk": monitor.peak_disk,
+    }
+
+
+def summarize(name: str, child: dict, image_size: int, sent: int) -> dict:
+    runs = child["runs"]
+    loaded = [run for run in runs if run["loaded"]]
+    seconds = statistics.median(run["seconds"] for run in loaded or runs)
+    return {
+        "strategy": name,
+        "runs": len(runs),
+        "loaded": len(loaded),
+        "median_seconds": seconds,
+        "throughput_mb_s": image_size / MB / seconds if loaded else 0.0,
+        "attempts": sum(run["attempts"] for run in runs) / len(runs),
+        "sent_mb": sent / MB / len(runs),
+        "peak_disk_mb": child["peak_disk"] / MB,
+        "baseline_rss_mb": child["baseline_rss"] / MB,
+        "peak_rss_mb": child["peak_rss"] / MB,
+    }
+
+
+def print_table(image_size: int, results: list[dict]) -> None:
+    print(f"image of {image_size / MB:.1f}MB")
+    print(
+        f"{'strategy':>12} {'loaded':>7} {'median s':>9} {'MB/s':>7} "
+        f"{'tries':>6} {'sent MB':>8} {'disk MB':>8} {'rss MB':>13}"
+    )
+    for result in results:
+        rss = f"{result['baseline_rss_mb']:.0f}->{result['peak_rss_mb']:.0f}"
+        print(
+            f"{result['strategy']:>12} "
+            f"{result['loaded']:>3}/{result['runs']:<3} "
+            f"{result['median_seconds']:>9.2f} "
+            f"{result['throughput_mb_s']:>7.1f} "
+            f"{result['attempts']:>6.1f} {result['sent_mb']:>8.1f} "
+            f"{result['peak_disk_mb']:>8.1f} {rss:>13}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--size", type=float, default=64, help="MB")
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument(
+        "--bandwidth", type=float, default=0, help="MB/s per connection"
+    )
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--segments", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--no-stream", action="store_true")
+    parser.add_argument("--chunk-size", type=int, default=1 << 20)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--max-attempts", type=int, default=5)
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(run_child(json.loads(args.child))))
+        return
+
+    # both fakes live in this process so they do not count in the RSS of
+    # the pipeline
+    workdir = tempfile.mkdtemp(prefix="splight-bench-")
+    node_id = str(uuid.uuid4())
+    hub_id = str(uuid.uuid4())
+    image = make_image_tarball(
+        "bench", int(args.size * MB), layers=args.layers
+    )
+    docker = FakeDocker(os.path.join(workdir, "docker.sock")).start()
+    api = FakeSplightAPI(
+        node_id,
+        faults=Faults(latency=args.latency),
+        bytes_per_second=args.bandwidth * MB or None,
+        drop_rate=args.drop_rate,
+        seed=1,
+    ).start()
+    api.add_image(hub_id, image)
+
+    strategies = [
+        (f"download x{segments}", {"stream": False, "segments": segments})
+        for segments in args.segments
+    ]
+    if not args.no_stream:
+        strategies.append(("stream", {"stream": True, "segments": 1}))
+
+    results = []
+    for name, strategy in strategies:
+        config = {
+            **strategy,
+            "docker_host": f"unix://{docker.socket_path}",
+            "api_url": api.url,
+            "node_id": node_id,
+            "hub_id": hub_id,
+            "chunk_size": args.chunk_size,
+            "runs": args.runs,
+            "max_attempts": args.max_attempts,
+        }
+        sent = api.downloaded_bytes
+        output = subprocess.run(
+            [sys.executable, __file__, "--child", json.dumps(config)],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        child = json.loads(output.strip().splitlines()[-1])
+        results.append(
+            summarize(name, child, len(image), api.downloaded_bytes - sent)
+        )
+    docker.stop()
+    api.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(len(image), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Microbenchmark of the desired state parsing done on every dispatcher cycle.
+
+Compares building full pydantic models for every item with the
+DesiredStateTable fast path, for unchanged payloads, and reports the memory
+retained between cycles.
+
+Usage:
+    PYTHONPATH=src python benchmarks/parse_desired_state.py
+"""
+import argparse
+import copy
+import gc
+import time
+import tracemalloc
+
+import psutil
+
+from splight_agent.models import Component, DesiredStateTable
+
+
+def make_component(index: int, input_size: int) -> dict:
+    return {
+        "id": f"00000000-0000-0000-0000-{index:012d}",
+        "name": f"component-{index}",
+        "deployment_active": True,
+        "deployment_status": "Running",
+        "deployment_capacity": "small",
+        "deployment_log_level": "20",
+        "deployment_restart_policy": "Always",
+        "deployment_updated_at": "2024-01-01T00:00:00Z",
+        "compute_node": "node",
+        "input": [
+            {
+                "name": f"param_{i}",
+                "type": "str",
+                "value": "x" * 64,
+                "multiple": False,
+                "required": True,
+            }
+            for i in range(input_size)
+        ],
+        "hub_component": {
+            "id": "hub",
+            "name": "hub-component",
+            "version": "1.0.0",
+        },
+    }
+
+
+def measure(func, payload: list[dict], repeat: int) -> float:
+    # every run gets its own copy, as a new API response would
+    copies = [copy.deepcopy(payload) for _ in range(repeat)]
+    start = time.perf_counter()
+    for items in copies:
+        func(items)
+    return (time.perf_counter() - start) / repeat
+
+
+def retained_bytes(build, payload: list[dict]) -> int:
+    items = copy.deepcopy(payload)
+    gc.collect()
+    tracemalloc.start()
+    retained = build(items)
+    del items
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del retained
+    return size
+
+
+def full_parse(items: list[dict]) -> list[Component]:
+    return [Component(**item) for item in items]
+
+
+def compact_parse(items: list[dict]) -> DesiredStateTable:
+    table = DesiredStateTable()
+    records = table.parse(items, Component)
+    for record in records:
+        record.release()
+    table.replace(records)
+    return table
+
+
+def run(count: int, input_size: int, repeat: int) -> dict:
+    payload = [make_component(i, input_size) for i in range(count)]
+    table = compact_parse(copy.deepcopy(payload))
+
+    def fast_parse(items: list[dict]) -> None:
+        records = table.parse(items, Component)
+        table.replace(records)
+        for record in records:
+            record.release()
+
+    return {
+        "count": count,
+        "full_ms": measure(full_parse, payload, repeat) * 1e3,
+        "fast_ms": measure(fast_parse, payload, repeat) * 1e3,
+        "full_kb": retained_bytes(full_parse, payload) / 1024,
+        "fast_kb": retained_bytes(compact_parse, payload) / 1024,
+        "rss_mb": psutil.Process().memory_info().rss / 2**20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10, 100, 1000]
+    )
+    parser.add_argument("--input-size", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(
+        f"{'instances':>10} {'full parse':>12} {'fast path':>12} "
+        f"{'full retained':>14} {'compact retained':>17} {'rss':>9}"
+    )
+    for count in args.sizes:
+        result = run(count, args.input_size, args.repeat)
+        print(
+            f"{result['count']:>10} {result['full_ms']:>10.2f}ms "
+            f"{result['fast_ms']:>10.2f}ms {result['full_kb']:>12.1f}kB "
+            f"{result['fast_kb']:>15.1f}kB {result['rss_mb']:>7.1f}MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""
+Benchmark of the reconcile loop at 10, 100 and 1,000 instances.
+
+Runs the real Orchestrator stack (dispatcher, engine and exporter) against
+an in-process fake Docker daemon on a unix socket and a fake Splight API,
+and reports per phase the wall time, API and Docker calls, CPU time and
+RSS. Phases are the first deployment of every instance, idle cycles and a
+cycle after changing a fraction of the instances. Latency and faults can
+be injected in both fakes.
+
+Each size runs in its own process so memory numbers do not mix. CPU time
+and RSS are those of that process, fakes included.
+
+Usage:
+    PYTHONPATH=src python benchmarks/reconcile_loop.py
+    PYTHONPATH=src python benchmarks/reconcile_loop.py --sizes 100 \\
+        --api-latency 0.02 --api-error-rate 0.01 --workers 4
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+
+import psutil
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import (  # noqa: E402
+    FakeDocker,
+    FakeSplightAPI,
+    Faults,
+    make_component,
+    make_image_tarball,
+    make_server,
+)
+
+
+def wait_until(condition, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class Probe:
+    """
+    Measures wall time, calls to both fakes, CPU time and RSS of a phase
+    """
+
+    def __init__(self, api: FakeSplightAPI, docker: FakeDocker) -> None:
+        self._api = api
+        self._docker = docker
+        self._process = psutil.Process()
+
+    def __enter__(self) -> "Probe":
+        cpu = self._process.cpu_times()
+        self._cpu = cpu.user + cpu.system
+        self._api_calls = self._api.total_calls
+        self._docker_calls = self._docker.total_calls
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        cpu = self._process.cpu_times()
+        self.result = {
+            "seconds": time.perf_counter() - self._start,
+            "api_calls": self._api.total_calls - self._api_calls,
+            "docker_calls": self._docker.total_calls - self._docker_calls,
+            "cpu_seconds": cpu.user + cpu.system - self._cpu,
+            "rss_mb": self._process.memory_info().rss / 2**20,
+        }
+
+
+def run_child(args: argparse.Namespace) -> dict:
+    workdir = tempfile.mkdtemp(prefix="splight-bench-")
+    node_id = str(uuid.uuid4())
+    docker = FakeDocker(
+        os.path.join(workdir, "docker.sock"),
+        faults=Faults(args.docker_latency, args.docker_error_rate, seed=1),
+    ).start()
+    api = FakeSplightAPI(
+        node_id, faults=Faults(args.api_latency, args.api_error_rate, seed=2)
+    ).start()
+
+    hub_ids = [str(uuid.uuid4()) for _ in range(args.hubs)]
+    for index, hub_id in enumerate(hub_ids):
+        api.add_image(
+            hub_id,
+            make_image_tarball(f"hub-{index}", args.image_size, seed=index),
+        )
+    servers = int(args.size * args.server_ratio)
+    for index in range(args.size - servers):
+        api.add(
+            "components",
+            make_component(index, hub_ids[index % len(hub_ids)]),
+        )
+    for index in range(servers):
+        api.add("servers", make_server(index, hub_ids[index % len(hub_ids)]))
+
+    # the agent reads its settings from the environment when imported
+    os.environ.update(
+        {
+            "HOME": workdir,
+            "DOCKER_HOST": f"unix://{docker.socket_path}",
+            "SPLIGHT_PLATFORM_API_HOST": api.url,
+            "COMPUTE_NODE_ID": node_id,
+            "API_VERSION": "v3",
+            "IMAGE_STREAMING": "true",
+            "DISPATCHER_MAX_WORKERS": str(args.workers),
+            "ENGINE_MAX_CONTAINER_OPERATIONS": str(max(args.workers, 4)),
+            "INCREMENTAL_FETCH": str(args.incremental).lower(),
+            "EXPORTER_BULK_UPDATE": str(args.bulk_update).lower(),
+            "HTTP_BACKOFF_FACTOR": "0.01",
+            "LOG_LEVEL": "40",
+            "SPLIGHT_COMPONENT_LOG_FILE": os.path.join(workdir, "agent.log"),
+        }
+    )
+    from splight_agent.orchestrator import Orchestrator
+
+    orchestrator = Orchestrator()
+    dispatcher = orchestrator._dispatcher
+    orchestrator._exporter.start()
+
+    def idle() -> bool:
+        with dispatcher._in_flight_lock:
+            return not dispatcher._in_flight
+
+    def all_running() -> bool:
+        return api.count_status("Running") >= args.size
+
+    results = {"size": args.size}
+    with Probe(api, docker) as probe:
+        dispatcher._run_cycle()
+        wait_until(idle, args.timeout)
+    results["deploy"] = probe.result
+    last_cycle = time.monotonic()
+
+    def converged_or_retry() -> bool:
+        # actions failed by injected faults are retried on the next cycles
+        nonlocal last_cycle
+        if all_running():
+            return True
+        if time.monotonic() - last_cycle > 1.0 and idle():
+            dispatcher._run_cycle()
+            last_cycle = time.monotonic()
+        return False
+
+    with Probe(api, docker) as probe:
+        converged = wait_until(converged_or_retry, args.timeout)
+    results["deploy"]["converge_seconds"] = (
+        results["deploy"]["seconds"] + probe.result["seconds"]
+    )
+    results["deploy"]["converged"] = converged
+    with api.lock:
+        results["deploy"]["statuses"] = dict(Counter(api.statuses.values()))
+
+    idle_results = []
+    for _ in range(args.cycles):
+        with Probe(api, docker) as probe:
+            dispatcher._run_cycle()
+        idle_results.append(probe.result)
+    results["idle"] = {
+        key: sum(r[key] for r in idle_results) / len(idle_results)
+        for key in idle_results[0]
+    }
+
+    changed = max(int(args.size * args.change_ratio), 1)
+    component_ids = list(api.instances["components"])[:changed]
+    for index, instance_id in enumerate(component_ids):
+        api.update(
+            "components",
+            instance_id,
+            input=[{"name": "param_0", "type": "str", "value": f"v{index}"}],
+        )
+    with Probe(api, docker) as probe:
+        dispatcher._run_cycle()
+        wait_until(idle, args.timeout)
+    results["change"] = {**probe.result, "instances": len(component_ids)}
+
+    results["api_errors"] = api.faults.errors
+    results["docker_errors"] = docker.faults.errors
+    # ru_maxrss is in kilobytes on Linux
+    results["peak_rss_mb"] = (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    )
+    orchestrator._exporter.stop()
+    docker.stop()
+    api.stop()
+    return results
+
+
+def print_table(results: list[dict]) -> None:
+    print(
+        f"{'instances':>9} {'phase':>7} {'wall s':>8} {'api':>6} "
+        f"{'docker':>7} {'cpu s':>7} {'rss MB':>7}"
+    )
+    for result in results:
+        for phase in ("deploy", "idle", "change"):
+            row = result[phase]
+            print(
+                f"{result['size']:>9} {phase:>7} {row['seconds']:>8.3f} "
+                f"{row['api_calls']:>6.0f} {row['docker_calls']:>7.0f} "
+                f"{row['cpu_seconds']:>7.3f} {row['rss_mb']:>7.1f}"
+            )
+        deploy = result["deploy"]
+        print(
+            f"{'':>9} all running after {deploy['converge_seconds']:.2f}s"
+            f"{'' if deploy['converged'] else ' (timed out)'}, "
+            f"statuses {deploy['statuses']}, "
+            f"peak rss {result['peak_rss_mb']:.1f}MB, injected errors "
+            f"api={result['api_errors']} docker={result['docker_errors']}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10, 100, 1000]
+    )
+    parser.add_argument("--server-ratio", type=float, default=0.2)
+    parser.add_argument("--hubs", type=int, default=5)
+    parser.add_argument("--image-size", type=int, default=64 * 1024)
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--change-ratio", type=float, default=0.1)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--bulk-update", action="store_true")
+    parser.add_argument("--api-latency", type=float, default=0.0)
+    parser.add_argument("--api-error-rate", type=float, default=0.0)
+    parser.add_argument("--docker-latency", type=float, default=0.0)
+    parser.add_argument("--docker-error-rate", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.size is not None:
+        print(json.dumps(run_child(args)))
+        return
+
+    results = []
+    for size in args.sizes:
+        command = [
+            sys.executable,
+            __file__,
+            *sys.argv[1:],
+            "--size",
+            str(size),
+        ]
+        output = subprocess.run(
+            command, check=True, capture_output=True, text=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -120,10 +120,12 @@ while IFS=: read -r key value; do
 done < $CONFIG_FILE
 docker run \
       --privileged \
+      --cgroupns host \
       -id \
       --name $CONTAINER \
       -v $SPLIGHT_HOME:/root/.splight \
       -v /var/run/docker.sock:/var/run/docker.sock \
+      -v /sys/fs/cgroup:/host/sys/fs/cgroup:ro \
       -e LOG_LEVEL=$LOG_LEVEL \
       -e COMPUTE_NODE_ID=$COMPUTE_NODE_ID \
       -e SPLIGHT_ACCESS_ID=$SPLIGHT_ACCESS_ID \
@@ -131,6 +133,7 @@ docker run \
       -e SPLIGHT_SECRET_KEY=$SPLIGHT_SECRET_KEY \
       -e PROCESS_TYPE=agent \
       -e REPORT_USAGE=$REPORT_USAGE \
+      -e CGROUP_ROOT=/host/sys/fs/cgroup \
       --log-driver json-file \
       --log-opt max-size=10m \
       --log-opt max-file=3 \
@@ -0,0 +1,96 @@
+import asyncio
+import json
+import os
+from typing import AsyncIterator, Optional
+from urllib.parse import urlencode
+
+DEFAULT_DOCKER_SOCKET = "/var/run/docker.sock"
+
+
+class DockerAPIError(Exception):
+    pass
+
+
+class AsyncDockerClient:
+    """
+    Minimal asyncio client for the Docker Engine API over its unix socket.
+    Only the streaming endpoints used by the agent are implemented.
+    """
+
+    def __init__(self, socket_path: Optional[str] = None) -> None:
+        if socket_path is None:
+            docker_host = os.getenv("DOCKER_HOST", "")
+            socket_path = (
+                docker_host.removeprefix("unix://")
+                if docker_host.startswith("unix://")
+                else DEFAULT_DOCKER_SOCKET
+            )
+        self._socket_path = socket_path
+
+    async def _open_stream(
+        self, path: str, params: dict
+    ) -> tuple[asyncio.StreamReader, asyncio.StreamWriter, dict[str, str]]:
+        reader, writer = await asyncio.open_unix_connection(self._socket_path)
+        query = urlencode(params)
+        writer.write(
+            (
+                f"GET {path}?{query} HTTP/1.1\r\n"
+                "Host: docker\r\n"
+                "Accept: application/json\r\n"
+                "\r\n"
+            ).encode("latin-1")
+        )
+        await writer.drain()
+        status_line = await reader.readline()
+        parts = status_line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while line := (await reader.readline()).strip():
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+        if len(parts) < 2 or parts[1] != "200":
+            writer.close()
+            raise DockerAPIError(
+                f"Docker API returned {status_line.decode().strip()}"
+            )
+        return reader, writer, headers
+
+    @staticmethod
+    async def _iter_body(
+        reader: asyncio.StreamReader, chunked: bool
+    ) -> AsyncIterator[bytes]:
+        if not chunked:
+            while data := await reader.read(65536):
+                yield data
+            return
+        while True:
+            size_line = await reader.readline()
+            if not size_line:
+                return
+            size = int(size_line.split(b";")[0].strip() or b"0", 16)
+            if size == 0:
+                return
+            data = await reader.readexactly(size)
+            await reader.readexactly(2)  # chunk trailing CRLF
+            yield data
+
+    async def events(
+        self, filters: dict, since: Optional[float] = None
+    ) -> AsyncIterator[dict]:
+        """
+        Yields decoded Docker events until the stream is closed
+        """
+        params = {"filters": json.dumps(filters)}
+        if since is not None:
+            params["since"] = str(since)
+        reader, writer, headers = await self._open_stream("/events", params)
+        chunked = headers.get("transfer-encoding", "") == "chunked"
+        buffer = b""
+        try:
+            async for data in self._iter_body(reader, chunked):
+                buffer += data
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    if line.strip():
+                        yield json.loads(line)
+        finally:
+            writer.close()
@@ -1,9 +1,13 @@
+import asyncio
 import time
 from threading import Event, Thread
+from typing import Optional
 
 from splight_agent.logging import SplightLogger
+from splight_agent.metrics import BEACON_LAST_PING_SUCCESS, BEACON_PINGS
 from splight_agent.models import ComputeNode
-from splight_agent.rest_client import RestClient
+from splight_agent.rest_client import get_rest_client
+from splight_agent.scheduler import PollScheduler
 
 logger = SplightLogger(__name__)
 
@@ -13,13 +17,33 @@ class Beacon:
     The beacon periodically pings the API to signal that the agent is still alive
     """
 
+    # the platform marks the node offline without pings, so the backoff is
+    # kept within this many ping intervals
+    MAX_BACKOFF_INTERVALS = 2
+
     def __init__(
-        self, compute_node: ComputeNode, ping_interval: int, api_version: str
+        self,
+        compute_node: ComputeNode,
+        ping_interval: int,
+        api_version: str,
+        max_ping_interval: Optional[int] = None,
+        jitter: float = 0.1,
     ) -> None:
-        self._ping_interval = ping_interval
+        # pings back off while they fail, so an API outage is not made
+        # worse by the whole fleet
+        max_interval = min(
+            max_ping_interval or ping_interval,
+            ping_interval * self.MAX_BACKOFF_INTERVALS,
+        )
+        self._scheduler = PollScheduler(
+            min_interval=ping_interval,
+            max_interval=max_interval,
+            jitter=jitter,
+            seed=compute_node.id,
+        )
         self._thread = Thread(target=self._ping_forever, daemon=True)
         self._stop = Event()
-        self._client = RestClient()
+        self._client = get_rest_client()
         self._compute_node = compute_node
         self._base_url = f"{api_version}/engine/compute/nodes/all"
 
@@ -29,17 +53,39 @@ class Beacon:
             {},
         )
 
+    def _beat(self) -> float:
+        """
+        Ping the API and return how long it took
+        """
+        start = time.monotonic()
+        try:
+            self._ping()
+            logger.debug("API ping successful")
+            self._scheduler.reset()
+            BEACON_PINGS.inc(result="success")
+            BEACON_LAST_PING_SUCCESS.set(1)
+        except Exception as e:
+            logger.warning(f"Could not ping API: {e}")
+            self._scheduler.back_off()
+            BEACON_PINGS.inc(result="failure")
+            BEACON_LAST_PING_SUCCESS.set(0)
+        return time.monotonic() - start
+
     def _ping_forever(self):
         while True:
             if self._stop.is_set():
                 break
-            try:
-                self._ping()
-                logger.debug("API ping successful")
-            except Exception as e:
-                logger.warning(f"Could not ping API: {e}")
-            finally:
-                time.sleep(self._ping_interval)
+            elapsed = self._beat()
+            self._stop.wait(self._scheduler.next_delay(elapsed))
+
+    async def run_async(self):
+        """
+        Ping the API forever as an asyncio task, until it is cancelled
+        """
+        logger.info("Beacon started")
+        while True:
+            elapsed = await asyncio.to_thread(self._beat)
+            await asyncio.sleep(self._scheduler.next_delay(elapsed))
 
     def start(self):
         logger.info("Beacon started")
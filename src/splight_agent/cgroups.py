@@ -0,0 +1,181 @@
+import os
+import time
+from typing import Optional
+
+from docker import DockerClient
+
+from splight_agent.logging import SplightLogger
+from splight_agent.models import ContainerUsage, get_instance_from_labels
+
+logger = SplightLogger(__name__)
+
+# cgroup of a container relative to the cgroup root, for the systemd and
+# cgroupfs drivers
+CGROUP_PATH_TEMPLATES = ("system.slice/docker-{id}.scope", "docker/{id}")
+
+
+def read_value(path: str) -> Optional[int]:
+    """
+    Reads a single value cgroup file, None if it is missing or "max"
+    """
+    try:
+        with open(path) as fid:
+            value = fid.read().strip()
+    except OSError:
+        return None
+    return int(value) if value.isdigit() else None
+
+
+def read_flat_keyed(path: str) -> dict[str, int]:
+    """
+    Reads a cgroup file with a "key value" pair per line, like cpu.stat
+    """
+    values = {}
+    try:
+        with open(path) as fid:
+            for line in fid:
+                key, _, value = line.partition(" ")
+                if value.strip().isdigit():
+                    values[key] = int(value)
+    except OSError:
+        pass
+    return values
+
+
+def read_io_stat(path: str) -> dict[str, int]:
+    """
+    Sums the io.stat counters of every device
+    """
+    totals: dict[str, int] = {}
+    try:
+        with open(path) as fid:
+            for line in fid:
+                # 8:0 rbytes=1 wbytes=2 rios=3 wios=4 dbytes=0 dios=0
+                for item in line.split()[1:]:
+                    key, _, value = item.partition("=")
+                    if value.isdigit():
+                        totals[key] = totals.get(key, 0) + int(value)
+    except OSError:
+        pass
+    return totals
+
+
+class ContainerMetricsCollector:
+    """
+    Collects CPU, memory, IO and PID metrics of the agent containers
+    straight from the cgroup v2 filesystem. A single container listing is
+    made per collection instead of one Docker stats call per container.
+    """
+
+    def __init__(
+        self,
+        client: DockerClient,
+        agent_id: str,
+        cgroup_root: str = "/sys/fs/cgroup",
+    ) -> None:
+        self._client = client
+        self._agent_id = agent_id
+        self._cgroup_root = cgroup_root
+        self._paths: dict[str, str] = {}
+        # container id -> (time, cpu usage in microseconds)
+        self._last_cpu: dict[str, tuple[float, int]] = {}
+        # running containers whose cgroup was not found, warned once
+        self._missing: set[str] = set()
+        self.enabled = os.path.exists(
+            os.path.join(cgroup_root, "cgroup.controllers")
+        )
+        if not self.enabled:
+            logger.info(
+                f"No cgroup v2 hierarchy at {cgroup_root}, container metrics are disabled"
+            )
+
+    def _get_cgroup_path(self, container_id: str) -> Optional[str]:
+        if container_id in self._paths:
+            return self._paths[container_id]
+        for template in CGROUP_PATH_TEMPLATES:
+            path = os.path.join(
+                self._cgroup_root, template.format(id=container_id)
+            )
+            if os.path.isdir(path):
+                self._paths[container_id] = path
+                self._missing.discard(container_id)
+                return path
+        if container_id not in self._missing:
+            self._missing.add(container_id)
+            # the agent container needs the host cgroup hierarchy
+            logger.warning(
+                f"No cgroup found for container {container_id} under "
+                f"{self._cgroup_root}, mount the host /sys/fs/cgroup and "
+                "run the agent with the host cgroup namespace"
+            )
+        return None
+
+    def _get_cpu_percent(
+        self, container_id: str, usage_usec: Optional[int]
+    ) -> Optional[float]:
+        """
+        CPU usage since the previous collection, 100 being a whole core
+        """
+        if usage_usec is None:
+            return None
+        now = time.monotonic()
+        previous = self._last_cpu.get(container_id)
+        self._last_cpu[container_id] = (now, usage_usec)
+        if previous is None or now <= previous[0]:
+            return None
+        used = (usage_usec - previous[1]) / 1e6
+        return round(max(used, 0) / (now - previous[0]) * 100, 2)
+
+    def _read(self, container: dict) -> Optional[ContainerUsage]:
+        container_id = container["Id"]
+        path = self._get_cgroup_path(container_id)
+        deployed = get_instance_from_labels(container.get("Labels") or {})
+        if path is None or deployed is None:
+            return None
+        model, instance_id = deployed
+        cpu = read_flat_keyed(os.path.join(path, "cpu.stat"))
+        io = read_io_stat(os.path.join(path, "io.stat"))
+        memory = read_value(os.path.join(path, "memory.current"))
+        memory_limit = read_value(os.path.join(path, "memory.max"))
+        return ContainerUsage(
+            container_id=container_id,
+            instance_type=model.__name__,
+            instance_id=instance_id,
+            cpu_percent=self._get_cpu_percent(
+                container_id, cpu.get("usage_usec")
+            ),
+            cpu_throttled_usec=cpu.get("throttled_usec"),
+            memory_bytes=memory,
+            memory_limit_bytes=memory_limit,
+            memory_percent=(
+                round(memory / memory_limit * 100, 2)
+                if memory is not None and memory_limit
+                else None
+            ),
+            io_read_bytes=io.get("rbytes"),
+            io_write_bytes=io.get("wbytes"),
+            pids=read_value(os.path.join(path, "pids.current")),
+        )
+
+    def collect(self) -> list[ContainerUsage]:
+        if not self.enabled:
+            return []
+        containers = self._client.api.containers(
+            filters={
+                "label": [f"AgentID={self._agent_id}"],
+                "status": "running",
+            }
+        )
+        running = {container["Id"] for container in containers}
+        # forget containers that are gone
+        for container_id in set(self._paths) - running:
+            self._paths.pop(container_id, None)
+        for container_id in set(self._last_cpu) - running:
+            self._last_cpu.pop(container_id, None)
+        self._missing &= running
+        metrics = []
+        for container in containers:
+            usage = self._read(container)
+            if usage is not None:
+                metrics.append(usage)
+        return metrics
@@ -0,0 +1,161 @@
+import time
+from collections import OrderedDict
+from enum import Enum
+from functools import cache
+from threading import Lock
+from typing import Optional
+
+from splight_agent.metrics import REGISTRY, Histogram
+from splight_agent.models import parse_datetime
+from splight_agent.sampler import percentile
+
+CONVERGENCE_SECONDS = REGISTRY.register(
+    Histogram(
+        "splight_agent_convergence_seconds",
+        "Time from a deployment change in the platform to each stage",
+        ("stage",),
+        buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600),
+    )
+)
+
+
+class ConvergenceStage(str, Enum):
+    DETECTED = "detected"
+    APPLIED = "applied"
+    RUNNING = "running"
+
+    def __str__(self) -> str:
+        return self.value
+
+
+def parse_timestamp(value: Optional[str]) -> Optional[float]:
+    parsed = parse_datetime(value)
+    return parsed.timestamp() if parsed is not None else None
+
+
+class PendingChange:
+    """
+    A detected change and the stages already observed for it
+    """
+
+    __slots__ = ("updated_at", "expects_running", "applied", "running")
+
+    def __init__(self, updated_at: float, expects_running: bool) -> None:
+        self.updated_at = updated_at
+        self.expects_running = expects_running
+        self.applied = False
+        self.running = False
+
+    @property
+    def done(self) -> bool:
+        return self.applied and (self.running or not self.expects_running)
+
+
+class ConvergenceTracker:
+    """
+    Measures the time from the deployment_updated_at of an instance to the
+    dispatcher detecting the change, the engine applying it and the
+    exporter seeing the container running
+    """
+
+    def __init__(self, max_instances: int = 10000) -> None:
+        self._lock = Lock()
+        self._max_instances = max_instances
+        # changes kept until every expected stage was observed, the
+        # container may be seen running before the engine returns
+        self._pending: OrderedDict[
+            tuple[str, str], PendingChange
+        ] = OrderedDict()
+        # last change detected for every instance, so a change is only
+        # measured once even if its action is planned again
+        self._seen: OrderedDict[tuple[str, str], float] = OrderedDict()
+        # observations since the last summary
+        self._window: dict[ConvergenceStage, list[float]] = {
+            stage: [] for stage in ConvergenceStage
+        }
+
+    def _observe(self, stage: ConvergenceStage, updated_at: float) -> None:
+        # clocks of the node and the platform may differ slightly
+        seconds = max(time.time() - updated_at, 0.0)
+        CONVERGENCE_SECONDS.observe(seconds, stage=stage.value)
+        self._window[stage].append(seconds)
+
+    @staticmethod
+    def _trim(table: OrderedDict, size: int) -> None:
+        while len(table) > size:
+            table.popitem(last=False)
+
+    def detected(
+        self,
+        instance_type: str,
+        instance_id: str,
+        deployment_updated_at: Optional[str],
+        expects_running: bool = True,
+    ) -> None:
+        updated_at = parse_timestamp(deployment_updated_at)
+        if updated_at is None:
+            return
+        key = (instance_type, instance_id)
+        with self._lock:
+            if self._seen.get(key) == updated_at:
+                return
+            self._seen[key] = updated_at
+            self._seen.move_to_end(key)
+            self._trim(self._seen, self._max_instances)
+            self._pending[key] = PendingChange(updated_at, expects_running)
+            self._pending.move_to_end(key)
+            self._trim(self._pending, self._max_instances)
+            self._observe(ConvergenceStage.DETECTED, updated_at)
+
+    def applied(self, instance_type: str, instance_id: str) -> None:
+        """
+        The engine applied the change successfully
+        """
+        key = (instance_type, instance_id)
+        with self._lock:
+            change = self._pending.get(key)
+            if change is None or change.applied:
+                return
+            change.applied = True
+            self._observe(ConvergenceStage.APPLIED, change.updated_at)
+            if change.done:
+                del self._pending[key]
+
+    def running(self, instance_type: str, instance_id: str) -> None:
+        """
+        A container started by the agent for the instance is running
+        """
+        key = (instance_type, instance_id)
+        with self._lock:
+            change = self._pending.get(key)
+            if change is None or not change.expects_running or change.running:
+                return
+            change.running = True
+            self._observe(ConvergenceStage.RUNNING, change.updated_at)
+            if change.done:
+                del self._pending[key]
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """
+        Returns the count, mean, max and p95 of every stage observed since
+        the last call
+        """
+        with self._lock:
+            window = self._window
+            self._window = {stage: [] for stage in ConvergenceStage}
+        summary = {}
+        for stage, values in window.items():
+            if not values:
+                continue
+            summary[stage.value] = {
+                "count": len(values),
+                "mean": round(sum(values) / len(values), 2),
+                "max": round(max(values), 2),
+                "p95": round(percentile(values, 0.95), 2),
+            }
+        return summary
+
+
+@cache
+def get_convergence_tracker() -> ConvergenceTracker:
+    return ConvergenceTracker()
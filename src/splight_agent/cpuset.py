@@ -0,0 +1,175 @@
+import glob
+import os
+import re
+from threading import Lock
+from typing import Iterable, Optional
+
+CpuTopology = dict[int, list[int]]
+
+# label of the containers with exclusive cpus, used to rebuild the
+# allocations when the agent restarts
+PINNED_CPUS_LABEL = "PinnedCpus"
+
+
+def parse_cpu_list(value: str) -> list[int]:
+    """
+    Parses a kernel cpu list like "0-3,8,10-11"
+    """
+    cpus = set()
+    for item in value.strip().split(","):
+        if not item:
+            continue
+        start, _, end = item.partition("-")
+        cpus.update(range(int(start), int(end or start) + 1))
+    return sorted(cpus)
+
+
+def format_cpu_list(cpus: Iterable[int]) -> str:
+    """
+    Formats cpus as a kernel cpu list, the format of Docker's cpuset-cpus
+    """
+    ranges: list[list[int]] = []
+    for cpu in sorted(set(cpus)):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(
+        str(start) if start == end else f"{start}-{end}"
+        for start, end in ranges
+    )
+
+
+def _read_cpu_list(path: str) -> Optional[list[int]]:
+    try:
+        with open(path) as fid:
+            return parse_cpu_list(fid.read())
+    except (OSError, ValueError):
+        return None
+
+
+def read_cpu_topology(sys_root: str = "/sys/devices/system") -> CpuTopology:
+    """
+    Online cpus of the host grouped by NUMA node. Hosts without NUMA
+    information are seen as a single node.
+    """
+    online = _read_cpu_list(os.path.join(sys_root, "cpu", "online"))
+    if not online:
+        online = sorted(os.sched_getaffinity(0))
+    topology: CpuTopology = {}
+    for path in glob.glob(os.path.join(sys_root, "node", "node*", "cpulist")):
+        match = re.search(r"node(\d+)", os.path.dirname(path))
+        cpus = [cpu for cpu in _read_cpu_list(path) or [] if cpu in online]
+        if match and cpus:
+            topology[int(match.group(1))] = cpus
+    if not topology:
+        topology = {0: online}
+    return topology
+
+
+class CpusetAllocator:
+    """
+    Hands out exclusive cpus to instances. An allocation is taken from a
+    single NUMA node when one has enough free cpus, choosing the fullest
+    node that fits so larger allocations still find room later. The
+    reserved cpus are never allocated and stay for the agent and the
+    containers without exclusive cpus.
+    """
+
+    def __init__(
+        self, topology: CpuTopology, reserved: Iterable[int] = ()
+    ) -> None:
+        self._lock = Lock()
+        self._topology = {
+            node: sorted(cpus) for node, cpus in topology.items()
+        }
+        self._reserved = set(reserved)
+        # instance key -> allocated cpus
+        self._allocations: dict[tuple[str, str], list[int]] = {}
+
+    @property
+    def cpus(self) -> list[int]:
+        return sorted(cpu for cpus in self._topology.values() for cpu in cpus)
+
+    @property
+    def numa(self) -> bool:
+        return len(self._topology) > 1
+
+    @property
+    def allocations(self) -> dict[tuple[str, str], list[int]]:
+        with self._lock:
+            return dict(self._allocations)
+
+    def _allocated(self) -> set[int]:
+        return {cpu for cpus in self._allocations.values() for cpu in cpus}
+
+    def _free(self) -> dict[int, list[int]]:
+        taken = self._allocated() | self._reserved
+        return {
+            node: [cpu for cpu in cpus if cpu not in taken]
+            for node, cpus in self._topology.items()
+        }
+
+    def allocate(
+        self, key: tuple[str, str], count: int
+    ) -> Optional[list[int]]:
+        """
+        Returns the cpus allocated to key, None if there are not enough
+        free cpus. An existing allocation of the same size is kept.
+        """
+        with self._lock:
+            current = self._allocations.pop(key, None)
+            if current is not None and len(current) == count:
+                self._allocations[key] = current
+                return list(current)
+            free = self._free()
+            fitting = [
+                node for node, cpus in free.items() if len(cpus) >= count
+            ]
+            if fitting:
+                node = min(fitting, key=lambda n: (len(free[n]), n))
+                cpus = free[node][:count]
+            elif sum(len(cpus) for cpus in free.values()) >= count:
+                # spread over the nodes with the most free cpus
+                cpus = []
+                for node in sorted(free, key=lambda n: -len(free[n])):
+                    cpus.extend(free[node][: count - len(cpus)])
+            else:
+                if current is not None:
+                    self._allocations[key] = current
+                return None
+            self._allocations[key] = sorted(cpus)
+            return list(self._allocations[key])
+
+    def restore(self, key: tuple[str, str], cpus: Iterable[int]) -> bool:
+        """
+        Records an allocation made before, e.g. by a previous run of the
+        agent. It is rejected if the cpus are unknown or already taken.
+        """
+        cpus = set(cpus)
+        with self._lock:
+            taken = self._allocated() | self._reserved
+            if not cpus or not cpus <= set(self.cpus) or cpus & taken:
+                return False
+            self._allocations[key] = sorted(cpus)
+            return True
+
+    def release(self, key: tuple[str, str]) -> Optional[list[int]]:
+        with self._lock:
+            return self._allocations.pop(key, None)
+
+    def shared_cpus(self) -> list[int]:
+        """
+        Cpus not allocated to any instance
+        """
+        with self._lock:
+            allocated = self._allocated()
+        return [cpu for cpu in self.cpus if cpu not in allocated]
+
+    def nodes_of(self, cpus: Iterable[int]) -> list[int]:
+        cpus = set(cpus)
+        return sorted(
+            node
+            for node, node_cpus in self._topology.items()
+            if cpus & set(node_cpus)
+        )
@@ -1,13 +1,27 @@
+import asyncio
+import contextvars
 import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock
 from typing import List, Optional
 
-from splight_agent.engine import Engine, EngineAction, EngineActionType
+from splight_agent.convergence import get_convergence_tracker
+from splight_agent.engine import (
+    ContainerSnapshot,
+    Engine,
+    EngineAction,
+    EngineActionType,
+)
 from splight_agent.logging import SplightLogger
+from splight_agent.metrics import DISPATCHER_ACTIONS, DISPATCHER_CYCLE_SECONDS
 from splight_agent.models import (
     ComponentDeploymentStatus,
     ComputeNode,
     DeployableInstance,
+    DesiredState,
 )
+from splight_agent.scheduler import PollScheduler
+from splight_agent.tracing import get_tracer
 
 logger = SplightLogger()
 
@@ -23,77 +37,263 @@ class Dispatcher:
         compute_node: ComputeNode,
         engine: Engine,
         poll_interval: int,
+        max_workers: int = 1,
+        max_poll_interval: Optional[int] = None,
+        poll_jitter: float = 0.1,
     ) -> None:
         self._poll_interval = poll_interval
+        self._scheduler = PollScheduler(
+            min_interval=poll_interval,
+            max_interval=max_poll_interval or poll_interval,
+            jitter=poll_jitter,
+            seed=compute_node.id,
+        )
         self._compute_node = compute_node
         self._engine = engine
+        self.last_cycle_docker_calls = 0
+        # with a single worker actions are handled sequentially in the
+        # dispatcher thread
+        self._executor = (
+            ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="dispatcher"
+            )
+            if max_workers > 1
+            else None
+        )
+        # instances with an action still being handled by a worker
+        self._in_flight: set[tuple[str, str]] = set()
+        self._in_flight_lock = Lock()
+        self._wakeup = Event()
+        # set when the agent stops, held while a cycle runs
+        self._stop = Event()
+        self._cycle_lock = Lock()
+        self._subscriber = None
+        self._subscription_poll_interval = poll_interval
+
+    def attach_subscriber(self, subscriber, poll_interval: int) -> None:
+        """
+        Use a deployment subscriber to start cycles as soon as a change is
+        pushed. While it is connected, the API is only polled every
+        poll_interval seconds as a safety net.
+        """
+        self._subscriber = subscriber
+        self._subscription_poll_interval = poll_interval
+
+    def notify(self) -> None:
+        """
+        Start the next cycle right away
+        """
+        self._wakeup.set()
+
+    def _wait_for_next_cycle(self, elapsed: float = 0.0) -> None:
+        interval = None
+        if self._subscriber is not None and self._subscriber.connected:
+            interval = self._subscription_poll_interval
+        timeout = self._scheduler.next_delay(elapsed, interval=interval)
+        self._wakeup.wait(timeout=timeout)
+        self._wakeup.clear()
+
+    @staticmethod
+    def _instance_key(
+        instance: DeployableInstance | DesiredState,
+    ) -> tuple[str, str]:
+        return instance.instance_type, instance.id
+
+    def _get_in_flight(self) -> set[tuple[str, str]]:
+        with self._in_flight_lock:
+            return set(self._in_flight)
+
+    @staticmethod
+    def _get_restart_reason(
+        state: DesiredState, snapshot: ContainerSnapshot
+    ) -> str:
+        field_hashes = snapshot.get_field_hashes(state)
+        if field_hashes is None:
+            return "changed fields unknown"
+        changed = state.instance.diff_fields(field_hashes)
+        return f"changed fields: {', '.join(changed) or 'none'}"
 
     def _compute_action(
-        self, instance: DeployableInstance
+        self, state: DesiredState, snapshot: ContainerSnapshot
     ) -> Optional[EngineAction]:
-        instance_hash = self._engine.get_instance_hash(instance)
-        if instance.deployment_active and not instance_hash:
+        instance_hash = snapshot.get_instance_hash(state)
+        if state.deployment_active and not instance_hash:
             logger.info(
-                f"Received RUN action {instance.instance_type} {instance.id}"
+                f"Received RUN action {state.instance_type} {state.id}"
+            )
+            return EngineAction(
+                type=EngineActionType.RUN, instance=state.instance
             )
-            return EngineAction(type=EngineActionType.RUN, instance=instance)
         elif (
-            instance.deployment_active
+            state.deployment_active
             and instance_hash
-            and instance_hash != instance.to_hash()
+            and not state.matches_hash(instance_hash)
         ):
             logger.info(
-                f"Received RESTART action {instance.instance_type} {instance.id}"
+                f"Received RESTART action {state.instance_type} {state.id}"
+                f" ({self._get_restart_reason(state, snapshot)})"
             )
             return EngineAction(
-                type=EngineActionType.RESTART, instance=instance
+                type=EngineActionType.RESTART, instance=state.instance
             )
-        elif not instance.deployment_active:
+        elif not state.deployment_active:
             if instance_hash:
                 logger.info(
-                    f"Received STOP action {instance.instance_type} {instance.id}"
+                    f"Received STOP action {state.instance_type} {state.id}"
                 )
                 return EngineAction(
-                    type=EngineActionType.STOP, instance=instance
+                    type=EngineActionType.STOP, instance=state.instance
                 )
-            elif (
-                instance.deployment_status != ComponentDeploymentStatus.STOPPED
-            ):
+            elif state.deployment_status != ComponentDeploymentStatus.STOPPED:
                 logger.info(
-                    f"Instance {instance.id} has status {instance.deployment_status} and should be STOPPED. Setting status to STOPPED."
+                    f"Instance {state.id} has status {state.deployment_status} and should be STOPPED. Setting status to STOPPED."
                 )
+                instance = state.instance
                 instance.deployment_status = ComponentDeploymentStatus.STOPPED
                 instance.update_status()
+                state.deployment_status = ComponentDeploymentStatus.STOPPED
                 return None
         return None
 
     def _compute_actions(self) -> List[EngineAction]:
-        instances = self._compute_node.components + self._compute_node.servers
-        actions = [
-            action
-            for instance in instances
-            if (action := self._compute_action(instance)) is not None
-        ]
+        desired_state = self._compute_node.get_desired_state()
+        # taken before the snapshot, an action that finishes in between is
+        # still skipped instead of being planned from a stale snapshot
+        in_flight = self._get_in_flight()
+        snapshot = self._engine.get_snapshot()
+        actions = []
+        try:
+            for state in desired_state:
+                if self._instance_key(state) in in_flight:
+                    logger.debug(
+                        f"Skipping {state.instance_type} {state.id}, an action is still in progress"
+                    )
+                    continue
+                action = self._compute_action(state, snapshot)
+                if action is not None:
+                    get_convergence_tracker().detected(
+                        state.instance_type,
+                        state.id,
+                        state.deployment_updated_at,
+                        expects_running=action.type != EngineActionType.STOP,
+                    )
+                    actions.append(action)
+        finally:
+            # keep only the compact records between cycles
+            for state in desired_state:
+                state.release()
         return actions
 
-    def start(self):
-        logger.info("Dispatcher started")
-        while True:
+    def _handle_action(self, action: EngineAction) -> None:
+        try:
+            if self._engine.handle_action(action):
+                get_convergence_tracker().applied(
+                    action.instance.instance_type, action.instance.id
+                )
+        except Exception as e:
+            logger.error(
+                f"The engine failed to handle action {action.type}:\n{e}\n Continuing..."
+            )
+        finally:
+            with self._in_flight_lock:
+                self._in_flight.discard(self._instance_key(action.instance))
+
+    def _dispatch(self, action: EngineAction) -> None:
+        DISPATCHER_ACTIONS.inc(type=action.type.value)
+        if self._executor is None:
+            self._handle_action(action)
+            return
+        # the instance is not planned again until its action is done, so
+        # actions for the same instance never overlap and keep their order
+        with self._in_flight_lock:
+            self._in_flight.add(self._instance_key(action.instance))
+        # the action spans are recorded under the cycle that planned them
+        context = contextvars.copy_context()
+        self._executor.submit(context.run, self._handle_action, action)
+
+    def _run_cycle(self) -> float:
+        """
+        Run one reconcile cycle and return how long it took. No cycle runs
+        once the dispatcher is stopped.
+        """
+        with self._cycle_lock:
+            if self._stop.is_set():
+                return 0.0
+            return self._reconcile()
+
+    def _reconcile(self) -> float:
+        start = time.monotonic()
+        self._engine.docker_calls.reset()
+        with get_tracer().span("dispatcher.cycle") as span:
             try:
                 actions = self._compute_actions()
+                span.set_attribute("actions", len(actions))
                 for action in actions:
-                    try:
-                        self._engine.handle_action(action)
-                    except Exception as e:
-                        logger.error(
-                            f"The engine failed to handle action {action.type}:\n{e}\n Continuing..."
+                    if self._stop.is_set():
+                        logger.info(
+                            "Dispatcher stopped, skipping the remaining actions"
                         )
+                        break
+                    self._dispatch(action)
+                self._scheduler.record(changed=bool(actions))
             except Exception as e:
                 logger.error(
                     f"Failed to fetch instances or compute actions: {e}"
                 )
+                span.set_attribute("result", "failed")
+                self._scheduler.record(failed=True)
             finally:
-                time.sleep(self._poll_interval)
+                self.last_cycle_docker_calls = (
+                    self._engine.docker_calls.reset()
+                )
+                span.set_attribute(
+                    "docker_calls", self.last_cycle_docker_calls
+                )
+                logger.debug(
+                    f"Dispatcher cycle made {self.last_cycle_docker_calls} Docker API calls"
+                )
+        elapsed = time.monotonic() - start
+        DISPATCHER_CYCLE_SECONDS.observe(elapsed)
+        return elapsed
+
+    def start(self):
+        logger.info("Dispatcher started")
+        while not self._stop.is_set():
+            elapsed = self._run_cycle()
+            self._wait_for_next_cycle(elapsed)
+
+    async def run_async(self):
+        """
+        Run the dispatcher loop as an asyncio task, until it is cancelled.
+        Cycles run in a worker thread so they do not block the event loop.
+        """
+        logger.info("Dispatcher started")
+        while True:
+            elapsed = await asyncio.to_thread(self._run_cycle)
+            try:
+                await asyncio.to_thread(self._wait_for_next_cycle, elapsed)
+            except asyncio.CancelledError:
+                # release the waiting worker thread
+                self._wakeup.set()
+                raise
+
+    def stop(self) -> None:
+        """
+        Stop dispatching actions and wait for the cycle in progress, which
+        may still be running in a worker thread after its task was
+        cancelled
+        """
+        self._stop.set()
+        self._wakeup.set()
+        with self._cycle_lock:
+            pass
+
+    def shutdown(self) -> None:
+        """
+        Wait for the actions handed to the worker pool to finish
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
 
     def wait_for_instances_to_stop(self, instances: List[DeployableInstance]):
         while True:
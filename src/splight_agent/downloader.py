@@ -0,0 +1,357 @@
+import json
+import os
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import List, Optional, Tuple
+
+import requests
+from pydantic import BaseModel
+
+from splight_agent.exceptions import DownloadError
+from splight_agent.logging import SplightLogger
+
+logger = SplightLogger(__name__)
+
+PART_SUFFIX = ".part"
+PROGRESS_SUFFIX = ".progress"
+PARTIAL_SUFFIXES = (PART_SUFFIX, PROGRESS_SUFFIX, f"{PROGRESS_SUFFIX}.tmp")
+
+# files being downloaded by this process, their partials are never stale
+_active_downloads: set = set()
+_active_lock = Lock()
+
+
+def remove_stale_partials(file_path: str, pattern: re.Pattern) -> None:
+    """
+    Remove the partial files of other downloads in the directory of
+    file_path whose file name fully matches pattern, e.g. older versions of
+    the same image that will not be retried. The partials of file_path and
+    of the downloads in progress are kept.
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    with _active_lock:
+        keep = _active_downloads | {os.path.abspath(file_path)}
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        suffix = next((s for s in PARTIAL_SUFFIXES if name.endswith(s)), None)
+        if suffix is None:
+            continue
+        target = name[: -len(suffix)]
+        if not pattern.fullmatch(target):
+            continue
+        if os.path.join(directory, target) in keep:
+            continue
+        try:
+            os.remove(os.path.join(directory, name))
+            logger.info(f"Removed stale partial download {name}")
+        except OSError as e:
+            logger.warning(f"Unable to remove stale partial {name}: {e}")
+
+
+class DownloadStats(BaseModel):
+    size: int = 0
+    downloaded: int = 0
+    resumed: int = 0
+    retries: int = 0
+    seconds: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Downloaded bytes per second in this run"""
+        if not self.seconds:
+            return 0.0
+        return self.downloaded / self.seconds
+
+
+class _DownloadProgress:
+    """
+    Byte ranges of a download and how far each one got. It is saved next to
+    the partial file so an interrupted download can be resumed.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        size: int,
+        segments: List[List[int]],
+        validator: Optional[str] = None,
+    ) -> None:
+        self._path = path
+        self._lock = Lock()
+        self._last_save = 0.0
+        self.size = size
+        # ETag or Last-Modified of the file the partial was downloaded from
+        self.validator = validator
+        # [next byte to fetch, last byte] for every segment
+        self.segments = segments
+
+    @classmethod
+    def create(
+        cls, path: str, size: int, count: int, validator: Optional[str]
+    ) -> "_DownloadProgress":
+        step = -(-size // count)
+        segments = [
+            [start, min(start + step, size) - 1]
+            for start in range(0, size, step)
+        ]
+        return cls(path, size, segments, validator)
+
+    @classmethod
+    def load(
+        cls, path: str, size: int, validator: Optional[str]
+    ) -> Optional["_DownloadProgress"]:
+        """
+        Returns the saved progress if it belongs to the same file, same size
+        and validator, or None to start over
+        """
+        try:
+            with open(path) as fid:
+                data = json.load(fid)
+        except (OSError, ValueError):
+            return None
+        if data.get("size") != size or data.get("validator") != validator:
+            return None
+        return cls(path, size, data["segments"], validator)
+
+    @property
+    def remaining(self) -> int:
+        return sum(end - offset + 1 for offset, end in self.segments)
+
+    def advance(self, index: int, length: int) -> None:
+        with self._lock:
+            self.segments[index][0] += length
+            if time.monotonic() - self._last_save > 1:
+                self._save()
+
+    def save(self) -> None:
+        with self._lock:
+            self._save()
+
+    def _save(self) -> None:
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "w") as fid:
+            json.dump(
+                {
+                    "size": self.size,
+                    "validator": self.validator,
+                    "segments": self.segments,
+                },
+                fid,
+            )
+        os.replace(tmp_path, self._path)
+        self._last_save = time.monotonic()
+
+
+class RangedDownloader:
+    """
+    Downloads a file with several concurrent HTTP Range requests. Progress is
+    kept on disk, so a download interrupted by an error or an agent restart
+    resumes where it stopped. Failed requests are retried with exponential
+    backoff. Requests are sent through the given session, or a new one.
+    """
+
+    def __init__(
+        self,
+        segments: int = 4,
+        chunk_size: int = 1 << 20,
+        max_retries: int = 5,
+        backoff_factor: float = 1.0,
+        max_backoff: float = 60.0,
+        timeout: float = 60.0,
+        session: Optional[requests.Session] = None,
+    ) -> None:
+        self._segments = max(segments, 1)
+        self._chunk_size = chunk_size
+        self._max_retries = max_retries
+        self._backoff_factor = backoff_factor
+        self._max_backoff = max_backoff
+        self._timeout = timeout
+        # shared by the range requests, so they reuse their connections
+        self._session = session or requests.Session()
+        self._stats_lock = Lock()
+        self.stats = DownloadStats()
+
+    def _backoff(self, attempt: int) -> None:
+        delay = min(
+            self._max_backoff, self._backoff_factor * 2 ** (attempt - 1)
+        )
+        time.sleep(delay * random.uniform(0.5, 1.5))
+
+    def _retry(self, attempt: int, error: Exception) -> int:
+        attempt += 1
+        if attempt > self._max_retries:
+            raise DownloadError(
+                f"Download failed after {self._max_retries} retries"
+            ) from error
+        logger.warning(f"Download request failed, retrying: {error}")
+        with self._stats_lock:
+            self.stats.retries += 1
+        self._backoff(attempt)
+        return attempt
+
+    def _probe(self, url: str) -> Tuple[Optional[int], bool, Optional[str]]:
+        """
+        Returns the file size, whether the server supports ranges and the
+        ETag or Last-Modified of the file. A one byte GET is used since
+        presigned URLs are only valid for GET.
+        """
+        attempt = 0
+        while True:
+            try:
+                with self._session.get(
+                    url,
+                    headers={"Range": "bytes=0-0"},
+                    stream=True,
+                    timeout=self._timeout,
+                ) as response:
+                    response.raise_for_status()
+                    validator = response.headers.get(
+                        "ETag"
+                    ) or response.headers.get("Last-Modified")
+                    content_range = response.headers.get("Content-Range", "")
+                    total = content_range.rpartition("/")[2]
+                    if response.status_code == 206 and total.isdigit():
+                        return int(total), True, validator
+                    length = response.headers.get("Content-Length")
+                    return (int(length) if length else None), False, validator
+            except requests.RequestException as e:
+                attempt = self._retry(attempt, e)
+
+    def _fetch_segment(
+        self, url: str, part_path: str, progress: _DownloadProgress, index: int
+    ) -> None:
+        attempt = 0
+        while progress.segments[index][0] <= progress.segments[index][1]:
+            offset, end = progress.segments[index]
+            start = offset
+            try:
+                with self._session.get(
+                    url,
+                    headers={"Range": f"bytes={offset}-{end}"},
+                    stream=True,
+                    timeout=self._timeout,
+                ) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        raise DownloadError("Server ignored range request")
+                    with open(part_path, "r+b", buffering=0) as fid:
+                        fid.seek(offset)
+                        for chunk in response.iter_content(self._chunk_size):
+                            chunk = chunk[: end - offset + 1]
+                            fid.write(chunk)
+                            offset += len(chunk)
+                            progress.advance(index, len(chunk))
+                            with self._stats_lock:
+                                self.stats.downloaded += len(chunk)
+                            if offset > end:
+                                break
+            except (requests.RequestException, OSError) as e:
+                # only consecutive failures without progress count
+                if offset > start:
+                    attempt = 0
+                attempt = self._retry(attempt, e)
+
+    def _fetch_whole(self, url: str, part_path: str) -> None:
+        attempt = 0
+        while True:
+            try:
+                with self._session.get(
+                    url, stream=True, timeout=self._timeout
+                ) as response:
+                    response.raise_for_status()
+                    with open(part_path, "wb") as fid:
+                        for chunk in response.iter_content(self._chunk_size):
+                            fid.write(chunk)
+                            with self._stats_lock:
+                                self.stats.downloaded += len(chunk)
+                return
+            except (requests.RequestException, OSError) as e:
+                attempt = self._retry(attempt, e)
+
+    def _fetch_ranges(
+        self, url: str, file_path: str, size: int, validator: Optional[str]
+    ) -> None:
+        part_path = f"{file_path}{PART_SUFFIX}"
+        progress_path = f"{file_path}{PROGRESS_SUFFIX}"
+        progress = None
+        if os.path.exists(part_path):
+            # a file rebuilt with the same size has another validator, its
+            # partial is never mixed with the new bytes
+            progress = _DownloadProgress.load(progress_path, size, validator)
+        if progress is None:
+            progress = _DownloadProgress.create(
+                progress_path, size, self._segments, validator
+            )
+            with open(part_path, "wb") as fid:
+                fid.truncate(size)
+        else:
+            self.stats.resumed = size - progress.remaining
+            logger.info(f"Resuming download at {self.stats.resumed} bytes")
+        progress.save()
+
+        pending = [
+            index
+            for index, (offset, end) in enumerate(progress.segments)
+            if offset <= end
+        ]
+        try:
+            with ThreadPoolExecutor(max_workers=len(pending) or 1) as pool:
+                futures = [
+                    pool.submit(
+                        self._fetch_segment, url, part_path, progress, index
+                    )
+                    for index in pending
+                ]
+                for future in futures:
+                    future.result()
+        finally:
+            progress.save()
+        os.remove(progress_path)
+
+    def download(
+        self,
+        url: str,
+        file_path: str,
+        stale_pattern: Optional[re.Pattern] = None,
+    ) -> str:
+        """
+        Download url to file_path. If stale_pattern is given, the partial
+        files of the other downloads it matches are removed first.
+        """
+        active_path = os.path.abspath(file_path)
+        with _active_lock:
+            _active_downloads.add(active_path)
+        try:
+            if stale_pattern is not None:
+                remove_stale_partials(file_path, stale_pattern)
+            return self._download(url, file_path)
+        finally:
+            with _active_lock:
+                _active_downloads.discard(active_path)
+
+    def _download(self, url: str, file_path: str) -> str:
+        self.stats = DownloadStats()
+        start = time.monotonic()
+        size, ranges, validator = self._probe(url)
+        self.stats.size = size or 0
+        if ranges and size:
+            self._fetch_ranges(url, file_path, size, validator)
+        else:
+            logger.info("Server does not support ranges, downloading file")
+            self._fetch_whole(url, f"{file_path}{PART_SUFFIX}")
+        os.replace(f"{file_path}{PART_SUFFIX}", file_path)
+        self.stats.seconds = time.monotonic() - start
+        logger.info(
+            f"Download complete: {self.stats.downloaded} bytes in "
+            f"{self.stats.seconds:.1f}s "
+            f"({self.stats.throughput / 1e6:.2f} MB/s, "
+            f"{self.stats.resumed} bytes resumed, "
+            f"{self.stats.retries} retries)"
+        )
+        return file_path
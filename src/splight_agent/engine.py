@@ -1,5 +1,11 @@
+import contextvars
 import json
+import math
 import os
+import re
+import time
+from collections import defaultdict
+from threading import BoundedSemaphore, Lock, Thread
 from typing import Callable, List, Optional, TypedDict, Union
 
 import docker
@@ -11,21 +17,45 @@ from splight_agent.constants import (
     DeploymentSize,
     EngineActionType,
 )
+from splight_agent.cpuset import (
+    PINNED_CPUS_LABEL,
+    CpusetAllocator,
+    format_cpu_list,
+    parse_cpu_list,
+)
+from splight_agent.images import HashingStream, ImageIndex
 from splight_agent.logging import SplightLogger
+from splight_agent.metrics import (
+    ENGINE_CONTAINER_START_SECONDS,
+    ENGINE_DOCKER_CALLS,
+    ENGINE_DOWNLOAD_BYTES,
+    ENGINE_DOWNLOAD_SECONDS,
+    ENGINE_IMAGE_INDEX_LOOKUPS,
+    ENGINE_IMAGE_LOAD_SECONDS,
+)
 from splight_agent.models import (
+    DEPLOY_LABEL_MODELS,
     Component,
     ComponentDeploymentStatus,
     ComputeNode,
     DeployableInstance,
+    DesiredState,
     EngineAction,
     HubComponent,
     HubServer,
-    Server,
+    get_instance_from_labels,
+    partial,
 )
 from splight_agent.settings import RUNNER_CLI_VERSION
+from splight_agent.tracing import NoopSpan, Span, get_tracer
 
 logger = SplightLogger()
 
+# daemon errors caused by a missing or corrupt image
+IMAGE_ERROR_REGEX = re.compile(
+    r"no such image|digest|layer does not exist", re.IGNORECASE
+)
+
 
 class ComponentEnvironment(TypedDict):
     """
@@ -38,6 +68,19 @@ class ComponentEnvironment(TypedDict):
     SPLIGHT_PLATFORM_API_HOST: str
 
 
+class ContainerResources(TypedDict, total=False):
+    """
+    Resource limits passed to docker when a container is run
+    """
+
+    nano_cpus: int
+    cpuset_cpus: str
+    cpuset_mems: str
+    mem_limit: str
+    mem_reservation: str
+    memswap_limit: str
+
+
 class InvalidActionError(Exception):
     ...
 
@@ -50,6 +93,84 @@ class ContainerExecutionError(Exception):
     ...
 
 
+class DockerCallCounter:
+    """
+    Counts the requests made to the Docker daemon by a docker client
+    """
+
+    def __init__(self, client: docker.DockerClient) -> None:
+        self._lock = Lock()
+        self._count = 0
+        # never reset, exported as a counter
+        self.total = 0
+        client.api.hooks["response"].append(self._on_response)
+
+    def _on_response(self, response, *args, **kwargs) -> None:
+        with self._lock:
+            self._count += 1
+            self.total += 1
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    def reset(self) -> int:
+        """
+        Reset the counter and return the count before the reset
+        """
+        with self._lock:
+            count, self._count = self._count, 0
+        return count
+
+
+class ContainerSnapshot:
+    """
+    Point-in-time view of the containers deployed by the agent, indexed by
+    the deploy label (ComponentID/ServerID) and instance id
+    """
+
+    def __init__(self, containers: List[Container]) -> None:
+        self._index: dict[tuple[str, str], List[Container]] = defaultdict(list)
+        for container in containers:
+            labels = container.attrs.get("Labels") or {}
+            for deploy_label in DEPLOY_LABEL_MODELS:
+                instance_id = labels.get(deploy_label)
+                if instance_id:
+                    self._index[(deploy_label, instance_id)].append(container)
+
+    def __len__(self) -> int:
+        return sum(len(containers) for containers in self._index.values())
+
+    def get_containers(
+        self, instance: DeployableInstance | DesiredState
+    ) -> List[Container]:
+        return self._index.get((instance.get_deploy_label(), instance.id), [])
+
+    def get_instance_hash(
+        self, instance: DeployableInstance | DesiredState
+    ) -> Optional[str]:
+        containers = self.get_containers(instance)
+        if not containers:
+            return None
+        return (containers[0].attrs.get("Labels") or {}).get("StateHash")
+
+    def get_field_hashes(
+        self, instance: DeployableInstance | DesiredState
+    ) -> Optional[dict[str, str]]:
+        """
+        Per-field hashes of the state the instance container was started
+        with, None for containers started before they were recorded
+        """
+        containers = self.get_containers(instance)
+        if not containers:
+            return None
+        labels = containers[0].attrs.get("Labels") or {}
+        try:
+            return json.loads(labels["StateFieldHashes"])
+        except (KeyError, ValueError):
+            return None
+
+
 class Engine:
     """
     The engine is responsible for handling the execution of instances
@@ -62,29 +183,96 @@ class Engine:
     }
 
     DEPLOYMENT_SIZE_MAP = {
-        DeploymentSize.SMALL: {"cpu": "0.5", "memory": "500m"},
-        DeploymentSize.MEDIUM: {"cpu": "1", "memory": "3g"},
-        DeploymentSize.LARGE: {"cpu": "3", "memory": "7g"},
-        DeploymentSize.VERY_LARGE: {"cpu": "4", "memory": "16g"},
+        DeploymentSize.SMALL: {
+            "cpu": "0.5",
+            "memory": "500m",
+            "memory_reservation": "250m",
+        },
+        DeploymentSize.MEDIUM: {
+            "cpu": "1",
+            "memory": "3g",
+            "memory_reservation": "1536m",
+        },
+        DeploymentSize.LARGE: {
+            "cpu": "3",
+            "memory": "7g",
+            "memory_reservation": "3584m",
+        },
+        DeploymentSize.VERY_LARGE: {
+            "cpu": "4",
+            "memory": "16g",
+            "memory_reservation": "8g",
+        },
     }
 
+    # sizes that get exclusive cpus when a cpuset allocator is given
+    PINNED_SIZES = (DeploymentSize.LARGE, DeploymentSize.VERY_LARGE)
+
+    # the health check start period and a few of its intervals
+    HEALTH_TIMEOUT = 90
+    HEALTH_POLL_INTERVAL = 1.0
+
     def __init__(
         self,
         compute_node: ComputeNode,
         workspace_name: str,
         ecr_repository: str,
         componenent_environment: ComponentEnvironment,
+        max_downloads: int = 2,
+        max_image_loads: int = 1,
+        max_container_operations: int = 4,
+        stream_images: bool = False,
+        stream_chunk_size: int = 1 << 20,
+        cpu_limits: bool = True,
+        memory_swap: bool = False,
+        cpuset_allocator: Optional[CpusetAllocator] = None,
     ) -> None:
         self._compute_node = compute_node
         self._workspace_name = workspace_name
         self._ecr_repository = ecr_repository
         self._component_environment = componenent_environment
         self._docker_client = docker.from_env(timeout=600)
+        self._docker_calls = DockerCallCounter(self._docker_client)
+        self._image_index = ImageIndex(self._docker_client)
+        ENGINE_DOCKER_CALLS.set_function(lambda: self._docker_calls.total)
+        ENGINE_IMAGE_INDEX_LOOKUPS.set_function(
+            lambda: {
+                ("hit",): self._image_index.stats["hits"],
+                ("miss",): self._image_index.stats["misses"],
+            }
+        )
+        self._stream_images = stream_images
+        self._stream_chunk_size = stream_chunk_size
+        # limits for concurrent actions, each phase has its own cap
+        self._download_slots = BoundedSemaphore(max_downloads)
+        self._image_load_slots = BoundedSemaphore(max_image_loads)
+        self._container_slots = BoundedSemaphore(max_container_operations)
+        # one pull at a time for every hub instance version, they share the
+        # image file and its partials
+        self._pull_locks: dict[tuple[str, str], Lock] = {}
+        self._pull_locks_lock = Lock()
+        self._cpu_limits = cpu_limits
+        self._memory_swap = memory_swap
+        self._cpuset_allocator = cpuset_allocator
+        self._cpuset_lock = Lock()
+        # container id -> cpus set by the agent on the containers without
+        # exclusive cpus
+        self._shared_cpusets: dict[str, str] = {}
         self._docker_network = self._get_or_create_network()
         self._add_containers_to_network()
+        if self._cpuset_allocator:
+            self._restore_cpu_allocations()
+
+    @property
+    def docker_calls(self) -> DockerCallCounter:
+        return self._docker_calls
 
     @property
-    def handlers(self) -> dict[EngineActionType, Callable[[Component], None]]:
+    def image_index(self) -> ImageIndex:
+        return self._image_index
+
+    @property
+    def handlers(self) -> dict[EngineActionType, Callable[[Component], bool]]:
         return {
             EngineActionType.RUN: self.run,
             EngineActionType.STOP: self.stop,
@@ -122,18 +310,168 @@ class Engine:
             }
         return None
 
-    def _get_mem_limit(self, instance: DeployableInstance) -> str:
+    def _get_nano_cpus(self, instance: DeployableInstance) -> Optional[int]:
         map_ = self.DEPLOYMENT_SIZE_MAP.get(instance.deployment_capacity, None)
         if map_:
-            return map_["memory"]
+            return int(float(map_["cpu"]) * 1e9)
         return None
 
+    def _get_resources(
+        self,
+        instance: DeployableInstance,
+        pinned_cpus: Optional[List[int]] = None,
+    ) -> ContainerResources:
+        resources = ContainerResources()
+        map_ = self.DEPLOYMENT_SIZE_MAP.get(instance.deployment_capacity, None)
+        if map_:
+            resources["mem_limit"] = map_["memory"]
+            resources["mem_reservation"] = map_["memory_reservation"]
+            if not self._memory_swap:
+                # memory plus swap equal to the memory limit disables swap
+                resources["memswap_limit"] = map_["memory"]
+        nano_cpus = self._get_nano_cpus(instance)
+        if self._cpu_limits and nano_cpus:
+            resources["nano_cpus"] = nano_cpus
+        if pinned_cpus:
+            resources["cpuset_cpus"] = format_cpu_list(pinned_cpus)
+            if self._cpuset_allocator.numa:
+                # keep the memory on the nodes of the cpus
+                resources["cpuset_mems"] = format_cpu_list(
+                    self._cpuset_allocator.nodes_of(pinned_cpus)
+                )
+        elif self._cpuset_allocator:
+            # stay off the cpus given to other instances
+            resources["cpuset_cpus"] = format_cpu_list(
+                self._cpuset_allocator.shared_cpus()
+            )
+        return resources
+
+    @staticmethod
+    def _get_allocation_key(
+        instance: DeployableInstance,
+    ) -> tuple[str, str]:
+        return (instance.get_deploy_label(), instance.id)
+
+    def _allocate_cpus(
+        self, instance: DeployableInstance
+    ) -> Optional[List[int]]:
+        """
+        Exclusive cpus for the instance if its size is pinned, None
+        otherwise or if there are not enough free cpus
+        """
+        if (
+            not self._cpuset_allocator
+            or instance.deployment_capacity not in self.PINNED_SIZES
+        ):
+            return None
+        count = math.ceil(self._get_nano_cpus(instance) / 1e9)
+        cpus = self._cpuset_allocator.allocate(
+            self._get_allocation_key(instance), count
+        )
+        if cpus is None:
+            logger.warning(
+                f"Not enough free cpus to pin {instance.instance_type} "
+                f"{instance.id}, running it with a cpu limit only"
+            )
+            return None
+        logger.info(
+            f"Pinned {instance.instance_type} {instance.id} to cpus "
+            f"{format_cpu_list(cpus)}"
+        )
+        self._update_shared_cpusets()
+        return cpus
+
+    def _release_cpus(self, instance: DeployableInstance) -> None:
+        if not self._cpuset_allocator:
+            return
+        released = self._cpuset_allocator.release(
+            self._get_allocation_key(instance)
+        )
+        if released is not None:
+            self._update_shared_cpusets()
+
+    def _update_shared_cpusets(self) -> None:
+        """
+        Move the containers without exclusive cpus to the cpus that are not
+        allocated, so they never run on the cpus of a pinned instance
+        """
+        with self._cpuset_lock:
+            shared = format_cpu_list(self._cpuset_allocator.shared_cpus())
+            # a single listing, the containers are not inspected
+            containers = self._docker_client.containers.list(
+                filters={"label": [f"AgentID={self._compute_node.id}"]},
+                all=True,
+                sparse=True,
+            )
+            listed = {container.id for container in containers}
+            for container_id in set(self._shared_cpusets) - listed:
+                del self._shared_cpusets[container_id]
+            for container in containers:
+                labels = container.attrs.get("Labels") or {}
+                if PINNED_CPUS_LABEL in labels:
+                    continue
+                self._set_shared_cpuset(container, shared)
+
+    def _set_shared_cpuset(self, container: Container, shared: str) -> None:
+        """
+        Move a container to the shared cpus, unless the agent already did.
+        Called with the cpuset lock held.
+        """
+        if self._shared_cpusets.get(container.id) == shared:
+            return
+        try:
+            container.update(cpuset_cpus=shared)
+        except docker.errors.APIError as e:
+            logger.warning(
+                f"Could not update the cpus of container {container.id}: {e}"
+            )
+            return
+        self._shared_cpusets[container.id] = shared
+
+    def _track_shared_cpuset(
+        self, container: Container, resources: ContainerResources
+    ) -> None:
+        """
+        Record the cpus a new container without exclusive cpus was started
+        with, and move it if cpus were allocated or released since they were
+        computed, as the update pass may have listed the containers before
+        it existed
+        """
+        with self._cpuset_lock:
+            self._shared_cpusets[container.id] = resources["cpuset_cpus"]
+            shared = format_cpu_list(self._cpuset_allocator.shared_cpus())
+            self._set_shared_cpuset(container, shared)
+
+    def _restore_cpu_allocations(self) -> None:
+        """
+        Rebuild the cpu allocations from the containers already running,
+        e.g. after an agent restart
+        """
+        for container in self._get_deployed_containers():
+            cpus = container.labels.get(PINNED_CPUS_LABEL)
+            if not cpus:
+                continue
+            for deploy_label in DEPLOY_LABEL_MODELS:
+                instance_id = container.labels.get(deploy_label)
+                if not instance_id:
+                    continue
+                restored = self._cpuset_allocator.restore(
+                    (deploy_label, instance_id), parse_cpu_list(cpus)
+                )
+                if not restored:
+                    logger.warning(
+                        f"Pinned cpus {cpus} of container {container.name} "
+                        "are taken or offline, they are not tracked"
+                    )
+        self._update_shared_cpusets()
+
     def _get_labels(self, instance: DeployableInstance) -> dict:
         deploy_label = instance.get_deploy_label()
         labels = {
             "AgentID": self._compute_node.id,
             deploy_label: instance.id,
             "StateHash": instance.to_hash(),
+            "StateFieldHashes": json.dumps(instance.get_field_hashes()),
         }
         return labels
 
@@ -169,6 +507,97 @@ class Engine:
             ) from exc
         return image
 
+    def _stream_image(
+        self, hub_instance: Union[HubComponent, HubServer]
+    ) -> Image:
+        """
+        Pipe the image download straight into docker load, chunk by chunk,
+        without writing the tarball to disk
+        """
+        logger.info(
+            f"Starting image stream for component: {hub_instance.name} {hub_instance.version}"
+        )
+        stream = HashingStream(
+            hub_instance.stream_image(chunk_size=self._stream_chunk_size)
+        )
+        try:
+            with self._download_slots, self._image_load_slots:
+                start = time.monotonic()
+                with get_tracer().span("image.stream") as span:
+                    images = self._docker_client.images.load(stream)
+                    span.set_attribute("image_bytes", stream.size)
+                elapsed = time.monotonic() - start
+            image = images[0]
+        except Exception as exc:
+            raise ImageError(
+                f"Failed to stream image for instance: {hub_instance.name} {hub_instance.version}"
+            ) from exc
+        logger.info(
+            f"Loaded image for {hub_instance.name} {hub_instance.version} "
+            f"({stream.size} bytes, sha256 {stream.hexdigest})"
+        )
+        ENGINE_DOWNLOAD_BYTES.inc(stream.size)
+        # both run at once, the load is the time not spent waiting on the
+        # download
+        ENGINE_DOWNLOAD_SECONDS.observe(stream.read_seconds)
+        ENGINE_IMAGE_LOAD_SECONDS.observe(
+            max(elapsed - stream.read_seconds, 0.0)
+        )
+        return image
+
+    def _get_pull_lock(
+        self, hub_instance: Union[HubComponent, HubServer]
+    ) -> Lock:
+        key = (hub_instance.id, hub_instance.version)
+        with self._pull_locks_lock:
+            return self._pull_locks.setdefault(key, Lock())
+
+    def _get_or_pull_image(
+        self, hub_instance: Union[HubComponent, HubServer]
+    ) -> Image:
+        """
+        Pull the image of a hub instance unless another action pulled it
+        while waiting for the lock of its version
+        """
+        with self._get_pull_lock(hub_instance):
+            image = self._image_index.get(hub_instance)
+            if image is not None:
+                return image
+            return self._pull_image(hub_instance)
+
+    def _pull_image(
+        self, hub_instance: Union[HubComponent, HubServer]
+    ) -> Image:
+        """
+        Download and load the image of a hub instance and add it to the
+        local image index
+        """
+        if self._stream_images:
+            image = self._stream_image(hub_instance)
+            self._image_index.add(hub_instance, image)
+            return image
+        with self._download_slots, ENGINE_DOWNLOAD_SECONDS.time():
+            with get_tracer().span("image.download") as span:
+                image_file = self._download_image(hub_instance)
+                image_size = os.path.getsize(image_file)
+                span.set_attribute("image_bytes", image_size)
+        ENGINE_DOWNLOAD_BYTES.inc(image_size)
+        try:
+            with (
+                self._image_load_slots,
+                ENGINE_IMAGE_LOAD_SECONDS.time(),
+                get_tracer().span("image.load", image_bytes=image_size),
+            ):
+                image = self._load_image(
+                    image_file=image_file,
+                    hub_instance_name=hub_instance.name,
+                    hub_instance_version=hub_instance.version,
+                )
+        finally:
+            os.remove(image_file)
+        self._image_index.add(hub_instance, image)
+        return image
+
     def _get_command(self, instance: DeployableInstance) -> List[str]:
         if instance.instance_type == "component":
             return [
@@ -208,7 +637,7 @@ class Engine:
         environment: dict,
         labels: dict,
         restart_policy: dict,
-        mem_limit: str,
+        resources: ContainerResources,
         command: list[str] | None = None,
         ports: dict | None = None,
     ) -> Container:
@@ -217,7 +646,7 @@ class Engine:
             "config": {"max-size": "10m", "max-file": "3"},
         }
         try:
-            self._docker_client.containers.run(
+            return self._docker_client.containers.run(
                 image,
                 name=name,
                 detach=True,
@@ -226,10 +655,10 @@ class Engine:
                 command=command,
                 labels=labels,
                 restart_policy=restart_policy,
-                mem_limit=mem_limit,
                 log_config=log_config,
                 ports=ports,
                 network=self._docker_network.name,
+                **resources,
                 healthcheck={
                     "test": [
                         "CMD",
@@ -247,67 +676,175 @@ class Engine:
                     "start_period": 60000000000,  # 60 seconds in nanoseconds
                 },
             )
-        except Exception:
+        except Exception as exc:
             raise ContainerExecutionError(
                 f"Failed to run container for instance: {name}"
-            )
+            ) from exc
 
-    def run(self, instance: DeployableInstance):
+    @staticmethod
+    def _is_image_error(error: Optional[Exception]) -> bool:
+        """
+        Whether a container failed to start because of its image, e.g. it
+        was removed or its layers do not match their digests
+        """
+        if isinstance(error, docker.errors.ImageNotFound):
+            return True
+        if isinstance(error, docker.errors.APIError):
+            return bool(IMAGE_ERROR_REGEX.search(str(error.explanation)))
+        return False
+
+    def run(self, instance: DeployableInstance) -> bool:
+        """
+        Returns whether the container was started. Image failures are
+        reported to the platform and return False.
+        """
+        with get_tracer().span(
+            "engine.run",
+            instance_id=instance.id,
+            instance_type=instance.instance_type,
+        ) as span:
+            return self._run(instance, span)
+
+    def _run(
+        self, instance: DeployableInstance, span: Span | NoopSpan
+    ) -> bool:
         instance.deployment_status = ComponentDeploymentStatus.PENDING
         instance.update_status()
 
         hub_instance = instance.get_hub_instance()
-        # Download image
-        try:
-            image_file = self._download_image(hub_instance)
-            # Load image
-            image = self._load_image(
-                image_file=image_file,
-                hub_instance_name=hub_instance.name,
-                hub_instance_version=hub_instance.version,
+        span.set_attribute("hub_version", hub_instance.version)
+        with get_tracer().span("image.lookup") as lookup_span:
+            image = self._image_index.get(hub_instance)
+            lookup_span.set_attribute("hit", image is not None)
+        from_index = image is not None
+        if from_index:
+            logger.info(
+                f"Image for {hub_instance.name} {hub_instance.version} already loaded, skipping download"
             )
-        except ImageError as e:
-            os.remove(image_file)
-            instance.deployment_status = ComponentDeploymentStatus.FAILED
-            instance.update_status()
-            logger.error(e)
-            return
         else:
-            os.remove(image_file)
+            try:
+                image = self._get_or_pull_image(hub_instance)
+            except ImageError as e:
+                instance.deployment_status = ComponentDeploymentStatus.FAILED
+                instance.update_status()
+                logger.error(e)
+                span.set_attribute("result", "image_failed")
+                return False
 
         # Run container
         logger.info(
             f"Running container for {instance.instance_type}: {instance.id}"
         )
-        self._run_container(
-            image=image,
-            name=instance.id,
-            environment=self._get_environment(instance),
-            labels=self._get_labels(instance),
-            command=self._get_command(instance),
-            restart_policy=self._get_instance_restart_policy(instance),
-            mem_limit=self._get_mem_limit(instance),
-            ports=self._get_ports(instance),
-            # TODO: add cpu limit
-        )
+        with (
+            self._container_slots,
+            ENGINE_CONTAINER_START_SECONDS.time(),
+            get_tracer().span("container.run") as run_span,
+        ):
+            pinned_cpus = self._allocate_cpus(instance)
+            labels = self._get_labels(instance)
+            if pinned_cpus:
+                labels[PINNED_CPUS_LABEL] = format_cpu_list(pinned_cpus)
+                run_span.set_attribute("cpus", labels[PINNED_CPUS_LABEL])
+            resources = self._get_resources(instance, pinned_cpus)
+            try:
+                container = self._run_container(
+                    image=image,
+                    name=instance.id,
+                    environment=self._get_environment(instance),
+                    labels=labels,
+                    command=self._get_command(instance),
+                    restart_policy=self._get_instance_restart_policy(instance),
+                    resources=resources,
+                    ports=self._get_ports(instance),
+                )
+            except ContainerExecutionError as exc:
+                self._release_cpus(instance)
+                # force a new download on the next run only when the indexed
+                # image itself is gone or corrupt, other errors are retried
+                # with the same image
+                if from_index and self._is_image_error(exc.__cause__):
+                    self._image_index.invalidate(hub_instance)
+                raise
+            if self._cpuset_allocator and not pinned_cpus:
+                self._track_shared_cpuset(container, resources)
+        if span.sampled:
+            # traced in the background, the action does not wait for the
+            # health check start period
+            context = contextvars.copy_context()
+            Thread(
+                target=context.run,
+                args=(self._trace_health, container),
+                daemon=True,
+            ).start()
+        span.set_attribute("result", "started")
+        return True
+
+    def _wait_for_health(self, container: Container) -> str:
+        """
+        Wait until the health check of a started container passes or fails
+        and return its health status, or the container state if it is no
+        longer running
+        """
+        deadline = time.monotonic() + self.HEALTH_TIMEOUT
+        while True:
+            try:
+                container.reload()
+            except docker.errors.NotFound:
+                return "removed"
+            state = container.attrs.get("State") or {}
+            if state.get("Status") != "running":
+                return state.get("Status", "unknown")
+            health = (state.get("Health") or {}).get("Status", "none")
+            if health != "starting" or time.monotonic() > deadline:
+                return health
+            time.sleep(self.HEALTH_POLL_INTERVAL)
+
+    def _trace_health(self, container: Container) -> None:
+        """
+        Record the time from the container start until it is healthy, as a
+        child of the span that started it
+        """
+        try:
+            with get_tracer().span("container.health") as span:
+                span.set_attribute("health", self._wait_for_health(container))
+        except Exception as e:
+            logger.debug(f"Could not trace the health of {container.id}: {e}")
 
-    def handle_action(self, action: EngineAction):
+    def handle_action(self, action: EngineAction) -> bool:
+        """
+        Returns whether the action was applied
+        """
         handler = self.handlers.get(action.type)
         if not handler:
             raise InvalidActionError(f"Invalid action type: {action.type}")
-        handler(action.instance)
-
-    def stop(self, instance: DeployableInstance) -> None:
+        return handler(action.instance)
+
+    def stop(self, instance: DeployableInstance) -> bool:
+        with get_tracer().span(
+            "engine.stop",
+            instance_id=instance.id,
+            instance_type=instance.instance_type,
+        ) as span:
+            self._stop_instance(instance, span)
+        return True
+
+    def _stop_instance(
+        self, instance: DeployableInstance, span: Span | NoopSpan
+    ) -> None:
         containers = self._get_deployed_containers(instance)
+        span.set_attribute("containers", len(containers))
         if not containers:
+            self._release_cpus(instance)
             return
         try:
             for container in containers:
                 logger.info(
                     f"Stopping container for {instance.instance_type}: {instance.id}"
                 )
-                container.stop()
-                container.remove()
+                with self._container_slots:
+                    container.stop()
+                    container.remove()
+            self._release_cpus(instance)
             instance.deployment_status = ComponentDeploymentStatus.STOPPED
             instance.update_status()
         except Exception:
@@ -315,10 +852,15 @@ class Engine:
                 f"Failed to stop container for {instance.instance_type}: {instance.id}"
             )
 
-    def restart(self, instance: DeployableInstance) -> None:
+    def restart(self, instance: DeployableInstance) -> bool:
         logger.info(f"Restarting instance: {instance.id}")
-        self.stop(instance)
-        self.run(instance)
+        with get_tracer().span(
+            "engine.restart",
+            instance_id=instance.id,
+            instance_type=instance.instance_type,
+        ):
+            self.stop(instance)
+            return self.run(instance)
 
     def _get_deployed_containers(
         self, instance: Optional[DeployableInstance] = None
@@ -332,11 +874,17 @@ class Engine:
         )
         return containers
 
-    def get_instance_hash(self, instance: DeployableInstance) -> str:
-        containers = self._get_deployed_containers(instance)
-        if not containers:
-            return None
-        return containers[0].labels["StateHash"]
+    def get_snapshot(self) -> ContainerSnapshot:
+        """
+        List every container deployed by the agent with a single Docker API
+        call. Containers are not inspected, only the list data is used.
+        """
+        containers = self._docker_client.containers.list(
+            filters={"label": [f"AgentID={self._compute_node.id}"]},
+            all=True,
+            sparse=True,
+        )
+        return ContainerSnapshot(containers)
 
     def stop_all(self) -> List[DeployableInstance]:
         """
@@ -345,12 +893,11 @@ class Engine:
         setopped_instances: List[DeployableInstance] = []
         deployed_containers = self._get_deployed_containers()
         for container in deployed_containers:
-            instance_id = container.labels.get("ComponentID", None)
-            if not instance_id:
-                instance_id = container.labels.get("ServerID", None)
-                instance = Server(id=instance_id)
-            else:
-                instance = Component(id=instance_id)
+            deployed = get_instance_from_labels(container.labels)
+            if deployed is None:
+                continue
+            model, instance_id = deployed
+            instance = partial(model)(id=instance_id)
             try:
                 self.stop(instance)
                 setopped_instances.append(instance)
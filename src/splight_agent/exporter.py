@@ -1,29 +1,279 @@
-from threading import Thread
-from typing import Optional, Tuple
+import asyncio
+import os
+import queue
+import re
+import time
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+from typing import Optional, Tuple, Type
 
 from docker import from_env
+from requests import RequestException
 
+from splight_agent.aio import AsyncDockerClient
+from splight_agent.convergence import get_convergence_tracker
 from splight_agent.logging import SplightLogger
+from splight_agent.metrics import (
+    EXPORTER_EVENTS,
+    EXPORTER_OVERFLOWS,
+    EXPORTER_PUBLISHED,
+    EXPORTER_QUEUE_DEPTH,
+    EXPORTER_SKIPPED,
+)
 from splight_agent.models import (
-    Component,
     ComponentDeploymentStatus,
     ComputeNode,
     ContainerEventAction,
+    DeployableInstance,
+    get_instance_from_labels,
     partial,
 )
+from splight_agent.rest_client import is_rejected
 
 logger = SplightLogger()
 
+EXIT_CODE_REGEX = re.compile(r"Exited \((\d+)\)")
+
+# instance model and id
+InstanceKey = Tuple[Type[DeployableInstance], str]
+
+
+class StatusCoalescer:
+    """
+    Keeps only the last status received for each instance during a short
+    window, and drops statuses equal to the last one confirmed by the API
+    """
+
+    def __init__(
+        self,
+        window: float,
+        confirmed_cache_size: int,
+        retry_delay: float = 1.0,
+        max_retry_delay: float = 60.0,
+    ) -> None:
+        self._window = window
+        self._confirmed_cache_size = confirmed_cache_size
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._lock = Lock()
+        # instance key -> (status, time at which it is sent)
+        self._pending: dict[
+            InstanceKey, Tuple[ComponentDeploymentStatus, float]
+        ] = {}
+        # instance key -> time of the oldest event not published yet
+        self._event_times: dict[InstanceKey, float] = {}
+        self._confirmed: OrderedDict[
+            InstanceKey, ComponentDeploymentStatus
+        ] = OrderedDict()
+        # instances with a status being published
+        self._in_flight: set[InstanceKey] = set()
+        # instance key -> consecutive failed publishes
+        self._failures: dict[InstanceKey, int] = {}
+        self.skipped = 0
+
+    def add(
+        self,
+        instance_key: InstanceKey,
+        deployment_status: ComponentDeploymentStatus,
+        event_time: Optional[float] = None,
+    ) -> None:
+        with self._lock:
+            # the window starts with the first status of the instance
+            _, deadline = self._pending.get(
+                instance_key, (None, time.monotonic() + self._window)
+            )
+            self._pending[instance_key] = (deployment_status, deadline)
+            if event_time is not None:
+                self._event_times.setdefault(instance_key, event_time)
+
+    def pop_ready(self) -> dict[InstanceKey, ComponentDeploymentStatus]:
+        now = time.monotonic()
+        ready = {}
+        with self._lock:
+            for instance_key, (status, deadline) in list(
+                self._pending.items()
+            ):
+                # wait for the previous status of the instance to be
+                # published, so updates are never reordered
+                if deadline > now or instance_key in self._in_flight:
+                    continue
+                del self._pending[instance_key]
+                if self._confirmed.get(instance_key) == status:
+                    self._event_times.pop(instance_key, None)
+                    self.skipped += 1
+                    continue
+                ready[instance_key] = status
+                self._in_flight.add(instance_key)
+        return ready
+
+    def done(self, instance_key: InstanceKey) -> None:
+        with self._lock:
+            self._in_flight.discard(instance_key)
+            # a status requeued or received while this one was being
+            # published keeps the older event time, which is still safe to
+            # replay from
+            if instance_key not in self._pending:
+                self._event_times.pop(instance_key, None)
+
+    def oldest_unpublished(self) -> Optional[float]:
+        """
+        Time of the oldest event whose status was not published yet
+        """
+        with self._lock:
+            return min(self._event_times.values(), default=None)
+
+    def requeue(
+        self,
+        instance_key: InstanceKey,
+        deployment_status: ComponentDeploymentStatus,
+        delay: Optional[float] = None,
+    ) -> None:
+        """
+        Put back a status that could not be published, unless a newer one
+        was received in the meantime. Its event time is kept until a status
+        of the instance is published.
+        """
+        if delay is None:
+            delay = self._window
+        with self._lock:
+            self._in_flight.discard(instance_key)
+            self._pending.setdefault(
+                instance_key, (deployment_status, time.monotonic() + delay)
+            )
+
+    def retry(
+        self,
+        instance_key: InstanceKey,
+        deployment_status: ComponentDeploymentStatus,
+    ) -> float:
+        """
+        Requeue a status the API failed to update, backing off exponentially
+        with the consecutive failures of the instance. Returns the delay.
+        """
+        with self._lock:
+            failures = self._failures.get(instance_key, 0) + 1
+            self._failures[instance_key] = failures
+        delay = min(
+            self._retry_delay * 2 ** (failures - 1), self._max_retry_delay
+        )
+        self.requeue(instance_key, deployment_status, delay=delay)
+        return delay
+
+    def time_to_next(self, default: float) -> float:
+        with self._lock:
+            if not self._pending:
+                return default
+            deadlines = [
+                deadline
+                for instance_key, (_, deadline) in self._pending.items()
+                if instance_key not in self._in_flight
+            ]
+        if not deadlines:
+            return default
+        return max(min(deadlines) - time.monotonic(), 0)
+
+    def confirm(
+        self,
+        instance_key: InstanceKey,
+        deployment_status: ComponentDeploymentStatus,
+    ) -> None:
+        with self._lock:
+            self._failures.pop(instance_key, None)
+            self._confirmed[instance_key] = deployment_status
+            self._confirmed.move_to_end(instance_key)
+            while len(self._confirmed) > self._confirmed_cache_size:
+                self._confirmed.popitem(last=False)
+
+    def forget(self, instance_key: InstanceKey) -> None:
+        """
+        Drop the confirmed status, e.g. when a new container is created and
+        the platform status was set by someone else
+        """
+        with self._lock:
+            self._confirmed.pop(instance_key, None)
+
+
+class PublishMetrics:
+    """
+    Counters of the exporter publishing pipeline
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self.events = 0
+        self.published = 0
+        self.overflows = 0
+        self.max_queue_depth = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record_event(self) -> None:
+        with self._lock:
+            self.events += 1
+
+    def record_overflow(self) -> None:
+        with self._lock:
+            self.overflows += 1
+
+    def record_queue_depth(self, depth: int) -> None:
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def record_publish(self, count: int, seconds: float) -> None:
+        with self._lock:
+            self.published += count
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+
 
 class Exporter:
     """
-    The exporter is responsible for notifying the platform about the deployment status of components
+    The exporter is responsible for notifying the platform about the deployment status of components and servers
     """
 
-    def __init__(self, compute_node: ComputeNode) -> None:
+    def __init__(
+        self,
+        compute_node: ComputeNode,
+        coalesce_window: float = 1.0,
+        confirmed_cache_size: int = 1024,
+        bulk_update: bool = False,
+        queue_size: int = 1000,
+        publishers: int = 4,
+        max_replay_gap: float = 600,
+        cursor_file: Optional[str] = None,
+    ) -> None:
         self._compute_node = compute_node
         self._client = from_env()
         self._thread = Thread(target=self._run_event_loop, daemon=True)
+        self._flusher_thread = Thread(target=self._flush_forever, daemon=True)
+        self._publishers = publishers
+        # statuses ready to be published, consumed by the publisher workers
+        self._queue: queue.Queue[
+            dict[InstanceKey, ComponentDeploymentStatus]
+        ] = queue.Queue(maxsize=queue_size)
+        # used instead in the asyncio runtime, where the statuses are
+        # queued and consumed from the event loop
+        self._async_queue: Optional[
+            asyncio.Queue[dict[InstanceKey, ComponentDeploymentStatus]]
+        ] = None
+        self._queue_size = queue_size
+        self.metrics = PublishMetrics()
+        EXPORTER_QUEUE_DEPTH.set_function(lambda: self.queue_depth)
+        self._max_replay_gap = max_replay_gap
+        self._cursor_file = cursor_file
+        self._cursor = self._load_cursor()
+        self._cursor_saved_at = 0.0
+        self._cursor_lock = Lock()
+        self._coalescer = StatusCoalescer(
+            window=coalesce_window, confirmed_cache_size=confirmed_cache_size
+        )
+        # exported from the counters kept by the pipeline itself
+        EXPORTER_EVENTS.set_function(lambda: self.metrics.events)
+        EXPORTER_PUBLISHED.set_function(lambda: self.metrics.published)
+        EXPORTER_OVERFLOWS.set_function(lambda: self.metrics.overflows)
+        EXPORTER_SKIPPED.set_function(lambda: self._coalescer.skipped)
+        self._bulk_update = bulk_update
+        self._stop = Event()
         self._transition_map = {
             ContainerEventAction.CREATE: lambda event: ComponentDeploymentStatus.PENDING,
             ContainerEventAction.START: lambda event: ComponentDeploymentStatus.RUNNING,
@@ -31,28 +281,33 @@ class Exporter:
             ContainerEventAction.DIE: self._process_die_event,
         }
         self._stopped_containers = set()
+        # containers created and not started yet
+        self._created_containers = set()
 
     @property
     def _filters(self) -> dict:
+        # label filters are ANDed, the deploy label is checked when parsing
         return {
-            "label": [
-                f"AgentID={self._compute_node.id}",
-                "ComponentID",
-                "Legacy",
-            ],
+            "type": ["container"],
+            "label": [f"AgentID={self._compute_node.id}"],
             "event": [a.value for a in ContainerEventAction],
         }
 
     def _parse_event(
         self, event: dict
-    ) -> Tuple[str, ComponentDeploymentStatus]:
+    ) -> Tuple[InstanceKey, ComponentDeploymentStatus]:
         action = ContainerEventAction(event["Action"])
-        component_id: str = event["Actor"]["Attributes"]["ComponentID"]
+        instance_key = get_instance_from_labels(event["Actor"]["Attributes"])
+        if instance_key is None:
+            raise ValueError("Container has no deploy label")
+        model, instance_id = instance_key
+        if action == ContainerEventAction.CREATE:
+            self._coalescer.forget(instance_key)
         deployment_status = self._transition_map[action](event)
         logger.info(
-            f"Received event for component {component_id}: {action} -> {deployment_status}"
+            f"Received event for {model.__name__} {instance_id}: {action} -> {deployment_status}"
         )
-        return component_id, deployment_status
+        return instance_key, deployment_status
 
     def _process_stop_event(self, event: dict) -> None:
         container_id = event["Actor"]["ID"]
@@ -70,30 +325,354 @@ class Exporter:
             return ComponentDeploymentStatus.SUCCEEDED
         return ComponentDeploymentStatus.FAILED
 
-    def _get_component_from_event(self, event: dict) -> Optional[Component]:
+    def _load_cursor(self) -> Optional[float]:
+        if not self._cursor_file:
+            return None
+        try:
+            with open(self._cursor_file) as fid:
+                return float(fid.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def _save_cursor(self, force: bool = False) -> None:
+        """
+        Persist the time of the oldest event whose status was not published
+        yet, or of the last event read if every status was published, so a
+        restarted agent replays every transition it did not publish
+        """
+        if not self._cursor_file:
+            return
+        with self._cursor_lock:
+            # written at most once per second
+            if not force and time.monotonic() - self._cursor_saved_at < 1:
+                return
+            times = [
+                t
+                for t in (self._coalescer.oldest_unpublished(), self._cursor)
+                if t is not None
+            ]
+            if not times:
+                return
+            cursor = min(times)
+            self._cursor_saved_at = time.monotonic()
+            try:
+                os.makedirs(os.path.dirname(self._cursor_file), exist_ok=True)
+                tmp_path = f"{self._cursor_file}.tmp"
+                with open(tmp_path, "w") as fid:
+                    fid.write(f"{cursor:.9f}")
+                os.replace(tmp_path, self._cursor_file)
+            except OSError as e:
+                logger.warning(f"Could not save exporter cursor: {e}")
+
+    @staticmethod
+    def _get_event_time(event: dict) -> Optional[float]:
+        if "timeNano" in event:
+            return event["timeNano"] / 1e9
+        if "time" in event:
+            return float(event["time"])
+        return None
+
+    @staticmethod
+    def _get_container_status(
+        container: dict,
+    ) -> Optional[ComponentDeploymentStatus]:
+        state = container.get("State")
+        if state == "created":
+            return ComponentDeploymentStatus.PENDING
+        if state == "running":
+            return ComponentDeploymentStatus.RUNNING
+        if state in ("exited", "dead"):
+            match = EXIT_CODE_REGEX.search(container.get("Status", ""))
+            if match and match.group(1) == "0":
+                return ComponentDeploymentStatus.SUCCEEDED
+            return ComponentDeploymentStatus.FAILED
+        return None
+
+    def _reconcile(self) -> None:
         """
-        Returns a partial Component object or None if the event is not parsable
+        Set the status of every container from a single listing, used when
+        too many events were missed to replay them
         """
+        containers = self._client.api.containers(
+            all=True,
+            filters={"label": [f"AgentID={self._compute_node.id}"]},
+        )
+        for container in containers:
+            instance_key = get_instance_from_labels(
+                container.get("Labels") or {}
+            )
+            deployment_status = self._get_container_status(container)
+            if instance_key and deployment_status:
+                self._coalescer.add(instance_key, deployment_status)
+        logger.info(f"Reconciled the status of {len(containers)} containers")
+
+    def _resume_point(self) -> Optional[float]:
+        """
+        Timestamp to replay events from, None to only read new events
+        """
+        if self._cursor is None:
+            return None
+        gap = time.time() - self._cursor
+        if gap > self._max_replay_gap:
+            logger.warning(
+                f"Missed {gap:.0f}s of Docker events, reconciling container states"
+            )
+            self._reconcile()
+            self._cursor = None
+            return None
+        logger.info(f"Replaying Docker events since {self._cursor:.3f}")
+        return self._cursor
+
+    def _handle_event(self, event: dict) -> None:
+        self.metrics.record_event()
+        event_time = self._get_event_time(event)
         try:
-            component_id, deployment_status = self._parse_event(event)
+            instance_key, deployment_status = self._parse_event(event)
         except (KeyError, ValueError) as e:
             logger.warning(f"Could not parse event: {e}")
+        else:
+            self._track_convergence(event, instance_key)
+            self._coalescer.add(instance_key, deployment_status, event_time)
+        if event_time is not None:
+            self._cursor = event_time
+        self._save_cursor()
+
+    def _track_convergence(
+        self, event: dict, instance_key: InstanceKey
+    ) -> None:
+        """
+        Only the first start of a container created by the agent counts as
+        running, restarts by the restart policy have no create event
+        """
+        container_id = event["Actor"].get("ID")
+        action = event["Action"]
+        if action == ContainerEventAction.CREATE:
+            self._created_containers.add(container_id)
+        elif action == ContainerEventAction.START:
+            if container_id not in self._created_containers:
+                return
+            self._created_containers.discard(container_id)
+            model, instance_id = instance_key
+            get_convergence_tracker().running(
+                model.__name__.lower(), instance_id
+            )
+        elif action == ContainerEventAction.DIE:
+            self._created_containers.discard(container_id)
+
+    def _publish_one(
+        self,
+        instance_key: InstanceKey,
+        deployment_status: ComponentDeploymentStatus,
+    ) -> None:
+        model, instance_id = instance_key
+        instance = partial(model)(
+            id=instance_id, deployment_status=deployment_status
+        )
+        try:
+            instance.update_status()
+        except RequestException as e:
+            if is_rejected(e):
+                logger.error(
+                    f"Status of {model.__name__} {instance_id} rejected: {e}"
+                )
+                return
+            # kept unpublished, so the cursor does not move past its event
+            delay = self._coalescer.retry(instance_key, deployment_status)
+            logger.warning(
+                f"Could not update status of {model.__name__} {instance_id}, retrying in {delay:.0f}s: {e}"
+            )
+            return
+        except Exception as e:
+            logger.error(
+                f"Could not update status of {model.__name__} {instance_id}: {e}"
+            )
+            return
+        self._coalescer.confirm(instance_key, deployment_status)
+
+    def _publish_bulk(
+        self,
+        model: Type[DeployableInstance],
+        statuses: dict[InstanceKey, ComponentDeploymentStatus],
+    ) -> None:
+        try:
+            model.bulk_update_status(
+                {
+                    instance_id: deployment_status
+                    for (_, instance_id), deployment_status in statuses.items()
+                }
+            )
+        except Exception as e:
+            logger.warning(
+                f"Bulk status update failed, updating one by one: {e}"
+            )
+            for instance_key, deployment_status in statuses.items():
+                self._publish_one(instance_key, deployment_status)
+            return
+        for instance_key, deployment_status in statuses.items():
+            self._coalescer.confirm(instance_key, deployment_status)
+
+    def _publish(
+        self, statuses: dict[InstanceKey, ComponentDeploymentStatus]
+    ) -> None:
+        by_model: dict[
+            Type[DeployableInstance],
+            dict[InstanceKey, ComponentDeploymentStatus],
+        ] = {}
+        for instance_key, deployment_status in statuses.items():
+            by_model.setdefault(instance_key[0], {})[
+                instance_key
+            ] = deployment_status
+        for model, model_statuses in by_model.items():
+            if self._bulk_update and len(model_statuses) > 1:
+                self._publish_bulk(model, model_statuses)
+                continue
+            for instance_key, deployment_status in model_statuses.items():
+                self._publish_one(instance_key, deployment_status)
+
+    def _flush(self) -> None:
+        """
+        Move the statuses that are ready to the publishing queue. Event
+        reading never waits on it: if the queue is full the statuses go back
+        to the coalescer and are retried later.
+        """
+        ready = self._coalescer.pop_ready()
+        if not ready:
+            return
+        items = (
+            [ready]
+            if self._bulk_update
+            else [{k: v} for k, v in ready.items()]
+        )
+        delayed = 0
+        for item in items:
+            try:
+                self._put_item(item)
+            except (queue.Full, asyncio.QueueFull):
+                self.metrics.record_overflow()
+                delayed += len(item)
+                for instance_key, deployment_status in item.items():
+                    self._coalescer.requeue(instance_key, deployment_status)
+        if delayed:
+            logger.warning(
+                f"Exporter queue is full, delaying {delayed} statuses"
+            )
+        self.metrics.record_queue_depth(self.queue_depth)
+
+    def _put_item(
+        self, item: dict[InstanceKey, ComponentDeploymentStatus]
+    ) -> None:
+        if self._async_queue is not None:
+            self._async_queue.put_nowait(item)
+        else:
+            self._queue.put_nowait(item)
+
+    def _flush_forever(self) -> None:
+        while not self._stop.is_set():
+            self._stop.wait(self._coalescer.time_to_next(default=1.0))
+            self._flush()
+
+    def _publish_item(
+        self, statuses: dict[InstanceKey, ComponentDeploymentStatus]
+    ) -> None:
+        start = time.monotonic()
+        try:
+            self._publish(statuses)
+        finally:
+            for instance_key in statuses:
+                self._coalescer.done(instance_key)
+            self.metrics.record_publish(
+                len(statuses), time.monotonic() - start
+            )
+            self._save_cursor()
+
+    def _next_item(
+        self, timeout: float
+    ) -> Optional[dict[InstanceKey, ComponentDeploymentStatus]]:
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
             return None
-        return partial(Component)(
-            id=component_id,
-            deployment_status=deployment_status,
+
+    def _publish_forever(self) -> None:
+        while not self._stop.is_set():
+            item = self._next_item(timeout=1.0)
+            if item is not None:
+                self._publish_item(item)
+
+    @property
+    def queue_depth(self) -> int:
+        if self._async_queue is not None:
+            return self._async_queue.qsize()
+        return self._queue.qsize()
+
+    def _read_events(self) -> None:
+        events = self._client.events(
+            decode=True, filters=self._filters, since=self._resume_point()
         )
+        for event in events:
+            self._handle_event(event)
+            if self._stop.is_set():
+                return
 
     def _run_event_loop(self) -> None:
-        for event in self._client.events(decode=True, filters=self._filters):
-            component = self._get_component_from_event(event)
-            if component:
-                component.update_status()
+        attempt = 0
+        while not self._stop.is_set():
+            start = time.monotonic()
+            try:
+                self._read_events()
+                logger.warning("Docker event stream closed")
+            except Exception as e:
+                logger.warning(f"Docker event stream failed: {e}")
+            # a stream that lasted a while resets the backoff
+            attempt = 1 if time.monotonic() - start > 60 else attempt + 1
+            self._stop.wait(min(2**attempt, 30))
+
+    async def _flush_forever_async(self) -> None:
+        while True:
+            await asyncio.sleep(self._coalescer.time_to_next(default=1.0))
+            self._flush()
+
+    async def _publish_forever_async(self) -> None:
+        # waiting on the queue does not hold a worker thread, only the
+        # publishing itself runs in one
+        while True:
+            item = await self._async_queue.get()
+            await asyncio.to_thread(self._publish_item, item)
+
+    async def run_async(self) -> None:
+        """
+        Read Docker events from the daemon socket as an asyncio task, until
+        it is cancelled
+        """
+        logger.info("Exporter started")
+        self._async_queue = asyncio.Queue(maxsize=self._queue_size)
+        client = AsyncDockerClient()
+        tasks = [asyncio.create_task(self._flush_forever_async())] + [
+            asyncio.create_task(self._publish_forever_async())
+            for _ in range(self._publishers)
+        ]
+        try:
+            since = await asyncio.to_thread(self._resume_point)
+            async for event in client.events(
+                filters=self._filters, since=since
+            ):
+                self._handle_event(event)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._save_cursor(force=True)
 
     def start(self) -> None:
         """
         Launch the exporter daemon thread
         """
+        self._flusher_thread.start()
+        for index in range(self._publishers):
+            Thread(
+                target=self._publish_forever,
+                name=f"exporter-publisher-{index}",
+                daemon=True,
+            ).start()
         self._thread.start()
         logger.info("Exporter started")
 
@@ -102,4 +681,6 @@ class Exporter:
         Stop the exporter daemon thread
         TODO: find a proper way to stop the thread
         """
+        self._stop.set()
+        self._save_cursor(force=True)
         logger.info("Exporter stopped")
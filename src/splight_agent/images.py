@@ -0,0 +1,113 @@
+import hashlib
+import re
+import time
+from threading import Lock
+from typing import Iterable, Iterator, Optional, Tuple
+
+import docker
+from docker.models.images import Image
+
+from splight_agent.logging import SplightLogger
+from splight_agent.models import HubInstance
+
+logger = SplightLogger(__name__)
+
+
+class ImageIndex:
+    """
+    Index of the hub images already loaded in the local Docker daemon.
+    Loaded images are tagged with the hub instance id and version, so the
+    index lives in the daemon itself and survives agent restarts.
+    """
+
+    REPOSITORY = "splight-hub"
+
+    def __init__(self, client: docker.DockerClient) -> None:
+        self._client = client
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def _get_reference(self, hub_instance: HubInstance) -> Tuple[str, str]:
+        repository = f"{self.REPOSITORY}/{hub_instance.id}".lower()
+        # docker tags only allow [A-Za-z0-9_.-] and up to 128 characters
+        tag = re.sub(r"[^A-Za-z0-9_.-]", "_", hub_instance.version)[:128]
+        return repository, tag
+
+    def get(self, hub_instance: HubInstance) -> Optional[Image]:
+        """
+        Returns the loaded image for the hub instance version or None if it
+        is not present locally
+        """
+        repository, tag = self._get_reference(hub_instance)
+        try:
+            image = self._client.images.get(f"{repository}:{tag}")
+        except docker.errors.ImageNotFound:
+            with self._lock:
+                self._misses += 1
+            return None
+        with self._lock:
+            self._hits += 1
+        return image
+
+    def add(self, hub_instance: HubInstance, image: Image) -> None:
+        repository, tag = self._get_reference(hub_instance)
+        try:
+            image.tag(repository, tag=tag)
+        except docker.errors.APIError as e:
+            logger.warning(
+                f"Could not index image for {hub_instance.name} {hub_instance.version}: {e}"
+            )
+
+    def invalidate(self, hub_instance: HubInstance) -> None:
+        """
+        Remove the index entry for the hub instance version, e.g. when the
+        image is corrupt. The next run downloads the image again.
+        """
+        repository, tag = self._get_reference(hub_instance)
+        try:
+            self._client.images.remove(f"{repository}:{tag}", force=True)
+        except docker.errors.ImageNotFound:
+            return
+        except docker.errors.APIError as e:
+            logger.warning(
+                f"Could not invalidate image for {hub_instance.name} {hub_instance.version}: {e}"
+            )
+            return
+        logger.info(
+            f"Invalidated image for {hub_instance.name} {hub_instance.version}"
+        )
+
+    @property
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"hits": self._hits, "misses": self._misses}
+
+
+class HashingStream:
+    """
+    Wraps an iterable of chunks and computes their sha256 and total size as
+    they are consumed, and the time spent waiting for them
+    """
+
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        self._chunks = chunks
+        self._sha256 = hashlib.sha256()
+        self.size = 0
+        self.read_seconds = 0.0
+
+    def __iter__(self) -> Iterator[bytes]:
+        chunks = iter(self._chunks)
+        while True:
+            start = time.monotonic()
+            chunk = next(chunks, None)
+            self.read_seconds += time.monotonic() - start
+            if chunk is None:
+                return
+            self._sha256.update(chunk)
+            self.size += len(chunk)
+            yield chunk
+
+    @property
+    def hexdigest(self) -> str:
+        return self._sha256.hexdigest()
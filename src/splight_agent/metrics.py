@@ -0,0 +1,371 @@
+import math
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Callable, Iterator, Optional
+
+from splight_agent.logging import SplightLogger
+
+logger = SplightLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _escape(value: str) -> str:
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    items = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+    return f"{{{items}}}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """
+    Base of the metric types, values are kept per label set or read from a
+    function on every scrape
+    """
+
+    TYPE = ""
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: tuple = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self._labelnames = labelnames
+        self._lock = Lock()
+        self._values: dict[tuple, float] = {}
+        self._function: Optional[
+            Callable[[], float | dict[tuple, float]]
+        ] = None
+        if not labelnames:
+            # unlabelled metrics are exposed from the start
+            self._values[()] = 0
+
+    def _key(self, labels: dict[str, str]) -> tuple:
+        if set(labels) != set(self._labelnames):
+            raise ValueError(
+                f"{self.name} expects labels {self._labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self._labelnames)
+
+    def set_function(
+        self, function: Callable[[], float | dict[tuple, float]]
+    ) -> None:
+        """
+        Read the value from function on every scrape, so counters kept
+        elsewhere are exported as they are. Labelled metrics expect a dict
+        from label values to value.
+        """
+        self._function = function
+
+    def _read_values(self) -> list[tuple[tuple, float]]:
+        if self._function is None:
+            with self._lock:
+                return list(self._values.items())
+        try:
+            value = self._function()
+        except Exception as e:
+            logger.debug(f"Could not read {self.name}: {e}")
+            return []
+        if isinstance(value, dict):
+            return list(value.items())
+        return [((), value)]
+
+    def _samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+        for key, value in self._read_values():
+            yield self.name, dict(zip(self._labelnames, key)), value
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.TYPE}",
+        ]
+        for name, labels, value in self._samples():
+            lines.append(
+                f"{name}{_format_labels(labels)} {_format_value(value)}"
+            )
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        buckets: tuple = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label set -> (count per bucket, sum)
+        self._histograms: dict[tuple, tuple[list[int], float]] = {}
+        if not labelnames:
+            self._histograms[()] = ([0] * len(self._buckets), 0.0)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._histograms.get(
+                key, ([0] * len(self._buckets), 0.0)
+            )
+            for index, bound in enumerate(self._buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._histograms[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def _samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+        with self._lock:
+            histograms = [
+                (key, list(counts), total)
+                for key, (counts, total) in self._histograms.items()
+            ]
+        for key, counts, total in histograms:
+            labels = dict(zip(self._labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self._buckets, counts):
+                cumulative += count
+                yield (
+                    f"{self.name}_bucket",
+                    {**labels, "le": _format_value(bound)},
+                    cumulative,
+                )
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return (
+            "\n".join(metric.render() for metric in self._metrics.values())
+            + "\n"
+        )
+
+
+REGISTRY = MetricsRegistry()
+
+DISPATCHER_CYCLE_SECONDS = REGISTRY.register(
+    Histogram(
+        "splight_agent_dispatcher_cycle_seconds",
+        "Duration of the dispatcher reconcile cycles",
+    )
+)
+DISPATCHER_ACTIONS = REGISTRY.register(
+    Counter(
+        "splight_agent_dispatcher_actions_total",
+        "Actions dispatched to the engine",
+        ("type",),
+    )
+)
+ENGINE_DOWNLOAD_BYTES = REGISTRY.register(
+    Counter(
+        "splight_agent_engine_download_bytes_total",
+        "Bytes of images downloaded",
+    )
+)
+ENGINE_DOWNLOAD_SECONDS = REGISTRY.register(
+    Histogram(
+        "splight_agent_engine_download_seconds",
+        "Duration of the image downloads",
+    )
+)
+ENGINE_IMAGE_LOAD_SECONDS = REGISTRY.register(
+    Histogram(
+        "splight_agent_engine_image_load_seconds",
+        "Duration of the image loads, streamed loads exclude the time "
+        "waiting on the download",
+    )
+)
+ENGINE_DOCKER_CALLS = REGISTRY.register(
+    Counter(
+        "splight_agent_engine_docker_calls_total",
+        "Requests made to the Docker daemon by the engine",
+    )
+)
+ENGINE_IMAGE_INDEX_LOOKUPS = REGISTRY.register(
+    Counter(
+        "splight_agent_engine_image_index_lookups_total",
+        "Lookups of hub images already loaded in the Docker daemon",
+        ("result",),
+    )
+)
+DOWNLOAD_RETRIES = REGISTRY.register(
+    Counter(
+        "splight_agent_download_retries_total",
+        "Image download requests retried after a failure",
+    )
+)
+DOWNLOAD_RESUMED_BYTES = REGISTRY.register(
+    Counter(
+        "splight_agent_download_resumed_bytes_total",
+        "Bytes of interrupted image downloads that were not fetched again",
+    )
+)
+ENGINE_CONTAINER_START_SECONDS = REGISTRY.register(
+    Histogram(
+        "splight_agent_engine_container_start_seconds",
+        "Time to create and start a container",
+    )
+)
+EXPORTER_QUEUE_DEPTH = REGISTRY.register(
+    Gauge(
+        "splight_agent_exporter_queue_depth",
+        "Statuses waiting to be published",
+    )
+)
+EXPORTER_EVENTS = REGISTRY.register(
+    Counter(
+        "splight_agent_exporter_events_total",
+        "Docker events received by the exporter",
+    )
+)
+EXPORTER_PUBLISHED = REGISTRY.register(
+    Counter(
+        "splight_agent_exporter_published_total",
+        "Statuses published to the API",
+    )
+)
+EXPORTER_OVERFLOWS = REGISTRY.register(
+    Counter(
+        "splight_agent_exporter_overflows_total",
+        "Statuses delayed because the publishing queue was full",
+    )
+)
+EXPORTER_SKIPPED = REGISTRY.register(
+    Counter(
+        "splight_agent_exporter_skipped_total",
+        "Statuses not published because the API already had them",
+    )
+)
+HTTP_REQUEST_SECONDS = REGISTRY.register(
+    Histogram(
+        "splight_agent_http_request_seconds",
+        "Latency of the requests to the Splight API",
+        ("method", "endpoint"),
+    )
+)
+HTTP_REQUEST_ERRORS = REGISTRY.register(
+    Counter(
+        "splight_agent_http_request_errors_total",
+        "Failed requests to the Splight API",
+        ("method", "endpoint"),
+    )
+)
+HTTP_POOL_REQUESTS = REGISTRY.register(
+    Counter(
+        "splight_agent_http_pool_requests_total",
+        "Requests sent through the shared keep-alive session",
+    )
+)
+HTTP_POOL_CONNECTIONS = REGISTRY.register(
+    Counter(
+        "splight_agent_http_pool_connections_total",
+        "Connections opened by the shared keep-alive session",
+    )
+)
+BEACON_PINGS = REGISTRY.register(
+    Counter(
+        "splight_agent_beacon_pings_total",
+        "Pings sent by the beacon",
+        ("result",),
+    )
+)
+BEACON_LAST_PING_SUCCESS = REGISTRY.register(
+    Gauge(
+        "splight_agent_beacon_last_ping_success",
+        "1 if the last ping succeeded, 0 otherwise",
+    )
+)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: MetricsRegistry = REGISTRY
+
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(f"Metrics request: {format % args}")
+
+
+class MetricsServer:
+    """
+    Serves the agent metrics in the Prometheus text format
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 9464) -> None:
+        self._address = (host, port)
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def start(self) -> None:
+        self._server = ThreadingHTTPServer(self._address, _MetricsHandler)
+        self._server.daemon_threads = True
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        host, port = self._server.server_address[:2]
+        logger.info(f"Metrics server listening on {host}:{port}")
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
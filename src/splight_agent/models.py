@@ -1,27 +1,63 @@
 import hashlib
 import json
 import os
+import re
 from abc import ABC, abstractmethod
+from datetime import datetime, timezone
 from enum import Enum
-from functools import cached_property
-from typing import Any, Literal, Type, TypeVar
+from typing import Any, Iterator, Literal, Optional, Tuple, Type, TypeVar
 
 from docker.models.containers import Container
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
 from splight_agent.constants import IMAGE_DIRECTORY, EngineActionType
 from splight_agent.exceptions import DownloadError
 from splight_agent.logging import SplightLogger
-from splight_agent.rest_client import RestClient
+from splight_agent.rest_client import RestClient, get_rest_client
 from splight_agent.settings import APIVersion, settings
+from splight_agent.tracing import get_tracer
 
 logger = SplightLogger(__name__)
 
+STATE_HASH_FIELDS = (
+    "deployment_capacity",
+    "deployment_log_level",
+    "deployment_restart_policy",
+)
+
+
+def canonical_json(value: Any) -> str:
+    """
+    JSON serialization that does not depend on the key order of the data
+    """
+    return json.dumps(
+        value,
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+        default=str,
+    )
+
+
+def parse_datetime(value: Optional[str]) -> Optional[datetime]:
+    """
+    Timezone aware datetime of an ISO 8601 timestamp, naive ones are UTC
+    """
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
 
 class APIObject(BaseModel):
-    @cached_property
+    @property
     def _rest_client(self) -> RestClient:
-        return RestClient()
+        return get_rest_client()
 
 
 class HubInstance(APIObject):
@@ -29,6 +65,8 @@ class HubInstance(APIObject):
     name: str
     version: str
 
+    _VERSION_PATTERN = r"\d+\.\d+\.\d+(?:[-+][0-9A-Za-z.+-]*)?"
+
     @property
     @abstractmethod
     def _image_link(self) -> str:
@@ -38,6 +76,20 @@ class HubInstance(APIObject):
     def get_image_file(self) -> str:
         pass
 
+    @property
+    def _image_file_pattern(self) -> re.Pattern:
+        """
+        Image file names of every version of this hub instance. Versions
+        are semantic, so other hubs whose names start with this one never
+        match.
+        """
+        return re.compile(rf"{re.escape(self.name)}-{self._VERSION_PATTERN}")
+
+    def stream_image(self, chunk_size: int) -> Iterator[bytes]:
+        with get_tracer().span("image.link"):
+            image_link = self._image_link
+        return self._rest_client.stream(image_link, chunk_size=chunk_size)
+
 
 # Component
 # (only the fields that are needed for the agent)
@@ -63,12 +115,16 @@ class HubComponent(HubInstance):
             IMAGE_DIRECTORY, f"{self.name}-{self.version}"
         )
         try:
+            with get_tracer().span("image.link"):
+                image_link = self._image_link
             image = self._rest_client.download(
-                self._image_link, file_path=image_path
+                image_link,
+                file_path=image_path,
+                stale_pattern=self._image_file_pattern,
             )
         except Exception as exc:
-            for file_name in os.listdir(IMAGE_DIRECTORY):
-                os.remove(os.path.join(IMAGE_DIRECTORY, file_name))
+            # partial progress is kept so the next attempt resumes it, the
+            # partials of other versions are removed by the next download
             raise DownloadError("Unable to download docker image") from exc
         return image
 
@@ -93,12 +149,16 @@ class HubServer(HubInstance):
             server_directory, f"{self.name}-{self.version}"
         )
         try:
+            with get_tracer().span("image.link"):
+                image_link = self._image_link
             image = self._rest_client.download(
-                self._image_link, file_path=image_path
+                image_link,
+                file_path=image_path,
+                stale_pattern=self._image_file_pattern,
             )
         except Exception as exc:
-            for file_name in os.listdir(server_directory):
-                os.remove(os.path.join(server_directory, file_name))
+            # partial progress is kept so the next attempt resumes it, the
+            # partials of other versions are removed by the next download
             raise DownloadError("Unable to download docker image") from exc
         return image
 
@@ -135,6 +195,9 @@ class DeployableInstance(APIObject, ABC):
     deployment_updated_at: str | None
     compute_node: str | None
 
+    _field_states: dict[str, str] | None = PrivateAttr(default=None)
+    _legacy_hash: str | None = PrivateAttr(default=None)
+
     @property
     def instance_type(self) -> str:
         return self.__class__.__name__.lower()
@@ -169,12 +232,50 @@ class DeployableInstance(APIObject, ABC):
             == __value.deployment_restart_policy
         )
 
+    def _hash_fields(self) -> list[str]:
+        return [*STATE_HASH_FIELDS, *self._COMPARABLE_FIELDS]
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        super().__setattr__(name, value)
+        if name in self._hash_fields():
+            self._field_states = None
+            self._legacy_hash = None
+
+    def _get_field_states(self) -> dict[str, str]:
+        """
+        Canonical JSON of every field in the state hash. It is cached until
+        one of those fields is set again.
+        """
+        if self._field_states is None:
+            data = self.dict(include=set(self._hash_fields()))
+            self._field_states = {
+                field: canonical_json(data[field]) for field in sorted(data)
+            }
+        return self._field_states
+
     def to_hash(self) -> str:
-        data = self.dict()
+        """
+        sha256 of the canonical JSON of the deployment state
+        """
+        field_states = self._get_field_states()
+        state = ",".join(
+            f"{json.dumps(field)}:{value}"
+            for field, value in field_states.items()
+        )
+        return hashlib.sha256(f"{{{state}}}".encode("utf-8")).hexdigest()
+
+    def to_legacy_hash(self) -> str:
+        """
+        Hash used before the canonical serialization, which depends on the
+        key order of the payload. It is cached like the field states.
+        """
+        if self._legacy_hash is not None:
+            return self._legacy_hash
+        data = self.dict(include=set(self._COMPARABLE_FIELDS))
         comparable_fields_dict = {
             field: data[field] for field in self._COMPARABLE_FIELDS
         }
-        return hashlib.sha256(
+        self._legacy_hash = hashlib.sha256(
             json.dumps(
                 {
                     "deployment_capacity": self.deployment_capacity,
@@ -184,6 +285,28 @@ class DeployableInstance(APIObject, ABC):
                 }
             ).encode("utf-8")
         ).hexdigest()
+        return self._legacy_hash
+
+    def matches_hash(self, state_hash: str) -> bool:
+        return (
+            state_hash == self.to_hash() or state_hash == self.to_legacy_hash()
+        )
+
+    def get_field_hashes(self) -> dict[str, str]:
+        return {
+            field: hashlib.sha256(value.encode("utf-8")).hexdigest()[:16]
+            for field, value in self._get_field_states().items()
+        }
+
+    def diff_fields(self, field_hashes: dict[str, str]) -> list[str]:
+        """
+        Fields whose hash is different from the given ones
+        """
+        return [
+            field
+            for field, field_hash in self.get_field_hashes().items()
+            if field_hashes.get(field) != field_hash
+        ]
 
     def update_status(self) -> None:
         if not self._INSTANCE_URL:
@@ -199,6 +322,24 @@ class DeployableInstance(APIObject, ABC):
             f"{self.instance_type} {self.id} updated with status {self.deployment_status}"
         )
 
+    @classmethod
+    def bulk_update_status(
+        cls, statuses: dict[str, ComponentDeploymentStatus]
+    ) -> None:
+        if not cls._INSTANCE_URL:
+            raise NotImplementedError(
+                "The class must define _INSTANCE_URL to update the status"
+            )
+
+        get_rest_client().post(
+            f"{cls._INSTANCE_URL}/bulk-update-status/",
+            data=[
+                {"id": instance_id, "deployment_status": status}
+                for instance_id, status in statuses.items()
+            ],
+        )
+        logger.info(f"{len(statuses)} {cls.__name__.lower()} statuses updated")
+
     def refresh(self) -> None:
         if not self._INSTANCE_URL:
             raise NotImplementedError(
@@ -212,6 +353,16 @@ class DeployableInstance(APIObject, ABC):
             if field.name in data:
                 setattr(self, field.name, data[field.name])
 
+    @classmethod
+    def retrieve(cls, id: str) -> "DeployableInstance":
+        if not cls._INSTANCE_URL:
+            raise NotImplementedError(
+                "The class must define _INSTANCE_URL to retrieve instances"
+            )
+
+        response = get_rest_client().get(f"{cls._INSTANCE_URL}/{id}/")
+        return cls(**response.json())
+
     def __str__(self) -> str:
         return f"{self.instance_type}(id={self.id}, name={self.name}, deployment_active={self.deployment_active}))"
 
@@ -258,25 +409,244 @@ class Server(DeployableInstance):
         return "ServerID"
 
 
+# container label holding the instance id -> instance model
+DEPLOY_LABEL_MODELS: dict[str, Type[DeployableInstance]] = {
+    "ComponentID": Component,
+    "ServerID": Server,
+}
+
+
+def get_instance_from_labels(
+    labels: dict[str, str]
+) -> Optional[Tuple[Type[DeployableInstance], str]]:
+    """
+    Returns the instance model and id a container was deployed for, or None
+    if it has no deploy label
+    """
+    for deploy_label, model in DEPLOY_LABEL_MODELS.items():
+        instance_id = labels.get(deploy_label)
+        if instance_id:
+            return model, instance_id
+    return None
+
+
+def fingerprint(data: Any) -> bytes:
+    """
+    Cheap digest of a raw API payload, used to detect unchanged items
+    """
+    return hashlib.blake2b(
+        json.dumps(data, default=str).encode("utf-8"), digest_size=16
+    ).digest()
+
+
+class DesiredState:
+    """
+    Compact record of the desired state of an instance. The full model, with
+    its input/config payload, is only built when an action needs it.
+    """
+
+    __slots__ = (
+        "id",
+        "model",
+        "deployment_active",
+        "deployment_status",
+        "deployment_updated_at",
+        "state_hash",
+        "legacy_hash",
+        "fingerprint",
+        "_raw",
+        "_instance",
+    )
+
+    def __init__(
+        self,
+        instance: DeployableInstance,
+        raw_fingerprint: bytes,
+    ) -> None:
+        self.id = instance.id
+        self.model = type(instance)
+        self.deployment_active = instance.deployment_active
+        self.deployment_status = instance.deployment_status
+        self.deployment_updated_at = instance.deployment_updated_at
+        self.state_hash = instance.to_hash()
+        # containers started before the canonical hash carry this one
+        self.legacy_hash = instance.to_legacy_hash()
+        self.fingerprint = raw_fingerprint
+        self._raw = None
+        self._instance = instance
+
+    @property
+    def instance_type(self) -> str:
+        return self.model.__name__.lower()
+
+    def get_deploy_label(self) -> str:
+        return self.model.get_deploy_label(self)
+
+    @property
+    def instance(self) -> DeployableInstance:
+        """
+        The full instance model, built from the payload of the last fetch
+        or retrieved from the API when the payload was already released
+        """
+        if self._instance is None:
+            if self._raw is not None:
+                self._instance = self.model(**self._raw)
+            else:
+                self._instance = self.model.retrieve(self.id)
+        return self._instance
+
+    def matches_hash(self, state_hash: str) -> bool:
+        return state_hash in (self.state_hash, self.legacy_hash)
+
+    def reuse(self, raw: dict) -> None:
+        """
+        Keep the record for an unchanged payload, without validating it
+        """
+        self._raw = raw
+        self._instance = None
+
+    def release(self) -> None:
+        """
+        Drop the payload and the full model
+        """
+        self._raw = None
+        self._instance = None
+
+
+class DesiredStateTable:
+    """
+    Local copy of the instances deployed in a compute node, with the
+    validators needed to fetch only what changed since the last request
+    """
+
+    def __init__(self) -> None:
+        self.records: dict[str, DesiredState] = {}
+        self.etag: str | None = None
+        self.last_modified: str | None = None
+        self.high_water_mark: datetime | None = None
+        self.incremental_fetches = 0
+
+    def _update_high_water_mark(self, records: list[DesiredState]) -> None:
+        # compared as datetimes, the API may mix "Z" and "+00:00" and the
+        # precision of the fractional seconds
+        updated_at = [
+            parsed
+            for r in records
+            if (parsed := parse_datetime(r.deployment_updated_at)) is not None
+        ]
+        if self.high_water_mark is not None:
+            updated_at.append(self.high_water_mark)
+        self.high_water_mark = max(updated_at, default=None)
+
+    def parse(
+        self, items: list[dict], model: Type[DeployableInstance]
+    ) -> list[DesiredState]:
+        """
+        Build the records for the given payload. Only new or changed items
+        are validated, the rest reuse the previous record.
+        """
+        records = []
+        for item in items:
+            item_fingerprint = fingerprint(item)
+            record = self.records.get(item.get("id"))
+            if (
+                record is not None
+                and record.fingerprint == item_fingerprint
+                and record.deployment_status == item["deployment_status"]
+            ):
+                record.reuse(item)
+            else:
+                record = DesiredState(model(**item), item_fingerprint)
+            records.append(record)
+        return records
+
+    def replace(self, records: list[DesiredState]) -> None:
+        self.records = {r.id: r for r in records}
+        self.high_water_mark = None
+        self.incremental_fetches = 0
+        self._update_high_water_mark(records)
+
+    def merge(self, records: list[DesiredState]) -> None:
+        self.records.update({r.id: r for r in records})
+        self.incremental_fetches += 1
+        self._update_high_water_mark(records)
+
+    def values(self) -> list[DesiredState]:
+        return list(self.records.values())
+
+
 class ComputeNode(APIObject):
     id: str
     name: str | None = None
 
-    @property
-    def components(self) -> list[Component]:
+    _desired_state: dict[str, DesiredStateTable] = PrivateAttr(
+        default_factory=dict
+    )
+
+    def _fetch_desired_state(
+        self, resource: str, model: Type[DeployableInstance]
+    ) -> list[DesiredState]:
+        """
+        Fetch the instances of the given resource. Unchanged lists are not
+        downloaded again (HTTP 304) and, with INCREMENTAL_FETCH, only the
+        instances updated since the last fetch are requested. A full fetch
+        is done every INCREMENTAL_FULL_FETCH_EVERY requests to catch deleted
+        instances. Instances updated at the high-water mark are requested
+        again, as others may share that timestamp, and are reused without
+        validating them if they did not change.
+        """
+        table = self._desired_state.setdefault(resource, DesiredStateTable())
         url_prefix = f"{settings.API_VERSION}/engine/compute/nodes/all"
+        params, headers = {}, {}
+        incremental = (
+            settings.INCREMENTAL_FETCH
+            and table.high_water_mark is not None
+            and table.incremental_fetches
+            < settings.INCREMENTAL_FULL_FETCH_EVERY
+        )
+        if incremental:
+            params[
+                "deployment_updated_at__gte"
+            ] = table.high_water_mark.isoformat()
+        else:
+            if table.etag:
+                headers["If-None-Match"] = table.etag
+            if table.last_modified:
+                headers["If-Modified-Since"] = table.last_modified
         response = self._rest_client.get(
-            f"{url_prefix}/{self.id}/components/",
+            f"{url_prefix}/{self.id}/{resource}/",
+            params=params or None,
+            headers=headers,
         )
-        return [Component(**c) for c in response.json()]
+        if response.status_code == 304:
+            logger.debug(f"{resource} of compute node {self.id} not modified")
+            return table.values()
+        records = table.parse(response.json(), model)
+        if incremental:
+            table.merge(records)
+        else:
+            table.replace(records)
+            table.etag = response.headers.get("ETag")
+            table.last_modified = response.headers.get("Last-Modified")
+        return table.values()
+
+    def get_desired_state(self) -> list[DesiredState]:
+        return self._fetch_desired_state(
+            "components", Component
+        ) + self._fetch_desired_state("servers", Server)
+
+    @property
+    def components(self) -> list[Component]:
+        return [
+            r.instance
+            for r in self._fetch_desired_state("components", Component)
+        ]
 
     @property
     def servers(self) -> list[Server]:
-        url_prefix = f"{settings.API_VERSION}/engine/compute/nodes/all"
-        response = self._rest_client.get(
-            f"{url_prefix}/{self.id}/servers/",
-        )
-        return [Server(**s) for s in response.json()]
+        return [
+            r.instance for r in self._fetch_desired_state("servers", Server)
+        ]
 
     def report_version(self, version: str) -> None:
         url_prefix = f"{settings.API_VERSION}/engine/compute/nodes/all"
@@ -314,20 +684,69 @@ class DeployedComponent(Component):
         arbitrary_types_allowed = True
 
 
+class ContainerUsage(BaseModel):
+    container_id: str
+    instance_type: str
+    instance_id: str
+    cpu_percent: float | None = None
+    cpu_throttled_usec: int | None = None
+    memory_bytes: int | None = None
+    memory_limit_bytes: int | None = None
+    memory_percent: float | None = None
+    io_read_bytes: int | None = None
+    io_write_bytes: int | None = None
+    pids: int | None = None
+
+
 class ComputeNodeUsage(APIObject):
     compute_node: str
     timestamp: str | None = None
     cpu_percent: float
     memory_percent: float
     disk_percent: float
+    samples: int = 1
+    # min, mean, max and p95 of every sampled metric
+    stats: dict[str, dict[str, float]] = {}
+    containers: list[ContainerUsage] = []
+    # seconds from deployment changes to each convergence stage
+    convergence: dict[str, dict[str, float]] = {}
+
+    _URL_PREFIX = f"{settings.API_VERSION}/engine/compute/nodes/all"
+
+    def to_payload(self) -> dict[str, Any]:
+        data = {
+            "cpu_percent": self.cpu_percent,
+            "memory_percent": self.memory_percent,
+            "disk_percent": self.disk_percent,
+        }
+        if self.timestamp:
+            data["timestamp"] = self.timestamp
+        if self.stats:
+            data["samples"] = self.samples
+            data["stats"] = self.stats
+        if self.containers:
+            data["containers"] = [c.dict() for c in self.containers]
+        if self.convergence:
+            data["convergence"] = self.convergence
+        return data
 
     def save(self) -> None:
-        url_prefix = f"{settings.API_VERSION}/engine/compute/nodes/all"
-        self._rest_client.post(
-            f"{url_prefix}/{self.compute_node}/usage/",
-            data={
-                "cpu_percent": self.cpu_percent,
-                "memory_percent": self.memory_percent,
-                "disk_percent": self.disk_percent,
-            },
+        self.save_payload(self.compute_node, self.to_payload())
+
+    @classmethod
+    def save_payload(cls, compute_node: str, payload: dict) -> None:
+        """
+        Upload a single report that was already serialized
+        """
+        get_rest_client().post(
+            f"{cls._URL_PREFIX}/{compute_node}/usage/", data=payload
+        )
+
+    @classmethod
+    def save_batch(cls, compute_node: str, payloads: list[dict]) -> None:
+        """
+        Upload several reports in a single gzip compressed request
+        """
+        get_rest_client().post_compressed(
+            f"{cls._URL_PREFIX}/{compute_node}/usage/batch/", data=payloads
         )
@@ -1,14 +1,24 @@
+import asyncio
 import sys
+from functools import cached_property
 from importlib import metadata
 from types import FrameType
+from typing import Callable, Coroutine, Optional
 
 from splight_agent.beacon import Beacon
+from splight_agent.cpuset import (
+    CpusetAllocator,
+    parse_cpu_list,
+    read_cpu_topology,
+)
 from splight_agent.dispatcher import Dispatcher
 from splight_agent.engine import Engine
 from splight_agent.exporter import Exporter
 from splight_agent.logging import SplightLogger
+from splight_agent.metrics import MetricsServer
 from splight_agent.models import ComputeNode
 from splight_agent.settings import SplightSettings
+from splight_agent.subscription import DeploymentSubscriber
 from splight_agent.usage import UsageReporter
 
 __version__ = metadata.version("splight-agent")
@@ -19,7 +29,7 @@ logger = SplightLogger(__name__)
 class Orchestrator:
     _settings = SplightSettings()
 
-    @property
+    @cached_property
     def _compute_node(self) -> ComputeNode:
         return ComputeNode(id=self._settings.COMPUTE_NODE_ID)
 
@@ -39,6 +49,22 @@ class Orchestrator:
                 "SPLIGHT_PLATFORM_API_HOST": self._settings.SPLIGHT_PLATFORM_API_HOST,
                 "API_VERSION": self._settings.API_VERSION,
             },
+            max_downloads=self._settings.ENGINE_MAX_DOWNLOADS,
+            max_image_loads=self._settings.ENGINE_MAX_IMAGE_LOADS,
+            max_container_operations=self._settings.ENGINE_MAX_CONTAINER_OPERATIONS,
+            stream_images=self._settings.IMAGE_STREAMING,
+            stream_chunk_size=self._settings.IMAGE_STREAM_CHUNK_SIZE,
+            cpu_limits=self._settings.CPU_LIMITS,
+            memory_swap=self._settings.CONTAINER_SWAP,
+            cpuset_allocator=self._create_cpuset_allocator(),
+        )
+
+    def _create_cpuset_allocator(self) -> Optional[CpusetAllocator]:
+        if not self._settings.CPU_PINNING:
+            return None
+        return CpusetAllocator(
+            read_cpu_topology(),
+            reserved=parse_cpu_list(self._settings.CPU_PINNING_RESERVED_CPUS),
         )
 
     def _create_beacon(self) -> Beacon:
@@ -46,22 +72,55 @@ class Orchestrator:
             compute_node=self._compute_node,
             ping_interval=self._settings.API_PING_INTERVAL,
             api_version=self._settings.API_VERSION,
+            max_ping_interval=self._settings.API_MAX_PING_INTERVAL,
+            jitter=self._settings.POLL_JITTER,
         )
 
     def _create_exporter(self) -> Exporter:
-        return Exporter(compute_node=self._compute_node)
+        return Exporter(
+            compute_node=self._compute_node,
+            coalesce_window=self._settings.EXPORTER_COALESCE_WINDOW,
+            confirmed_cache_size=self._settings.EXPORTER_CONFIRMED_CACHE_SIZE,
+            bulk_update=self._settings.EXPORTER_BULK_UPDATE,
+            queue_size=self._settings.EXPORTER_QUEUE_SIZE,
+            publishers=self._settings.EXPORTER_PUBLISHERS,
+            max_replay_gap=self._settings.EXPORTER_MAX_REPLAY_GAP,
+            cursor_file=self._settings.EXPORTER_CURSOR_FILE,
+        )
 
     def _create_dispatcher(self, engine: Engine) -> Dispatcher:
         return Dispatcher(
             compute_node=self._compute_node,
             engine=engine,
             poll_interval=self._settings.API_POLL_INTERVAL,
+            max_workers=self._settings.DISPATCHER_MAX_WORKERS,
+            max_poll_interval=self._settings.API_MAX_POLL_INTERVAL,
+            poll_jitter=self._settings.POLL_JITTER,
+        )
+
+    def _create_subscriber(
+        self, dispatcher: Dispatcher
+    ) -> DeploymentSubscriber:
+        return DeploymentSubscriber(
+            compute_node=self._compute_node,
+            on_change=dispatcher.notify,
+            api_version=self._settings.API_VERSION,
+            connect_timeout=self._settings.HTTP_CONNECT_TIMEOUT,
+            read_timeout=self._settings.SUBSCRIPTION_READ_TIMEOUT,
         )
 
     def _create_usage_reporter(self) -> UsageReporter:
         return UsageReporter(
             compute_node=self._compute_node,
-            cpu_percent_samples=self._settings.CPU_PERCENT_SAMPLES,
+            sample_interval=self._settings.USAGE_SAMPLE_INTERVAL,
+            report_interval=self._settings.USAGE_REPORT_INTERVAL,
+            buffer_size=self._settings.USAGE_BUFFER_SIZE,
+            container_metrics=self._settings.CONTAINER_METRICS,
+            cgroup_root=self._settings.CGROUP_ROOT,
+            spool_dir=self._settings.USAGE_SPOOL_DIR,
+            spool_max_bytes=self._settings.USAGE_SPOOL_MAX_BYTES,
+            upload_batch_size=self._settings.USAGE_UPLOAD_BATCH_SIZE,
+            flush_interval=self._settings.USAGE_FLUSH_INTERVAL,
         )
 
     def __init__(self) -> None:
@@ -69,9 +128,72 @@ class Orchestrator:
         self._beacon = self._create_beacon()
         self._exporter = self._create_exporter()
         self._dispatcher = self._create_dispatcher(self._engine)
+        self._subscriber = None
+        if self._settings.DEPLOYMENT_SUBSCRIPTION:
+            self._subscriber = self._create_subscriber(self._dispatcher)
+            self._dispatcher.attach_subscriber(
+                self._subscriber,
+                poll_interval=self._settings.SUBSCRIPTION_POLL_INTERVAL,
+            )
+        self._metrics_server = None
+        if self._settings.METRICS_SERVER:
+            self._metrics_server = MetricsServer(
+                host=self._settings.METRICS_HOST,
+                port=self._settings.METRICS_PORT,
+            )
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._tasks: list[asyncio.Task] = []
+
+    async def _supervise(
+        self, name: str, factory: Callable[[], Coroutine]
+    ) -> None:
+        """
+        Keep a subsystem task alive, restarting it if it fails or returns
+        """
+        while True:
+            try:
+                await factory()
+                logger.warning(f"{name} task finished. Restarting...")
+            except Exception as e:
+                logger.error(f"{name} task failed: {e}. Restarting...")
+            await asyncio.sleep(self._settings.API_POLL_INTERVAL)
+
+    async def _run_tasks(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        subsystems = {
+            "Exporter": self._exporter.run_async,
+            "Beacon": self._beacon.run_async,
+            "Dispatcher": self._dispatcher.run_async,
+        }
+        if self._settings.REPORT_USAGE:
+            self._usage_reporter = self._create_usage_reporter()
+            subsystems["Usage reporter"] = self._usage_reporter.run_async
+        self._tasks = [
+            asyncio.create_task(self._supervise(name, factory), name=name)
+            for name, factory in subsystems.items()
+        ]
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        logger.info("All agent tasks cancelled")
+        # the instances are stopped only after the last actions finished
+        await asyncio.to_thread(self._dispatcher.stop)
+        await asyncio.to_thread(self._dispatcher.shutdown)
+        await asyncio.to_thread(self._stop_instances)
+
+    def _cancel_tasks(self) -> None:
+        for task in self._tasks:
+            task.cancel()
 
     def start(self):
         self._report_agent_version()
+        if self._metrics_server is not None:
+            self._metrics_server.start()
+        if self._subscriber is not None:
+            self._subscriber.start()
+        if self._settings.ASYNC_RUNTIME:
+            # all subsystems run as tasks of a single event loop
+            asyncio.run(self._run_tasks())
+            return
+
         self._exporter.start()
         self._beacon.start()
         if self._settings.REPORT_USAGE:
@@ -81,13 +203,24 @@ class Orchestrator:
         # blocking main thread
         self._dispatcher.start()
 
-    def kill(self, sig: int, frame: FrameType):
-        logger.info(f"Received signal {sig}. Gracefully stopping Agent...")
+    def _stop_instances(self) -> None:
         stopped_instances = self._engine.stop_all()
         logger.info(f"Stopped {len(stopped_instances)} components")
         logger.info("Waiting for components to be stopped in the platform...")
         self._dispatcher.wait_for_instances_to_stop(stopped_instances)
         logger.info("All components stopped")
+
+    def kill(self, sig: int, frame: FrameType):
+        logger.info(f"Received signal {sig}. Gracefully stopping Agent...")
+        if self._subscriber is not None:
+            self._subscriber.stop()
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
+        if self._loop is not None:
+            # the event loop stops the instances once its tasks are cancelled
+            self._loop.call_soon_threadsafe(self._cancel_tasks)
+            return
+        self._stop_instances()
         self._beacon.stop()
         self._exporter.stop()
         sys.exit(0)
@@ -1,24 +1,130 @@
-import sys
-from typing import Optional
+import gzip
+import json
+import re
+import time
+from contextlib import contextmanager
+from functools import cache
+from typing import Iterator, Optional
 
 import requests
-import wget
 from furl import furl
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from splight_agent.downloader import RangedDownloader
 from splight_agent.logging import SplightLogger
+from splight_agent.metrics import (
+    DOWNLOAD_RESUMED_BYTES,
+    DOWNLOAD_RETRIES,
+    HTTP_POOL_CONNECTIONS,
+    HTTP_POOL_REQUESTS,
+    HTTP_REQUEST_ERRORS,
+    HTTP_REQUEST_SECONDS,
+)
 from splight_agent.settings import settings
 
 logger = SplightLogger(__name__)
 
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# client errors that may succeed if the same request is sent again
+TRANSIENT_CLIENT_STATUS_CODES = (408, 429)
+# path segments holding ids, replaced to keep the endpoint labels bounded
+ID_SEGMENT_REGEX = re.compile(r"/[0-9a-fA-F]{8}-[0-9a-fA-F-]{27,}(?=/|$)")
 
-def bar_progress(current: float, total: float, width: int = 80):
-    progress_message = "Downloading: %d%% [%d / %d] bytes" % (
-        current / total * 100,
-        current,
-        total,
+
+def get_endpoint(path: str) -> str:
+    """
+    Path of a request with its ids replaced by a placeholder
+    """
+    return ID_SEGMENT_REGEX.sub("/{id}", str(path))
+
+
+def is_rejected(exc: Exception) -> bool:
+    """
+    Whether the request failed with a client error, so sending it again
+    will fail the same way
+    """
+    if not isinstance(exc, requests.HTTPError) or exc.response is None:
+        return False
+    status_code = exc.response.status_code
+    return (
+        400 <= status_code < 500
+        and status_code not in TRANSIENT_CLIENT_STATUS_CODES
+    )
+
+
+@cache
+def get_session() -> requests.Session:
+    """
+    Process-wide keep-alive session. Idempotent requests are retried with
+    jittered exponential backoff, honoring Retry-After on 429 and 503.
+    """
+    retry = Retry(
+        total=settings.HTTP_MAX_RETRIES,
+        backoff_factor=settings.HTTP_BACKOFF_FACTOR,
+        backoff_jitter=settings.HTTP_BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=settings.HTTP_POOL_SIZE,
+        pool_maxsize=settings.HTTP_POOL_SIZE,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+@cache
+def get_download_session() -> requests.Session:
+    """
+    Keep-alive session for hub image downloads, with a connection for every
+    range request that may run at once. The downloader retries on its own,
+    so requests are not retried here.
+    """
+    pool_size = settings.DOWNLOAD_SEGMENTS * settings.ENGINE_MAX_DOWNLOADS
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0
     )
-    sys.stdout.write("\r" + progress_message)
-    sys.stdout.flush()
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_connection_stats() -> dict[str, int]:
+    """
+    Number of requests sent through the shared session pools and the number
+    of connections opened for them. Any request above the connection count
+    reused a kept-alive connection.
+    """
+    stats = {"requests": 0, "connections": 0}
+    # the same adapter is mounted for http and https
+    adapters = {
+        id(a): a
+        for session in (get_session(), get_download_session())
+        for a in session.adapters.values()
+    }
+    for adapter in adapters.values():
+        for key in adapter.poolmanager.pools.keys():
+            try:
+                pool = adapter.poolmanager.pools[key]
+            except KeyError:
+                continue
+            stats["requests"] += pool.num_requests
+            stats["connections"] += pool.num_connections
+    stats["reused"] = max(stats["requests"] - stats["connections"], 0)
+    return stats
+
+
+HTTP_POOL_REQUESTS.set_function(lambda: get_connection_stats()["requests"])
+HTTP_POOL_CONNECTIONS.set_function(
+    lambda: get_connection_stats()["connections"]
+)
 
 
 class RestClient:
@@ -26,41 +132,132 @@ class RestClient:
     def _base_url(self) -> furl:
         return furl(settings.SPLIGHT_PLATFORM_API_HOST)
 
+    @property
+    def _timeout(self) -> tuple[float, float]:
+        return settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT
+
     @property
     def headers(self) -> dict[str, str]:
         return {
             "Authorization": f"Splight {settings.SPLIGHT_ACCESS_ID} {settings.SPLIGHT_SECRET_KEY}"
         }
 
-    def post(self, path: str, data: dict) -> requests.Response:
-        response = requests.post(
-            self._base_url / path, json=data, headers=self.headers
-        )
-        response.raise_for_status()
+    def _request(
+        self,
+        method: str,
+        path: str,
+        headers: Optional[dict[str, str]] = None,
+        **kwargs,
+    ) -> requests.Response:
+        start = time.monotonic()
+        endpoint = get_endpoint(path)
+        try:
+            response = get_session().request(
+                method,
+                self._base_url / path,
+                headers={**self.headers, **(headers or {})},
+                timeout=self._timeout,
+                **kwargs,
+            )
+            response.raise_for_status()
+        except requests.RequestException:
+            elapsed = time.monotonic() - start
+            HTTP_REQUEST_SECONDS.observe(
+                elapsed, method=method, endpoint=endpoint
+            )
+            HTTP_REQUEST_ERRORS.inc(method=method, endpoint=endpoint)
+            raise
+        elapsed = time.monotonic() - start
+        HTTP_REQUEST_SECONDS.observe(elapsed, method=method, endpoint=endpoint)
         return response
 
-    def get(
-        self, path: str, params: Optional[dict] = None
+    def post(self, path: str, data: dict | list) -> requests.Response:
+        return self._request("POST", path, json=data)
+
+    def post_compressed(
+        self, path: str, data: dict | list
     ) -> requests.Response:
-        response = requests.get(
-            self._base_url / path, headers=self.headers, params=params
+        """
+        Post the data as gzip compressed JSON
+        """
+        body = gzip.compress(json.dumps(data).encode("utf-8"))
+        return self._request(
+            "POST",
+            path,
+            headers={
+                "Content-Type": "application/json",
+                "Content-Encoding": "gzip",
+            },
+            data=body,
         )
-        response.raise_for_status()
-        return response
+
+    def get(
+        self,
+        path: str,
+        params: Optional[dict] = None,
+        headers: Optional[dict[str, str]] = None,
+    ) -> requests.Response:
+        return self._request("GET", path, params=params, headers=headers)
 
     def patch(self, path: str, data: dict) -> requests.Response:
-        response = requests.patch(
-            self._base_url / path, json=data, headers=self.headers
-        )
-        response.raise_for_status()
-        return response
+        return self._request("PATCH", path, json=data)
 
     def download(
-        self, path: str, external: bool = True, file_path: Optional[str] = None
+        self,
+        path: str,
+        external: bool = True,
+        file_path: Optional[str] = None,
+        stale_pattern: Optional[re.Pattern] = None,
     ) -> str:
         url = path if external else self._base_url / path
+        file_path = file_path or furl(url).path.segments[-1]
         logger.info("Starting download...")
-        downloaded_file = wget.download(url, out=file_path, bar=bar_progress)
-        sys.stdout.write("\n")
-        logger.info("Download complete")
-        return downloaded_file
+        downloader = RangedDownloader(
+            segments=settings.DOWNLOAD_SEGMENTS,
+            max_retries=settings.DOWNLOAD_MAX_RETRIES,
+            session=get_download_session(),
+        )
+        try:
+            return downloader.download(
+                str(url), file_path, stale_pattern=stale_pattern
+            )
+        finally:
+            DOWNLOAD_RETRIES.inc(downloader.stats.retries)
+            DOWNLOAD_RESUMED_BYTES.inc(downloader.stats.resumed)
+
+    @contextmanager
+    def open_stream(
+        self,
+        path: str,
+        external: bool = True,
+        timeout: Optional[tuple[float, Optional[float]]] = None,
+    ) -> Iterator[requests.Response]:
+        """
+        Open a streamed response, its body is read by the caller. A read
+        timeout of None waits forever between chunks.
+        """
+        url = path if external else self._base_url / path
+        headers = {} if external else self.headers
+        with get_session().get(
+            url,
+            headers=headers,
+            stream=True,
+            timeout=timeout or self._timeout,
+        ) as response:
+            response.raise_for_status()
+            yield response
+
+    def stream(
+        self, path: str, external: bool = True, chunk_size: int = 1 << 20
+    ) -> Iterator[bytes]:
+        """
+        Yields the response body in chunks of at most chunk_size bytes
+        without storing it
+        """
+        with self.open_stream(path, external=external) as response:
+            yield from response.iter_content(chunk_size=chunk_size)
+
+
+@cache
+def get_rest_client() -> RestClient:
+    return RestClient()
@@ -0,0 +1,145 @@
+import asyncio
+import math
+import shutil
+import time
+from collections import deque
+from threading import Event, Lock, Thread
+from typing import Optional
+
+import psutil
+
+from splight_agent.logging import SplightLogger
+
+logger = SplightLogger(__name__)
+
+USAGE_METRICS = (
+    "cpu_percent",
+    "memory_percent",
+    "disk_percent",
+    "disk_read_bytes_per_second",
+    "disk_write_bytes_per_second",
+    "net_sent_bytes_per_second",
+    "net_recv_bytes_per_second",
+)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """
+    Nearest-rank percentile of a non empty list of values
+    """
+    ordered = sorted(values)
+    rank = max(math.ceil(fraction * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def aggregate(samples: list[dict[str, float]]) -> dict[str, dict[str, float]]:
+    """
+    Returns the min, mean, max and p95 of every metric in the samples
+    """
+    stats = {}
+    for metric in USAGE_METRICS:
+        values = [s[metric] for s in samples if s.get(metric) is not None]
+        if not values:
+            continue
+        stats[metric] = {
+            "min": round(min(values), 2),
+            "mean": round(sum(values) / len(values), 2),
+            "max": round(max(values), 2),
+            "p95": round(percentile(values, 0.95), 2),
+        }
+    return stats
+
+
+class UsageSampler:
+    """
+    Samples host usage at a fixed rate into a ring buffer. CPU usage is
+    measured since the previous sample, so sampling never blocks, and the
+    oldest samples are dropped when the buffer is full.
+    """
+
+    def __init__(self, interval: float = 1.0, capacity: int = 600) -> None:
+        self._interval = interval
+        self._samples: deque[dict[str, float]] = deque(maxlen=capacity)
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = Thread(target=self._sample_forever, daemon=True)
+        self._last_counters: Optional[tuple[float, dict[str, int]]] = None
+        # the first call only sets the reference point
+        psutil.cpu_percent(interval=None)
+
+    @staticmethod
+    def _get_counters() -> dict[str, int]:
+        counters = {}
+        disk = psutil.disk_io_counters()
+        if disk is not None:
+            counters["disk_read"] = disk.read_bytes
+            counters["disk_write"] = disk.write_bytes
+        net = psutil.net_io_counters()
+        if net is not None:
+            counters["net_sent"] = net.bytes_sent
+            counters["net_recv"] = net.bytes_recv
+        return counters
+
+    def _get_rates(self) -> dict[str, float]:
+        """
+        Bytes per second of every IO counter since the previous sample
+        """
+        now = time.monotonic()
+        counters = self._get_counters()
+        previous, self._last_counters = self._last_counters, (now, counters)
+        if previous is None:
+            return {}
+        elapsed = now - previous[0]
+        if elapsed <= 0:
+            return {}
+        return {
+            f"{name}_bytes_per_second": (value - previous[1][name]) / elapsed
+            for name, value in counters.items()
+            # counters can reset, e.g. when an interface goes away
+            if name in previous[1] and value >= previous[1][name]
+        }
+
+    def sample(self) -> None:
+        total, used, _ = shutil.disk_usage("/")
+        sample = {
+            "cpu_percent": psutil.cpu_percent(interval=None),
+            "memory_percent": psutil.virtual_memory().percent,
+            "disk_percent": used / total * 100,
+            **self._get_rates(),
+        }
+        with self._lock:
+            self._samples.append(sample)
+
+    def drain(self) -> list[dict[str, float]]:
+        """
+        Returns the samples taken since the last call and clears the buffer
+        """
+        with self._lock:
+            samples = list(self._samples)
+            self._samples.clear()
+        return samples
+
+    def _safe_sample(self) -> None:
+        try:
+            self.sample()
+        except Exception as e:
+            logger.warning(f"Could not sample usage: {e}")
+
+    def _sample_forever(self) -> None:
+        while not self._stop.is_set():
+            self._safe_sample()
+            self._stop.wait(self._interval)
+
+    async def run_async(self) -> None:
+        """
+        Sample usage forever as an asyncio task, until it is cancelled
+        """
+        while True:
+            self._safe_sample()
+            await asyncio.sleep(self._interval)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
@@ -0,0 +1,60 @@
+import random
+from threading import Lock
+from typing import Optional
+
+
+class PollScheduler:
+    """
+    Decides how long to wait between polls. It starts at min_interval and
+    after a change or a failure the next poll comes after min_interval,
+    while nothing changes the interval doubles up to max_interval. Every
+    delay is jittered with a generator seeded per node, so nodes started
+    together drift apart.
+    """
+
+    def __init__(
+        self,
+        min_interval: float,
+        max_interval: float,
+        jitter: float = 0.1,
+        backoff: float = 2.0,
+        seed: Optional[str] = None,
+    ) -> None:
+        self._min_interval = min_interval
+        self._max_interval = max(max_interval, min_interval)
+        self._jitter = jitter
+        self._backoff = backoff
+        self._random = random.Random(seed)
+        self._lock = Lock()
+        self.interval = self._min_interval
+
+    def reset(self) -> None:
+        with self._lock:
+            self.interval = self._min_interval
+
+    def back_off(self) -> None:
+        with self._lock:
+            self.interval = min(
+                self.interval * self._backoff, self._max_interval
+            )
+
+    def record(self, changed: bool = False, failed: bool = False) -> None:
+        """
+        Update the interval with the outcome of the last poll
+        """
+        if changed or failed:
+            self.reset()
+        else:
+            self.back_off()
+
+    def next_delay(
+        self, elapsed: float = 0.0, interval: Optional[float] = None
+    ) -> float:
+        """
+        Seconds to wait before the next poll, discounting the time the last
+        one took. interval overrides the adaptive interval.
+        """
+        with self._lock:
+            interval = self.interval if interval is None else interval
+            factor = self._random.uniform(1 - self._jitter, 1 + self._jitter)
+        return max(interval * factor - elapsed, 0.0)
@@ -1,6 +1,6 @@
 import os
 from enum import Enum
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, Optional, Tuple
 
 import yaml
 from pkg_resources import parse_version
@@ -46,9 +46,61 @@ class SplightSettings(BaseSettings, Singleton):
     NAMESPACE: str = ""
     API_POLL_INTERVAL: int = 10
     API_PING_INTERVAL: int = 30
+    # the intervals grow up to these values, None keeps them fixed. Pings
+    # never back off past twice API_PING_INTERVAL
+    API_MAX_POLL_INTERVAL: Optional[int] = None
+    API_MAX_PING_INTERVAL: Optional[int] = 60
+    POLL_JITTER: float = 0.1
     REPORT_USAGE: bool = True
-    CPU_PERCENT_SAMPLES: int = 4
+    USAGE_SAMPLE_INTERVAL: float = 1.0
+    USAGE_REPORT_INTERVAL: int = 60
+    USAGE_BUFFER_SIZE: int = 600
+    CONTAINER_METRICS: bool = True
+    CGROUP_ROOT: str = "/sys/fs/cgroup"
+    USAGE_SPOOL_DIR: str = os.path.join(SPLIGHT_HOME, "usage_spool")
+    USAGE_SPOOL_MAX_BYTES: int = 50 << 20  # 50MB
+    USAGE_UPLOAD_BATCH_SIZE: int = 100
+    USAGE_FLUSH_INTERVAL: int = 30
+    METRICS_SERVER: bool = False
+    METRICS_HOST: str = "127.0.0.1"
+    METRICS_PORT: int = 9464
+    TRACE_EXPORTER: str = ""  # "file" or "otlp"
+    TRACE_FILE: str = os.path.join(SPLIGHT_HOME, "traces", "agent.jsonl")
+    TRACE_MAX_BYTES: int = 10 << 20  # 10MB
+    TRACE_BACKUP_COUNT: int = 5
+    TRACE_OTLP_ENDPOINT: str = "http://localhost:4318/v1/traces"
+    TRACE_SAMPLE_RATE: float = 1.0
     API_VERSION: APIVersion = APIVersion.V3
+    DISPATCHER_MAX_WORKERS: int = 1
+    ENGINE_MAX_DOWNLOADS: int = 2
+    ENGINE_MAX_IMAGE_LOADS: int = 1
+    ENGINE_MAX_CONTAINER_OPERATIONS: int = 4
+    IMAGE_STREAMING: bool = False
+    IMAGE_STREAM_CHUNK_SIZE: int = 1 << 20  # 1MB
+    DOWNLOAD_SEGMENTS: int = 4
+    DOWNLOAD_MAX_RETRIES: int = 5
+    CPU_LIMITS: bool = True
+    CPU_PINNING: bool = False
+    CPU_PINNING_RESERVED_CPUS: str = "0"
+    CONTAINER_SWAP: bool = False
+    HTTP_POOL_SIZE: int = 10
+    HTTP_CONNECT_TIMEOUT: float = 10
+    HTTP_READ_TIMEOUT: float = 60
+    HTTP_MAX_RETRIES: int = 3
+    HTTP_BACKOFF_FACTOR: float = 0.5
+    ASYNC_RUNTIME: bool = False
+    INCREMENTAL_FETCH: bool = False
+    INCREMENTAL_FULL_FETCH_EVERY: int = 30
+    DEPLOYMENT_SUBSCRIPTION: bool = False
+    SUBSCRIPTION_POLL_INTERVAL: int = 300
+    SUBSCRIPTION_READ_TIMEOUT: float = 90
+    EXPORTER_COALESCE_WINDOW: float = 1.0
+    EXPORTER_CONFIRMED_CACHE_SIZE: int = 1024
+    EXPORTER_BULK_UPDATE: bool = False
+    EXPORTER_QUEUE_SIZE: int = 1000
+    EXPORTER_PUBLISHERS: int = 4
+    EXPORTER_MAX_REPLAY_GAP: int = 600
+    EXPORTER_CURSOR_FILE: str = os.path.join(SPLIGHT_HOME, "exporter_cursor")
 
     def configure(self, **params: Dict):
         self.parse_obj(params)
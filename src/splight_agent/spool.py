@@ -0,0 +1,95 @@
+import json
+import os
+import time
+from threading import Lock
+
+from splight_agent.logging import SplightLogger
+
+logger = SplightLogger(__name__)
+
+ENTRY_SUFFIX = ".json"
+
+
+class UsageSpool:
+    """
+    Disk-backed FIFO of usage reports that could not be sent. Each report
+    is a file named after the time it was stored, and the oldest files are
+    evicted once the spool grows above max_bytes.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 50 << 20) -> None:
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._lock = Lock()
+        self._last_name = 0
+        os.makedirs(directory, exist_ok=True)
+        # leftovers of an interrupted write
+        for name in os.listdir(directory):
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(directory, name))
+        self._size = sum(
+            os.path.getsize(path) for path in self._list_entries()
+        )
+        self.evicted = 0
+
+    def _list_entries(self) -> list[str]:
+        names = sorted(
+            name
+            for name in os.listdir(self._directory)
+            if name.endswith(ENTRY_SUFFIX)
+        )
+        return [os.path.join(self._directory, name) for name in names]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._list_entries())
+
+    def push(self, payload: dict) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        with self._lock:
+            # names must keep the insertion order
+            self._last_name = max(time.time_ns(), self._last_name + 1)
+            path = os.path.join(
+                self._directory, f"{self._last_name:020d}{ENTRY_SUFFIX}"
+            )
+            with open(f"{path}.tmp", "wb") as fid:
+                fid.write(data)
+            os.replace(f"{path}.tmp", path)
+            self._size += len(data)
+            self._evict()
+
+    def _evict(self) -> None:
+        entries = self._list_entries()
+        while self._size > self._max_bytes and len(entries) > 1:
+            path = entries.pop(0)
+            self._remove(path)
+            self.evicted += 1
+            logger.warning("Usage spool is full, dropped the oldest report")
+
+    def _remove(self, path: str) -> None:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        self._size -= size
+
+    def peek(self, count: int) -> list[tuple[str, dict]]:
+        """
+        Returns up to count of the oldest reports with their keys
+        """
+        batch = []
+        with self._lock:
+            for path in self._list_entries()[:count]:
+                try:
+                    with open(path) as fid:
+                        batch.append((path, json.load(fid)))
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Dropping unreadable usage report: {e}")
+                    self._remove(path)
+        return batch
+
+    def remove(self, keys: list[str]) -> None:
+        with self._lock:
+            for path in keys:
+                self._remove(path)
@@ -0,0 +1,106 @@
+import random
+from threading import Event, Thread
+from typing import Callable, Iterable, Iterator
+
+from splight_agent.logging import SplightLogger
+from splight_agent.models import ComputeNode
+from splight_agent.rest_client import get_rest_client
+
+logger = SplightLogger(__name__)
+
+
+def parse_sse(chunks: Iterable[bytes]) -> Iterator[dict[str, str]]:
+    """
+    Parse a server-sent events stream into dicts with the event type and
+    data. Comments (used as heartbeats) are skipped.
+    """
+    buffer = b""
+    event = {}
+    for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for raw_line in lines:
+            line = raw_line.rstrip(b"\r").decode("utf-8")
+            if not line:
+                if "data" in event:
+                    event.setdefault("event", "message")
+                    yield event
+                event = {}
+                continue
+            if line.startswith(":"):
+                continue
+            field, _, value = line.partition(":")
+            value = value.removeprefix(" ")
+            if field == "data" and "data" in event:
+                event["data"] += f"\n{value}"
+            elif field in ("event", "data", "id"):
+                event[field] = value
+
+
+class DeploymentSubscriber:
+    """
+    The subscriber listens to the deployment changes of the compute node
+    as server-sent events and notifies every change, so the dispatcher does
+    not have to wait for the next poll
+    """
+
+    def __init__(
+        self,
+        compute_node: ComputeNode,
+        on_change: Callable[[], None],
+        api_version: str,
+        max_reconnect_interval: float = 60,
+        connect_timeout: float = 10,
+        read_timeout: float = 90,
+    ) -> None:
+        self._compute_node = compute_node
+        self._on_change = on_change
+        self._max_reconnect_interval = max_reconnect_interval
+        # the read timeout must be longer than the heartbeat interval of
+        # the stream, or a quiet stream is dropped
+        self._timeout = (connect_timeout, read_timeout)
+        self._client = get_rest_client()
+        self._base_url = f"{api_version}/engine/compute/nodes/all"
+        self._thread = Thread(target=self._listen_forever, daemon=True)
+        self._stop = Event()
+        self.connected = False
+
+    def _listen(self) -> None:
+        with self._client.open_stream(
+            f"{self._base_url}/{self._compute_node.id}/deployments/stream/",
+            external=False,
+            timeout=self._timeout,
+        ) as response:
+            logger.info("Subscribed to deployment changes")
+            self.connected = True
+            chunks = response.iter_content(chunk_size=1024)
+            for event in parse_sse(chunks):
+                if self._stop.is_set():
+                    return
+                if event["event"] == "ping":
+                    continue
+                logger.debug(f"Received deployment change: {event['data']}")
+                self._on_change()
+
+    def _listen_forever(self) -> None:
+        attempt = 0
+        while not self._stop.is_set():
+            try:
+                self._listen()
+                attempt = 0
+            except Exception as e:
+                attempt += 1
+                logger.warning(f"Deployment subscription failed: {e}")
+            if self.connected:
+                # changes may have been missed while reconnecting, poll now
+                self.connected = False
+                self._on_change()
+            delay = min(self._max_reconnect_interval, 2**attempt)
+            self._stop.wait(delay * random.uniform(0.5, 1.5))
+
+    def start(self) -> None:
+        logger.info("Deployment subscriber started")
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
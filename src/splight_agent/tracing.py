@@ -0,0 +1,282 @@
+import json
+import logging
+import os
+import queue
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import cache
+from threading import Thread
+from typing import Any, ContextManager, Iterator, Optional
+
+import requests
+from concurrent_log_handler import ConcurrentRotatingFileHandler
+
+from splight_agent.logging import SplightLogger
+from splight_agent.settings import settings
+
+logger = SplightLogger(__name__)
+
+
+class Span:
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: Optional[str] = None,
+        sampled: bool = True,
+        attributes: Optional[dict[str, Any]] = None,
+    ) -> None:
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = attributes or {}
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    @property
+    def duration(self) -> float:
+        end_ns = self.end_ns or time.time_ns()
+        return (end_ns - self.start_ns) / 1e9
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start_ns / 1e9,
+            "duration": self.duration,
+            "status": "error" if self.error else "ok",
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class NoopSpan:
+    """
+    Span handed out while tracing is disabled, it records nothing
+    """
+
+    sampled = False
+
+    def __enter__(self) -> "NoopSpan":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        return None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class JsonLinesSink:
+    """
+    Writes finished spans as JSON lines to a rotating file
+    """
+
+    def __init__(
+        self, path: str, max_bytes: int = 10 << 20, backup_count: int = 5
+    ) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        handler = ConcurrentRotatingFileHandler(
+            filename=path, maxBytes=max_bytes, backupCount=backup_count
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self._logger = logging.Logger("splight_agent.tracing")
+        self._logger.propagate = False
+        self._logger.addHandler(handler)
+
+    def export(self, span: Span) -> None:
+        self._logger.info(json.dumps(span.to_dict(), default=str))
+
+
+def _otlp_value(value: Any) -> dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OTLPSink:
+    """
+    Sends finished spans in batches to an OTLP/HTTP collector using the
+    JSON encoding. Spans are dropped when the collector cannot keep up.
+    """
+
+    def __init__(
+        self,
+        endpoint: str = "http://localhost:4318/v1/traces",
+        batch_size: int = 100,
+        flush_interval: float = 5.0,
+        max_queue_size: int = 2048,
+    ) -> None:
+        self._endpoint = endpoint
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue: queue.Queue[Span] = queue.Queue(maxsize=max_queue_size)
+        self._thread = Thread(target=self._send_forever, daemon=True)
+        self._thread.start()
+
+    def export(self, span: Span) -> None:
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            pass
+
+    @staticmethod
+    def _to_otlp(span: Span) -> dict[str, Any]:
+        data = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in span.attributes.items()
+            ],
+            "status": (
+                {"code": 2, "message": span.error}
+                if span.error
+                else {"code": 1}
+            ),
+        }
+        if span.parent_id:
+            data["parentSpanId"] = span.parent_id
+        return data
+
+    def _send(self, spans: list[Span]) -> None:
+        body = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": "splight-agent"},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "splight_agent"},
+                            "spans": [self._to_otlp(s) for s in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        try:
+            requests.post(self._endpoint, json=body, timeout=10)
+        except requests.RequestException as e:
+            logger.debug(f"Could not send {len(spans)} spans: {e}")
+
+    def _send_forever(self) -> None:
+        while True:
+            spans = []
+            deadline = time.monotonic() + self._flush_interval
+            while len(spans) < self._batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    spans.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if spans:
+                self._send(spans)
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar(
+    "current_span", default=None
+)
+
+
+class Tracer:
+    """
+    Creates spans and hands the finished ones to the sink. Whether a trace
+    is recorded is decided once for its root span with sample_rate, and
+    the nested spans follow that decision.
+    """
+
+    def __init__(self, sink=None, sample_rate: float = 1.0) -> None:
+        self._sink = sink
+        self._sample_rate = sample_rate
+
+    @property
+    def enabled(self) -> bool:
+        return self._sink is not None
+
+    def span(
+        self, name: str, **attributes: Any
+    ) -> ContextManager[Span | NoopSpan]:
+        """
+        Context manager of a new span, nested in the current one. Without a
+        sink the same no-op span is returned and nothing is allocated.
+        """
+        if self._sink is None:
+            return NOOP_SPAN
+        return self._span(name, attributes)
+
+    @contextmanager
+    def _span(self, name: str, attributes: dict[str, Any]) -> Iterator[Span]:
+        parent = _current_span.get()
+        if parent is None:
+            span = Span(
+                name,
+                trace_id=os.urandom(16).hex(),
+                sampled=random.random() < self._sample_rate,
+                attributes=attributes,
+            )
+        else:
+            span = Span(
+                name,
+                trace_id=parent.trace_id,
+                parent_id=parent.span_id,
+                sampled=parent.sampled,
+                attributes=attributes,
+            )
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end_ns = time.time_ns()
+            if span.sampled:
+                try:
+                    self._sink.export(span)
+                except Exception as e:
+                    logger.debug(f"Could not export span {name}: {e}")
+
+
+@cache
+def get_tracer() -> Tracer:
+    if settings.TRACE_EXPORTER == "file":
+        sink = JsonLinesSink(
+            settings.TRACE_FILE,
+            max_bytes=settings.TRACE_MAX_BYTES,
+            backup_count=settings.TRACE_BACKUP_COUNT,
+        )
+    elif settings.TRACE_EXPORTER == "otlp":
+        sink = OTLPSink(settings.TRACE_OTLP_ENDPOINT)
+    else:
+        sink = None
+    return Tracer(sink, sample_rate=settings.TRACE_SAMPLE_RATE)
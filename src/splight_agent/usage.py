@@ -1,62 +1,209 @@
-import shutil
+import asyncio
 import time
-from threading import Thread
+from datetime import datetime, timezone
+from threading import Event, Lock, Thread
 from typing import Optional
 
-import psutil
+from docker import from_env
 
+from splight_agent.cgroups import ContainerMetricsCollector
+from splight_agent.convergence import get_convergence_tracker
 from splight_agent.logging import SplightLogger
-from splight_agent.models import ComputeNode, ComputeNodeUsage
+from splight_agent.models import ComputeNode, ComputeNodeUsage, ContainerUsage
+from splight_agent.rest_client import is_rejected
+from splight_agent.sampler import UsageSampler, aggregate
+from splight_agent.spool import UsageSpool
 
 logger = SplightLogger()
 
+# the usage/batch endpoint is not available in this platform
+BATCH_UNSUPPORTED_STATUS_CODES = (404, 405)
+
 
 class UsageReporter:
     def __init__(
-        self, compute_node: ComputeNode, cpu_percent_samples: Optional[int] = 4
+        self,
+        compute_node: ComputeNode,
+        sample_interval: float = 1.0,
+        report_interval: int = 60,
+        buffer_size: int = 600,
+        container_metrics: bool = True,
+        cgroup_root: str = "/sys/fs/cgroup",
+        spool_dir: Optional[str] = None,
+        spool_max_bytes: int = 50 << 20,
+        upload_batch_size: int = 100,
+        flush_interval: int = 30,
     ) -> None:
         self._running = False
         self._compute_node = compute_node
-        self._cpu_percent_samples = cpu_percent_samples
+        self._report_interval = report_interval
+        self._sampler = UsageSampler(
+            interval=sample_interval, capacity=buffer_size
+        )
+        self._collector = (
+            ContainerMetricsCollector(
+                from_env(), compute_node.id, cgroup_root=cgroup_root
+            )
+            if container_metrics
+            else None
+        )
+        # reports that could not be sent are kept here until the API is back
+        self._spool = (
+            UsageSpool(spool_dir, max_bytes=spool_max_bytes)
+            if spool_dir
+            else None
+        )
+        self._upload_batch_size = upload_batch_size
+        self._flush_interval = flush_interval
+        self._batch_supported = True
+        self._flush_lock = Lock()
+        self._stop = Event()
         self._thread = Thread(target=self._report_usage, daemon=True)
+        self._flush_thread = Thread(target=self._flush_forever, daemon=True)
+
+    def _get_container_usage(self) -> list[ContainerUsage]:
+        if self._collector is None:
+            return []
+        try:
+            return self._collector.collect()
+        except Exception as e:
+            logger.warning(f"Could not collect container metrics: {e}")
+            return []
+
+    def _send(self, usage: ComputeNodeUsage) -> None:
+        if self._spool is None:
+            usage.save()
+            return
+        try:
+            usage.save()
+        except Exception as e:
+            if is_rejected(e):
+                logger.error(f"Usage report rejected by the API: {e}")
+                return
+            logger.warning(f"Could not report usage, storing it: {e}")
+            self._spool.push(usage.to_payload())
+            return
+        if len(self._spool):
+            # the API is back, send what was stored while it was not
+            self._flush()
 
-    def _get_cpu_percent(self) -> float:
-        """Returns average cpu percent"""
-        total = psutil.cpu_percent(interval=1)
-        for i in range(self._cpu_percent_samples - 1):
-            total += psutil.cpu_percent(interval=1)
-        return total / self._cpu_percent_samples
+    def _upload_batch(self, payloads: list[dict]) -> bool:
+        """
+        Returns whether the batch was accepted. Batches rejected by the API
+        are sent again report by report, and the endpoint is not used again
+        if it does not exist.
+        """
+        if not self._batch_supported:
+            return False
+        try:
+            ComputeNodeUsage.save_batch(self._compute_node.id, payloads)
+        except Exception as e:
+            if not is_rejected(e):
+                raise
+            if e.response.status_code in BATCH_UNSUPPORTED_STATUS_CODES:
+                logger.warning(
+                    "Usage batch upload is not supported by the API, "
+                    "stored reports will be sent one by one"
+                )
+                self._batch_supported = False
+            else:
+                logger.warning(f"Usage batch rejected by the API: {e}")
+            return False
+        return True
+
+    def _upload_one(self, payload: dict) -> None:
+        """
+        Upload a single stored report, dropping it if the API rejects it
+        """
+        try:
+            ComputeNodeUsage.save_payload(self._compute_node.id, payload)
+        except Exception as e:
+            if not is_rejected(e):
+                raise
+            logger.error(f"Dropping stored usage report: {e}")
 
-    def _get_memory_percent(self) -> float:
-        """Returns memory percent"""
-        return psutil.virtual_memory().percent
+    def _flush(self) -> None:
+        """
+        Upload the stored reports in compressed batches, oldest first
+        """
+        if self._spool is None:
+            return
+        with self._flush_lock:
+            while batch := self._spool.peek(self._upload_batch_size):
+                keys, payloads = zip(*batch)
+                try:
+                    if self._upload_batch(list(payloads)):
+                        self._spool.remove(list(keys))
+                    else:
+                        for key, payload in batch:
+                            self._upload_one(payload)
+                            self._spool.remove([key])
+                except Exception as e:
+                    logger.warning(f"Could not upload stored usage: {e}")
+                    return
+                logger.info(f"Uploaded {len(payloads)} stored usage reports")
 
-    def _get_disk_percent(self) -> float:
-        """Returns memory disk percent"""
-        total, used, _ = shutil.disk_usage("/")
-        return round(used / total * 100, 2)
+    def _report(self) -> None:
+        try:
+            samples = self._sampler.drain()
+            if not samples:
+                self._sampler.sample()
+                samples = self._sampler.drain()
+            stats = aggregate(samples)
+            usage = ComputeNodeUsage(
+                compute_node=self._compute_node.id,
+                timestamp=datetime.now(timezone.utc).isoformat(),
+                cpu_percent=stats["cpu_percent"]["mean"],
+                memory_percent=stats["memory_percent"]["mean"],
+                disk_percent=stats["disk_percent"]["mean"],
+                samples=len(samples),
+                stats=stats,
+                containers=self._get_container_usage(),
+                convergence=get_convergence_tracker().summary(),
+            )
+            self._send(usage)
+        except Exception as e:
+            logger.error(f"Error while reporting usage: {e}")
 
     def _report_usage(self) -> None:
         while self._running:
-            try:
-                usage = ComputeNodeUsage(
-                    compute_node=self._compute_node.id,
-                    cpu_percent=self._get_cpu_percent(),
-                    memory_percent=self._get_memory_percent(),
-                    disk_percent=self._get_disk_percent(),
-                )
-                usage.save()
-            except Exception as e:
-                logger.error(f"Error while reporting usage: {e}")
-            finally:
-                time.sleep(60)
+            time.sleep(self._report_interval)
+            self._report()
+
+    def _flush_forever(self) -> None:
+        while not self._stop.wait(self._flush_interval):
+            self._flush()
+
+    async def _flush_forever_async(self) -> None:
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            await asyncio.to_thread(self._flush)
+
+    async def run_async(self) -> None:
+        """
+        Report usage forever as an asyncio task, until it is cancelled
+        """
+        logger.info("Usage reporter started")
+        tasks = [
+            asyncio.create_task(self._sampler.run_async()),
+            asyncio.create_task(self._flush_forever_async()),
+        ]
+        try:
+            while True:
+                await asyncio.sleep(self._report_interval)
+                await asyncio.to_thread(self._report)
+        finally:
+            for task in tasks:
+                task.cancel()
 
     def start(self):
         """
         Launch the usage reporter daemon thread
         """
         self._running = True
+        self._sampler.start()
         self._thread.start()
+        self._flush_thread.start()
         logger.info("Usage reporter started")
 
     def stop(self) -> None:
@@ -65,4 +212,6 @@ class UsageReporter:
         TODO: find a proper way to stop the thread
         """
         self._running = False
+        self._stop.set()
+        self._sampler.stop()
         logger.info("Usage reporter stopped")
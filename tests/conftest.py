@@ -0,0 +1,14 @@
+import pytest
+
+from splight_agent.settings import settings
+from tests.reference_server import ReferenceServer
+
+
+@pytest.fixture
+def reference_server(monkeypatch):
+    server = ReferenceServer().start()
+    monkeypatch.setattr(settings, "SPLIGHT_PLATFORM_API_HOST", server.url)
+    monkeypatch.setattr(settings, "SPLIGHT_ACCESS_ID", "access-id")
+    monkeypatch.setattr(settings, "SPLIGHT_SECRET_KEY", "secret-key")
+    yield server
+    server.stop()
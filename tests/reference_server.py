@@ -0,0 +1,175 @@
+"""
+Local stand-in of the platform API endpoints used by the agent, to test the
+agent against a real HTTP server without a platform
+"""
+
+import json
+import queue
+import re
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+NODE_URL_REGEX = re.compile(r"^/v\d+/engine/compute/nodes/all/(?P<node>[^/]+)")
+RESOURCES = ("components", "servers")
+
+
+def parse_iso(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+class ReferenceServer:
+    """
+    Serves the components and servers of the compute nodes, with ETags and
+    incremental fetches by deployment_updated_at, and their deployment
+    change stream as server-sent events with a comment line as heartbeat
+    """
+
+    def __init__(self, heartbeat: Optional[float] = 0.1) -> None:
+        self.heartbeat = heartbeat
+        self.requests: list[tuple[str, str, dict[str, str]]] = []
+        self.stream_requests = 0
+        # status code and number of items of every list response
+        self.list_responses: list[tuple[int, int]] = []
+        self.instances: dict[str, dict[str, dict]] = {
+            resource: {} for resource in RESOURCES
+        }
+        self._generation = 0
+        self._lock = Lock()
+        # one queue per open stream, None closes the stream
+        self._streams: list[queue.Queue[Optional[bytes]]] = []
+        self._server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), self._handler_class()
+        )
+        self._server.daemon_threads = True
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def _handler_class(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                with server._lock:
+                    server.requests.append(
+                        ("GET", self.path, dict(self.headers))
+                    )
+                url = urlparse(self.path)
+                match = NODE_URL_REGEX.match(url.path)
+                resource = url.path.rstrip("/").rsplit("/", 1)[-1]
+                if not self.headers.get("Authorization", "").startswith(
+                    "Splight "
+                ):
+                    self.send_error(401)
+                elif match and url.path.endswith("/deployments/stream/"):
+                    server._serve_stream(self)
+                elif match and resource in RESOURCES:
+                    query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                    server._serve_list(self, resource, query)
+                else:
+                    self.send_error(404)
+
+        return Handler
+
+    def _serve_list(
+        self, handler: BaseHTTPRequestHandler, resource: str, query: dict
+    ) -> None:
+        with self._lock:
+            items = list(self.instances[resource].values())
+            etag = f'"{resource}-{self._generation}"'
+        since = query.get("deployment_updated_at__gte")
+        if since is not None:
+            items = [
+                item
+                for item in items
+                if parse_iso(item["deployment_updated_at"]) >= parse_iso(since)
+            ]
+        elif handler.headers.get("If-None-Match") == etag:
+            self.list_responses.append((304, 0))
+            handler.send_response(304)
+            handler.send_header("ETag", etag)
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            return
+        self.list_responses.append((200, len(items)))
+        body = json.dumps(items).encode("utf-8")
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("ETag", etag)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def set_instance(self, resource: str, item: dict) -> None:
+        """
+        Create or replace an instance, as a deployment change does
+        """
+        with self._lock:
+            self.instances[resource][item["id"]] = item
+            self._generation += 1
+
+    def _serve_stream(self, handler: BaseHTTPRequestHandler) -> None:
+        events: queue.Queue[Optional[bytes]] = queue.Queue()
+        with self._lock:
+            self.stream_requests += 1
+            self._streams.append(events)
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Cache-Control", "no-cache")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+        try:
+            while True:
+                try:
+                    data = events.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    data = b": ping\n\n"
+                if data is None:
+                    break
+                handler.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                handler.wfile.flush()
+            handler.wfile.write(b"0\r\n\r\n")
+            handler.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._streams.remove(events)
+            handler.close_connection = True
+
+    def publish(self, data: dict, event: str = "deployment") -> None:
+        """
+        Send a deployment change to every open stream
+        """
+        message = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        with self._lock:
+            for events in self._streams:
+                events.put(message.encode("utf-8"))
+
+    def close_streams(self) -> None:
+        """
+        End every open stream, as the platform does when it restarts
+        """
+        with self._lock:
+            for events in self._streams:
+                events.put(None)
+
+    def start(self) -> "ReferenceServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.close_streams()
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,145 @@
+import json
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from typing import Iterator
+
+import pytest
+
+from splight_agent.downloader import (
+    PART_SUFFIX,
+    PROGRESS_SUFFIX,
+    RangedDownloader,
+    remove_stale_partials,
+)
+from splight_agent.rest_client import RestClient, get_connection_stats
+
+CONTENT = bytes(range(100))
+ETAG = '"content-v2"'
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves CONTENT with ranges, keeping connections alive
+    """
+
+    protocol_version = "HTTP/1.1"
+    # bytes sent before dropping the connection, None sends them all
+    max_bytes = None
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        start, _, end = self.headers["Range"][6:].partition("-")
+        start, end = int(start), int(end)
+        self.send_response(206)
+        self.send_header(
+            "Content-Range", f"bytes {start}-{end}/{len(CONTENT)}"
+        )
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", ETAG)
+        self.end_headers()
+        if self.max_bytes is None:
+            self.wfile.write(CONTENT[start : end + 1])
+            return
+        self.wfile.write(CONTENT[start : min(end + 1, start + self.max_bytes)])
+        self.close_connection = True
+
+
+class FlakyRangeHandler(RangeHandler):
+    """
+    Drops every connection after 10 bytes
+    """
+
+    max_bytes = 10
+
+
+def serve(handler_class: type[BaseHTTPRequestHandler]) -> Iterator[str]:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    yield f"http://{host}:{port}/image"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def range_server():
+    yield from serve(RangeHandler)
+
+
+@pytest.fixture
+def flaky_server():
+    yield from serve(FlakyRangeHandler)
+
+
+def test_retries_are_reset_while_the_download_advances(tmp_path, flaky_server):
+    downloader = RangedDownloader(
+        segments=1, chunk_size=10, max_retries=2, backoff_factor=0
+    )
+    file_path = str(tmp_path / "hub-1.1")
+    downloader.download(flaky_server, file_path)
+    with open(file_path, "rb") as fid:
+        assert fid.read() == CONTENT
+    assert downloader.stats.retries > downloader._max_retries
+
+
+def test_remove_stale_partials_keeps_current_version(tmp_path):
+    names = [
+        "hub-1.0.0.part",
+        "hub-1.0.0.progress",
+        "hub-1.0.0.progress.tmp",
+        "hub-1.1.0.part",
+        "hub-1.1.0.progress",
+        "hub-0.9.0",
+        "hub-extra-1.0.0.part",
+        "hub-2-1.0.0.progress",
+        "other-1.0.0.part",
+    ]
+    for name in names:
+        (tmp_path / name).touch()
+    pattern = re.compile(r"hub-\d+\.\d+\.\d+")
+    remove_stale_partials(str(tmp_path / "hub-1.1.0"), pattern)
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "hub-0.9.0",
+        "hub-1.1.0.part",
+        "hub-1.1.0.progress",
+        "hub-2-1.0.0.progress",
+        "hub-extra-1.0.0.part",
+        "other-1.0.0.part",
+    ]
+
+
+def test_partial_of_a_changed_file_is_discarded(tmp_path, flaky_server):
+    file_path = str(tmp_path / "hub-1.1.0")
+    # same size, downloaded from a previous build of the file
+    with open(f"{file_path}{PART_SUFFIX}", "wb") as fid:
+        fid.write(b"\xff" * len(CONTENT))
+    with open(f"{file_path}{PROGRESS_SUFFIX}", "w") as fid:
+        json.dump(
+            {
+                "size": len(CONTENT),
+                "validator": '"content-v1"',
+                "segments": [[50, len(CONTENT) - 1]],
+            },
+            fid,
+        )
+    downloader = RangedDownloader(segments=1, chunk_size=10, backoff_factor=0)
+    downloader.download(flaky_server, file_path)
+    with open(file_path, "rb") as fid:
+        assert fid.read() == CONTENT
+    assert downloader.stats.resumed == 0
+
+
+def test_downloads_reuse_pooled_connections(tmp_path, range_server):
+    before = get_connection_stats()
+    for version in ("1.0.0", "1.1.0"):
+        file_path = str(tmp_path / f"hub-{version}")
+        RestClient().download(range_server, file_path=file_path)
+        with open(file_path, "rb") as fid:
+            assert fid.read() == CONTENT
+    after = get_connection_stats()
+    assert after["requests"] - before["requests"] >= 4
+    assert after["reused"] > before["reused"]
@@ -0,0 +1,39 @@
+from splight_agent.exporter import StatusCoalescer
+from splight_agent.models import Component, ComponentDeploymentStatus
+
+INSTANCE_KEY = (Component, "component-1")
+RUNNING = ComponentDeploymentStatus.RUNNING
+
+
+def test_failed_publish_keeps_event_time_until_confirmed():
+    coalescer = StatusCoalescer(
+        window=0, confirmed_cache_size=10, retry_delay=0
+    )
+    coalescer.add(INSTANCE_KEY, RUNNING, event_time=100.0)
+    assert coalescer.pop_ready() == {INSTANCE_KEY: RUNNING}
+
+    assert coalescer.retry(INSTANCE_KEY, RUNNING) == 0
+    coalescer.done(INSTANCE_KEY)
+    assert coalescer.oldest_unpublished() == 100.0
+
+    assert coalescer.pop_ready() == {INSTANCE_KEY: RUNNING}
+    coalescer.confirm(INSTANCE_KEY, RUNNING)
+    coalescer.done(INSTANCE_KEY)
+    assert coalescer.oldest_unpublished() is None
+
+
+def test_retry_backs_off_until_confirmed():
+    coalescer = StatusCoalescer(
+        window=0, confirmed_cache_size=10, max_retry_delay=3
+    )
+    delays = []
+    for _ in range(4):
+        coalescer.add(INSTANCE_KEY, RUNNING)
+        coalescer.pop_ready()
+        delays.append(coalescer.retry(INSTANCE_KEY, RUNNING))
+        coalescer.done(INSTANCE_KEY)
+    assert delays == [1, 2, 3, 3]
+    assert coalescer.pop_ready() == {}
+
+    coalescer.confirm(INSTANCE_KEY, RUNNING)
+    assert coalescer.retry(INSTANCE_KEY, RUNNING) == 1
@@ -0,0 +1,44 @@
+from splight_agent.metrics import Counter, Gauge, Histogram, MetricsRegistry
+
+
+def test_render_metrics_read_from_functions():
+    registry = MetricsRegistry()
+    lookups = registry.register(
+        Counter("lookups_total", "Image lookups", ("result",))
+    )
+    depth = registry.register(Gauge("queue_depth", "Queue depth"))
+    stats = {"hits": 3, "misses": 1}
+    lookups.set_function(
+        lambda: {("hit",): stats["hits"], ("miss",): stats["misses"]}
+    )
+    depth.set_function(lambda: 7)
+    stats["hits"] += 1
+
+    lines = registry.render().splitlines()
+    assert 'lookups_total{result="hit"} 4.0' in lines
+    assert 'lookups_total{result="miss"} 1.0' in lines
+    assert "queue_depth 7.0" in lines
+
+
+def test_failing_function_is_skipped():
+    registry = MetricsRegistry()
+    broken = registry.register(Gauge("broken", "Always fails"))
+    broken.set_function(lambda: 1 / 0)
+    assert registry.render().splitlines() == [
+        "# HELP broken Always fails",
+        "# TYPE broken gauge",
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    seconds = registry.register(
+        Histogram("seconds", "Durations", buckets=(1, 5))
+    )
+    for value in (0.5, 2, 10):
+        seconds.observe(value)
+    lines = registry.render().splitlines()
+    assert 'seconds_bucket{le="1.0"} 1.0' in lines
+    assert 'seconds_bucket{le="5.0"} 2.0' in lines
+    assert 'seconds_bucket{le="+Inf"} 3.0' in lines
+    assert "seconds_count 3.0" in lines
@@ -0,0 +1,133 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from splight_agent.models import (
+    Component,
+    ComputeNode,
+    DesiredStateTable,
+    parse_datetime,
+)
+from splight_agent.settings import settings
+
+NODE_ID = "3c1b6a52-7f27-4e0c-9a8c-2f5a4f3e9d10"
+
+
+def make_component(index: int, updated_at: str, **fields) -> dict:
+    return {
+        "id": f"component-{index}",
+        "name": f"component-{index}",
+        "deployment_active": True,
+        "deployment_status": "Running",
+        "deployment_capacity": "small",
+        "deployment_log_level": "info",
+        "deployment_restart_policy": "Always",
+        "deployment_updated_at": updated_at,
+        "compute_node": NODE_ID,
+        "input": [{"name": "period", "value": index}],
+        "hub_component": {
+            "id": "hub-component",
+            "name": "hub",
+            "version": "1.0.0",
+        },
+        **fields,
+    }
+
+
+@pytest.fixture
+def incremental(monkeypatch):
+    monkeypatch.setattr(settings, "INCREMENTAL_FETCH", True)
+    monkeypatch.setattr(settings, "INCREMENTAL_FULL_FETCH_EVERY", 30)
+
+
+def test_parse_datetime_formats():
+    expected = datetime(2026, 1, 1, 12, 0, 1, 250000, tzinfo=timezone.utc)
+    assert parse_datetime("2026-01-01T12:00:01.25Z") == expected
+    assert parse_datetime("2026-01-01T12:00:01.250000+00:00") == expected
+    assert parse_datetime("2026-01-01T09:00:01.25-03:00") == expected
+    assert parse_datetime("2026-01-01T12:00:01.25") == expected
+    assert parse_datetime("not a date") is None
+    assert parse_datetime(None) is None
+
+
+def test_high_water_mark_compares_datetimes():
+    table = DesiredStateTable()
+    records = table.parse(
+        [
+            make_component(1, "2026-01-01T12:00:01Z"),
+            make_component(2, "2026-01-01T12:00:01.250+00:00"),
+            make_component(3, "2026-01-01T12:00:00.999999Z"),
+        ],
+        Component,
+    )
+    table.replace(records)
+    assert table.high_water_mark == datetime(
+        2026, 1, 1, 12, 0, 1, 250000, tzinfo=timezone.utc
+    )
+
+
+def test_unchanged_list_is_not_downloaded_again(reference_server):
+    reference_server.set_instance(
+        "components", make_component(1, "2026-01-01T12:00:00Z")
+    )
+    node = ComputeNode(id=NODE_ID)
+    first = node.components
+    second = node.components
+    assert [c.id for c in first] == [c.id for c in second] == ["component-1"]
+    assert reference_server.list_responses == [(200, 1), (304, 0)]
+
+
+def test_incremental_fetch_includes_the_high_water_mark(
+    reference_server, incremental
+):
+    for index in range(2):
+        reference_server.set_instance(
+            "components", make_component(index, "2026-01-01T12:00:00Z")
+        )
+    node = ComputeNode(id=NODE_ID)
+    assert len(node.components) == 2
+
+    # updated in the same timestamp as the mark, written differently
+    reference_server.set_instance(
+        "components",
+        make_component(
+            2, "2026-01-01T12:00:00.000+00:00", deployment_active=False
+        ),
+    )
+    components = {c.id: c for c in node.components}
+    assert set(components) == {"component-0", "component-1", "component-2"}
+    assert not components["component-2"].deployment_active
+    _, path, _ = reference_server.requests[-1]
+    mark = "2026-01-01T12%3A00%3A00%2B00%3A00"
+    assert f"deployment_updated_at__gte={mark}" in path
+
+    reference_server.set_instance(
+        "components",
+        make_component(
+            0, "2026-01-01T12:00:05Z", deployment_log_level="debug"
+        ),
+    )
+    components = {c.id: c for c in node.components}
+    assert components["component-0"].deployment_log_level == "debug"
+    assert len(components) == 3
+
+
+def test_released_record_matches_legacy_hash_without_requests(
+    reference_server,
+):
+    reference_server.set_instance(
+        "components", make_component(1, "2026-01-01T12:00:00Z")
+    )
+    node = ComputeNode(id=NODE_ID)
+    (record,) = node.get_desired_state()
+    legacy_hash = Component(
+        **make_component(1, "2026-01-01T12:00:00Z")
+    ).to_legacy_hash()
+    record.release()
+    # not modified, the record is kept without its payload
+    (record,) = node.get_desired_state()
+    requests = len(reference_server.requests)
+    assert record.matches_hash(legacy_hash)
+    assert record.matches_hash(record.state_hash)
+    assert not record.matches_hash("outdated")
+    assert len(reference_server.requests) == requests
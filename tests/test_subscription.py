@@ -0,0 +1,86 @@
+import time
+from threading import Event
+
+from splight_agent.models import ComputeNode
+from splight_agent.subscription import DeploymentSubscriber, parse_sse
+
+NODE_ID = "3c1b6a52-7f27-4e0c-9a8c-2f5a4f3e9d10"
+
+
+def wait_for(condition, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def make_subscriber(on_change, **kwargs) -> DeploymentSubscriber:
+    return DeploymentSubscriber(
+        compute_node=ComputeNode(id=NODE_ID),
+        on_change=on_change,
+        api_version="v3",
+        max_reconnect_interval=0.1,
+        **kwargs,
+    )
+
+
+def test_parse_sse_events_split_across_chunks():
+    chunks = [
+        b": ping\n\nevent: deploy",
+        b'ment\r\ndata: {"id": 1}\r\ndata: more\n',
+        b"\ndata: plain\n\n",
+    ]
+    assert list(parse_sse(chunks)) == [
+        {"event": "deployment", "data": '{"id": 1}\nmore'},
+        {"event": "message", "data": "plain"},
+    ]
+
+
+def test_connected_before_any_event(reference_server):
+    subscriber = make_subscriber(lambda: None)
+    subscriber.start()
+    try:
+        assert wait_for(lambda: subscriber.connected)
+    finally:
+        subscriber.stop()
+
+
+def test_change_notifies(reference_server):
+    changed = Event()
+    subscriber = make_subscriber(changed.set)
+    subscriber.start()
+    try:
+        assert wait_for(lambda: subscriber.connected)
+        reference_server.publish({"id": "component-id"})
+        assert changed.wait(timeout=5)
+    finally:
+        subscriber.stop()
+
+
+def test_quiet_stream_is_kept_by_heartbeats(reference_server):
+    subscriber = make_subscriber(lambda: None, read_timeout=0.5)
+    subscriber.start()
+    try:
+        assert wait_for(lambda: subscriber.connected)
+        time.sleep(1.5)
+        assert subscriber.connected
+        assert reference_server.stream_requests == 1
+    finally:
+        subscriber.stop()
+
+
+def test_dropped_stream_polls_and_reconnects(reference_server):
+    changes = []
+    subscriber = make_subscriber(lambda: changes.append(time.monotonic()))
+    subscriber.start()
+    try:
+        assert wait_for(lambda: subscriber.connected)
+        reference_server.close_streams()
+        # a catch-up cycle for the changes missed while reconnecting
+        assert wait_for(lambda: len(changes) == 1)
+        assert wait_for(lambda: reference_server.stream_requests == 2)
+        assert wait_for(lambda: subscriber.connected)
+    finally:
+        subscriber.stop()
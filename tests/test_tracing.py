@@ -0,0 +1,45 @@
+import pytest
+
+from splight_agent.tracing import NOOP_SPAN, Tracer
+
+
+class ListSink:
+    def __init__(self) -> None:
+        self.spans = []
+
+    def export(self, span) -> None:
+        self.spans.append(span)
+
+
+def test_disabled_tracer_hands_out_the_noop_span():
+    tracer = Tracer()
+    with tracer.span("engine.run", instance_id="id") as span:
+        span.set_attribute("result", "started")
+        with tracer.span("image.link") as child:
+            assert child is span is NOOP_SPAN
+
+
+def test_nested_spans_are_exported_with_their_parent():
+    sink = ListSink()
+    tracer = Tracer(sink)
+    with pytest.raises(RuntimeError):
+        with tracer.span("engine.run", instance_id="id") as parent:
+            with tracer.span("image.link"):
+                pass
+            raise RuntimeError("boom")
+    child, root = sink.spans
+    assert child.name == "image.link"
+    assert child.trace_id == root.trace_id
+    assert child.parent_id == root.span_id == parent.span_id
+    assert root.attributes == {"instance_id": "id"}
+    assert root.error == "RuntimeError: boom"
+    assert child.error is None
+
+
+def test_unsampled_traces_are_not_exported():
+    sink = ListSink()
+    tracer = Tracer(sink, sample_rate=0.0)
+    with tracer.span("dispatcher.cycle"):
+        with tracer.span("engine.run"):
+            pass
+    assert sink.spans == []